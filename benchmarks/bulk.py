@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Compares one request per path with the multi- modes of the python connector.
+
+Usage: python benchmarks/bulk.py [files]
+
+Serves a temporary folder with the WSGI application on a local wsgiref
+server, then for getinfo and delete times a loop of one request per file
+against a single multigetinfo or multidelete request for all of them,
+and prints files per second for each.
+"""
+import json, os, shutil, sys, tempfile, threading, time, urllib, urllib2
+from wsgiref.simple_server import make_server
+
+from loadtest import QuietHandler, ThreadingWSGIServer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connectors', 'python'))
+import filemanager
+
+
+def make_files(root, count):
+    paths = []
+    for i in xrange(count):
+        path = os.path.join(root, 'file%05d.txt' % i)
+        with open(path, 'wb') as f:
+            f.write('x' * 512)
+        paths.append(path)
+    return paths
+
+
+def request(url, **params):
+    return urllib2.urlopen(url, urllib.urlencode(params)).read()
+
+
+def measure(label, fn, count):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print '%-14s %8.0f files/s  %8.2f s' % (label, count / elapsed, elapsed)
+
+
+def main(count=2000):
+    root = tempfile.mkdtemp() + '/'
+    app = filemanager.WSGIApplication(filemanager.Filemanager(fileroot=root))
+    server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/' % server.server_port
+    try:
+        print '%d files' % count
+        paths = make_files(root, count)
+        measure('getinfo', lambda: [request(url, mode='getinfo', path=p) for p in paths], count)
+        measure('multigetinfo', lambda: request(url, mode='multigetinfo', paths=json.dumps(paths)), count)
+        measure('delete', lambda: [request(url, mode='delete', path=p) for p in paths], count)
+        paths = make_files(root, count)
+        measure('multidelete', lambda: request(url, mode='multidelete', paths=json.dumps(paths)), count)
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
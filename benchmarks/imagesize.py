@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Compares the header sniffer with PIL for reading image dimensions.
+
+Usage: python benchmarks/imagesize.py [images]
+
+Writes a corpus of PNG, GIF, BMP, JPEG and WebP files with PIL (WebP only
+if this PIL supports it), then times sniff_image_size against
+PIL.Image.open(...).size over the whole corpus and checks they agree.
+"""
+import os, shutil, sys, tempfile, time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connectors', 'python'))
+import filemanager
+
+
+formats = [('PNG', 'png'), ('GIF', 'gif'), ('BMP', 'bmp'), ('JPEG', 'jpg'), ('WEBP', 'webp')]
+
+
+def make_corpus(root, count):
+    paths = []
+    for i in xrange(count):
+        fmt, ext = formats[i % len(formats)]
+        path = os.path.join(root, 'image%05d.%s' % (i, ext))
+        try:
+            Image.new('RGB', (16 + i % 640, 16 + i % 480)).save(path, fmt)
+        except (IOError, KeyError):
+            continue # This PIL can't write the format.
+        paths.append(path)
+    return paths
+
+
+def sniff(path):
+    with open(path, 'rb') as f:
+        return filemanager.sniff_image_size(f)
+
+
+def pil(path):
+    return Image.open(path).size
+
+
+def measure(label, fn, paths):
+    start = time.time()
+    sizes = [fn(p) for p in paths]
+    elapsed = time.time() - start
+    print '%-6s %8.1f us/image' % (label, elapsed * 1e6 / len(paths))
+    return sizes
+
+
+def main(count=3000):
+    root = tempfile.mkdtemp()
+    try:
+        paths = make_corpus(root, count)
+        print '%d images' % len(paths)
+        sniffed = measure('sniff', sniff, paths)
+        decoded = measure('PIL', pil, paths)
+        mismatches = [p for p, a, b in zip(paths, sniffed, decoded) if a != tuple(b)]
+        print '%d mismatches' % len(mismatches)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Compares the per-entry getinfo listing with the scan_directory engine.
+
+Usage: python benchmarks/listing.py [entries]
+
+Creates a temporary folder of plain files, lists it both ways and prints
+the wall time and number of stat calls per 10k entries.
+"""
+import os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connectors', 'python'))
+import filemanager
+
+
+class StatCounter:
+    """Counts calls to os.stat and DirEntry.stat while active."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __enter__(self):
+        self._stat, self._scandir = os.stat, filemanager.scandir
+        counter = self
+
+        def counting_stat(*args, **kwargs):
+            counter.calls += 1
+            return counter._stat(*args, **kwargs)
+
+        class CountingEntry:
+            def __init__(self, entry):
+                self.name = entry.name
+                self._entry = entry
+            def stat(self, **kwargs):
+                counter.calls += 1
+                return self._entry.stat(**kwargs)
+
+        def counting_scandir(path):
+            return (CountingEntry(e) for e in counter._scandir(path))
+
+        os.stat = counting_stat
+        if self._scandir is not None:
+            filemanager.scandir = counting_scandir
+        return self
+
+    def __exit__(self, *exc):
+        os.stat, filemanager.scandir = self._stat, self._scandir
+
+
+def legacy_listing(path):
+    """The listing as getfolder used to do it: getinfo's syscalls per entry."""
+    result = {}
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        if os.path.exists(full):
+            result[full] = (os.path.isdir(full), os.path.getctime(full),
+                            os.path.getmtime(full), os.path.getsize(full))
+    return result
+
+
+def engine_listing(fm, path):
+    return dict(fm.folderinfo(path, getsizes=False))
+
+
+def measure(label, fn, entries):
+    with StatCounter() as counter:
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+    scale = 10000.0 / entries
+    print '%-10s %8.1f ms/10k  %8d stat calls/10k' % (label, elapsed * 1000 * scale, counter.calls * scale)
+
+
+def main(entries=10000):
+    root = tempfile.mkdtemp()
+    try:
+        for i in xrange(entries):
+            with open(os.path.join(root, 'file%06d.txt' % i), 'wb') as f:
+                f.write('x' * (i % 512))
+        fm = filemanager.Filemanager(fileroot=root)
+        print 'scandir: %s' % ('yes' if filemanager.scandir else 'no (os.listdir fallback)')
+        measure('getinfo', lambda: legacy_listing(root), entries)
+        measure('scandir', lambda: engine_listing(fm, root), entries)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
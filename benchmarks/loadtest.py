@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Load test for the python connector's HTTP front ends.
+
+Usage: python benchmarks/loadtest.py [--url URL --root PATH] [--clients N] [--seconds S]
+
+Without --url, generates a folder of files and images, serves it with
+the WSGI application on a threaded wsgiref server and drives that.  To
+compare with the mod_python handler, point --url at a deployment of it
+and --root at its fileroot (which should contain the same tree; the
+generated one is left in place with --keep).  Each client thread loops
+over getfolder, getinfo and download requests; the report gives
+throughput and latency percentiles per mode.
+"""
+import optparse, os, shutil, sys, tempfile, threading, time, urllib, urllib2
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connectors', 'python'))
+import filemanager
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_tree(root, files=2000, size=65536):
+    for i in xrange(files):
+        with open(os.path.join(root, 'file%05d.bin' % i), 'wb') as f:
+            f.write('x' * (size if i % 10 == 0 else 512))
+
+
+def client(url, root, deadline, results, lock):
+    names = sorted(n for n in os.listdir(root) if not n.startswith('.'))[:100]
+    requests = [('getfolder', {'path' : root})]
+    requests += [('getinfo', {'path' : os.path.join(root, n)}) for n in names[:10]]
+    requests += [('download', {'path' : os.path.join(root, n)}) for n in names[:10]]
+    i = 0
+    while time.time() < deadline:
+        mode, params = requests[i % len(requests)]
+        i += 1
+        params = dict(params, mode=mode)
+        start = time.time()
+        try:
+            urllib2.urlopen(url + '?' + urllib.urlencode(params)).read()
+            ok = True
+        except (urllib2.URLError, IOError):
+            ok = False
+        elapsed = time.time() - start
+        with lock:
+            results.setdefault(mode, []).append((elapsed, ok))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--url')
+    parser.add_option('--root')
+    parser.add_option('--clients', type='int', default=50)
+    parser.add_option('--seconds', type='int', default=20)
+    parser.add_option('--keep', action='store_true')
+    options, _ = parser.parse_args()
+
+    root, server = options.root, None
+    if root is None:
+        root = tempfile.mkdtemp() + '/'
+        make_tree(root)
+    if options.url is None:
+        app = filemanager.WSGIApplication(filemanager.Filemanager(fileroot=root))
+        server = make_server('127.0.0.1', 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        options.url = 'http://127.0.0.1:%d/' % server.server_port
+
+    results, lock = {}, threading.Lock()
+    deadline = time.time() + options.seconds
+    threads = [threading.Thread(target=client, args=(options.url, root, deadline, results, lock))
+               for _ in xrange(options.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print '%s, %d clients, %d s' % (options.url, options.clients, options.seconds)
+    print '%-10s %8s %8s %8s %8s %8s %7s' % ('mode', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'errors')
+    for mode, samples in sorted(results.items()):
+        times = sorted(t for t, _ in samples)
+        errors = len([ok for _, ok in samples if not ok])
+        print '%-10s %8.1f %8.1f %8.1f %8.1f %8.1f %7d' % (
+            mode, len(samples) / float(options.seconds),
+            percentile(times, .5) * 1000, percentile(times, .95) * 1000,
+            percentile(times, .99) * 1000, times[-1] * 1000, errors)
+
+    if server is not None:
+        server.shutdown()
+    if options.root is None and not options.keep:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the connectors' hot paths, with results to compare across runs.
+
+Usage: python benchmarks/suite.py [--scale F] [--only NAME,...] [--repeat N]
+                                  [--output FILE] [--compare FILE [--tolerance T]]
+                                  [--gae-sdk DIR --gae-app DIR]
+
+Generates synthetic trees in a temporary folder (a wide folder of 100k
+files, a tree 50 folders deep and a gallery of images; --scale shrinks
+or grows the file counts), then times getfolder, getinfo, download and
+add on the python connector and the jqueryFileTree dirlist, calling them
+in-process through fake requests so that no server is measured.  The
+memory benchmarks run the same modes on a tree held in a MemoryStorage,
+which takes the disk out of the numbers, and the s3 benchmarks on an
+S3Storage over the in-memory client in tests/fakes3.py, which measures
+the driver's requests without the network.  Each benchmark is run --repeat
+times and the results, with the median and fastest run, are written as
+JSON to --output (default: stdout).  With
+--compare, each result is checked against an earlier results file, and
+the exit status is 1 if any is more than --tolerance (default 0.2, 20%)
+slower.
+
+The GAE benchmarks run the GAE connector against the SDK's testbed
+datastore, memcache and blobstore stubs.  They need --gae-sdk, the App
+Engine SDK, and --gae-app, the application root providing py.constants,
+and are reported as skipped without them.
+"""
+import imp, json, optparse, os, platform, shutil, struct, StringIO, sys, tempfile, time, zlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'connectors', 'python'))
+sys.path.insert(0, os.path.join(here, '..', 'tests'))
+import filemanager
+from fakes3 import FakeS3Client
+
+
+class FakeRequest:
+    """Enough of a mod_python request for the connector's modes.
+
+    The response body is counted and thrown away; sendfile reads the
+    file, as the server would, so downloads include the disk reads.
+    """
+
+    def __init__(self, body='', headers=None):
+        self.headers_in = headers or {}
+        self.headers_out = {}
+        self.content_type = None
+        self.status = 200
+        self.method = 'POST' if body else 'GET'
+        self.args = ''
+        self.bytes = 0
+        self._body = StringIO.StringIO(body)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def write(self, data, flush=1):
+        self.bytes += len(data)
+
+    def set_content_length(self, length):
+        self.headers_out['Content-Length'] = str(length)
+
+    def sendfile(self, path, offset=0, length=-1):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while length != 0:
+                data = f.read(262144 if length < 0 else min(length, 262144))
+                if not data:
+                    break
+                self.bytes += len(data)
+                length -= len(data)
+
+
+class FakeDjangoRequest:
+    """The request jqueryFileTree.dirlist reads its POSTed "dir" and "depth" from."""
+
+    def __init__(self, **post):
+        self.method = 'POST'
+        self.POST = post
+        self.GET = {}
+        self.META = {}
+
+
+def png(width, height):
+    """Returns a valid grey PNG of the given size."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = ('\0' + '\x80' * width) * height
+    return ('\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+            + chunk('IDAT', zlib.compress(rows, 9)) + chunk('IEND', ''))
+
+
+def make_wide(root, files):
+    path = os.path.join(root, 'wide')
+    os.mkdir(path)
+    for i in xrange(files):
+        with open(os.path.join(path, 'file%06d.txt' % i), 'wb') as f:
+            f.write('x' * (i % 1024))
+    return path
+
+
+def make_deep(root, depth, files):
+    path = os.path.join(root, 'deep')
+    os.mkdir(path)
+    folders = [path]
+    for level in xrange(depth):
+        path = os.path.join(path, 'level%02d' % level)
+        os.mkdir(path)
+        folders.append(path)
+        for i in xrange(files):
+            with open(os.path.join(path, 'file%02d.txt' % i), 'wb') as f:
+                f.write('x' * 100)
+    return folders
+
+
+def make_gallery(root, images):
+    path = os.path.join(root, 'gallery')
+    os.mkdir(path)
+    for i in xrange(images):
+        with open(os.path.join(path, 'image%05d.png' % i), 'wb') as f:
+            f.write(png(64 + i % 1920, 48 + i % 1080))
+    return path
+
+
+def multipart(fields, filename, data):
+    boundary = 'suite-boundary-7d9f'
+    parts = ['--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, k, v)
+             for k, v in fields.items()]
+    parts.append('--%s\r\nContent-Disposition: form-data; name="newfile"; filename="%s"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n%s\r\n--%s--\r\n' % (boundary, filename, data, boundary))
+    body = ''.join(parts)
+    return body, {'Content-Type' : 'multipart/form-data; boundary=%s' % boundary,
+                  'Content-Length' : str(len(body))}
+
+
+def measure(fn, repeat):
+    """Calls fn(i) for i in range(repeat); returns the time each call took."""
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        fn(i)
+        times.append(time.time() - start)
+    return times
+
+
+def result(times, ops):
+    times = sorted(times)
+    median = times[len(times) // 2]
+    return {
+        'ops' : ops,
+        'runs' : len(times),
+        'median_seconds' : round(median, 6),
+        'min_seconds' : round(times[0], 6),
+        'ops_per_second' : round(ops / median, 1) if median else None,
+    }
+
+
+def python_benchmarks(root, scale, repeat):
+    """Yields (name, run) for the python connector and jqueryFileTree; run() returns the result."""
+    wide = make_wide(root, max(1, int(100000 * scale)))
+    deep = make_deep(root, 50, max(1, int(20 * scale)))
+    gallery = make_gallery(root, max(1, int(2000 * scale)))
+    uploads = os.path.join(root, 'uploads')
+    os.mkdir(uploads)
+    big = os.path.join(root, 'big.bin')
+    with open(big, 'wb') as f:
+        f.write(os.urandom(1 << 20) * 32)
+
+    fm = filemanager.Filemanager(fileroot=root + '/', searchindex=False)
+    def call(mode, req=None, **kwargs):
+        req = req or FakeRequest()
+        getattr(fm, mode)(req=req, **kwargs)
+        return req
+
+    entries = len(os.listdir(wide))
+    yield 'python.getfolder.wide', lambda: result(measure(lambda i: call('getfolder', path=wide + '/'), repeat), entries)
+    yield 'python.getfolder.wide_page', lambda: result(
+        measure(lambda i: call('getfolder', path=wide + '/', offset=entries // 2, limit=100), repeat), 100)
+    yield 'python.getfolder.deep', lambda: result(
+        measure(lambda i: [call('getfolder', path=p + '/') for p in deep], repeat), len(deep))
+    leaf = os.path.join(deep[-1], 'file00.txt')
+    yield 'python.getinfo.deep', lambda: result(
+        measure(lambda i: [call('getinfo', path=leaf) for _ in xrange(1000)], repeat), 1000)
+
+    images = len(os.listdir(gallery))
+    cold = filemanager.Filemanager(fileroot=root + '/', imagesizecache=False, searchindex=False)
+    yield 'python.getfolder.gallery_uncached', lambda: result(
+        measure(lambda i: cold.getfolder(path=gallery + '/', req=FakeRequest()), repeat), images)
+    call('getfolder', path=gallery + '/')
+    yield 'python.getfolder.gallery_cached', lambda: result(
+        measure(lambda i: call('getfolder', path=gallery + '/'), repeat), images)
+
+    yield 'python.download.32mb', lambda: result(measure(lambda i: call('download', path=big), repeat), 1)
+    yield 'python.download.range', lambda: result(measure(lambda i: [
+        call('download', FakeRequest(headers={'Range' : 'bytes=%d-%d' % (n << 16, (n << 16) + 4095)}), path=big)
+        for n in xrange(200)], repeat), 200)
+
+    data = os.urandom(1 << 18)
+    def add(i):
+        for n in xrange(20):
+            body, headers = multipart({'mode' : 'add', 'currentpath' : uploads + '/'}, 'upload-%d-%d.bin' % (i, n), data)
+            call('add', FakeRequest(body, headers))
+    yield 'python.add.256k', lambda: result(measure(add, repeat), 20)
+
+    try:
+        # The connector is a Django view.
+        from django.conf import settings
+        if not settings.configured:
+            settings.configure()
+        filetree = imp.load_source('jqueryFileTree', os.path.join(
+            here, '..', 'scripts', 'jquery.filetree', 'connectors', 'jqueryFileTree.py'))
+    except ImportError:
+        yield 'filetree', lambda: {'skipped' : 'needs Django'}
+        return
+    def dirlist(path, depth=1, cached=True):
+        if not cached:
+            filetree._fragments.clear()
+        filetree.dirlist(FakeDjangoRequest(dir=path + '/', depth=str(depth)))
+    yield 'filetree.dirlist.wide_uncached', lambda: result(
+        measure(lambda i: dirlist(wide, cached=False), repeat), entries)
+    yield 'filetree.dirlist.wide_cached', lambda: result(measure(lambda i: dirlist(wide), repeat), entries)
+    yield 'filetree.dirlist.deep', lambda: result(
+        measure(lambda i: [dirlist(p, cached=False) for p in deep], repeat), len(deep))
+    yield 'filetree.dirlist.deep_prefetch', lambda: result(
+        measure(lambda i: [dirlist(p, 3, cached=False) for p in deep[::3]], repeat), len(deep))
+
+
+def storage_benchmarks(name, storage, root, scale, repeat):
+    """Yields (name, run) for the python connector over a tree in storage, with names starting with name."""
+    wide = root + 'wide/'
+    storage.mkdir(wide)
+    files = max(1, int(100000 * scale))
+    for i in xrange(files):
+        with storage.create(wide, 'file%06d.txt' % i) as f:
+            f.write('x' * (i % 1024))
+    with storage.create(root, 'big.bin') as f:
+        f.write(os.urandom(1 << 20) * 32)
+    storage.mkdir(root + 'uploads')
+
+    fm = filemanager.Filemanager(fileroot=root, storage=storage)
+    def call(mode, req=None, **kwargs):
+        req = req or FakeRequest()
+        getattr(fm, mode)(req=req, **kwargs)
+        return req
+
+    yield name + '.getfolder.wide', lambda: result(measure(lambda i: call('getfolder', path=wide), repeat), files)
+    yield name + '.getinfo', lambda: result(
+        measure(lambda i: [call('getinfo', path=wide + 'file000000.txt') for _ in xrange(1000)], repeat), 1000)
+    yield name + '.download.32mb', lambda: result(measure(lambda i: call('download', path=root + 'big.bin'), repeat), 1)
+    data = os.urandom(1 << 18)
+    def add(i):
+        for n in xrange(20):
+            body, headers = multipart({'mode' : 'add', 'currentpath' : root + 'uploads/'}, 'upload-%d-%d.bin' % (i, n), data)
+            call('add', FakeRequest(body, headers))
+    yield name + '.add.256k', lambda: result(measure(add, repeat), 20)
+
+
+def gae_benchmarks(sdk, app, scale, repeat):
+    """Yields (name, run) for the GAE connector on the SDK's service stubs."""
+    sys.path[:0] = [sdk, app, os.path.join(here, '..', 'connectors', 'gae')]
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    from google.appengine.ext import webapp
+
+    bed = testbed.Testbed()
+    bed.activate()
+    try:
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        bed.init_blobstore_stub()
+        bed.init_taskqueue_stub()
+        gae = imp.load_source('gae_filemanager', os.path.join(here, '..', 'connectors', 'gae', 'filemanager.py'))
+        blobs = bed.get_stub(testbed.BLOBSTORE_SERVICE_NAME)
+
+        root = gae.Folder.get_by_path(gae.ROOT_PATH)
+        wide = gae.Folder(key_name=gae.join_path(gae.ROOT_PATH, 'wide'), path=gae.join_path(gae.ROOT_PATH, 'wide'))
+        wide.put()
+        files = max(1, int(2000 * scale))
+        batch = []
+        for i in xrange(files):
+            key = 'blob%06d' % i
+            blobs.CreateBlob(key, 'x' * (i % 1024))
+            name = 'file%06d.txt' % i
+            batch.append(gae.File(key_name=gae.join_path(wide.path, name), folder=wide, filename=name,
+                                  content=gae.blobstore.BlobKey(key)))
+            if len(batch) == 500:
+                gae.db.put(batch)
+                batch = []
+        gae.db.put(batch)
+
+        def call(**params):
+            handler = gae.FileManagerHandler()
+            handler.initialize(webapp.Request.blank('/?' + gae.urllib.urlencode(params)), webapp.Response())
+            handler.get()
+            return handler.response
+
+        yield 'gae.getfolder.wide', lambda: result(measure(lambda i: call(mode='getfolder', path=wide.path), repeat), files)
+        leaf = gae.join_path(wide.path, 'file000000.txt')
+        yield 'gae.getinfo', lambda: result(measure(lambda i: [call(mode='getinfo', path=leaf) for _ in xrange(200)], repeat), 200)
+        yield 'gae.download', lambda: result(measure(lambda i: [call(mode='download', path=leaf) for _ in xrange(200)], repeat), 200)
+        yield 'gae.search', lambda: result(measure(lambda i: [call(mode='search', q='file0001') for _ in xrange(20)], repeat), 20)
+    finally:
+        bed.deactivate()
+
+
+def compare(results, baseline, tolerance):
+    """Prints each benchmark's change from baseline; returns the names of regressions."""
+    regressions = []
+    for name, current in sorted(results['benchmarks'].items()):
+        before = baseline['benchmarks'].get(name)
+        if not before or 'median_seconds' not in before or 'median_seconds' not in current:
+            continue
+        change = current['median_seconds'] / before['median_seconds'] - 1 if before['median_seconds'] else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print >>sys.stderr, '%-36s %10.4f s %10.4f s %+7.1f%%%s' % (
+            name, before['median_seconds'], current['median_seconds'], change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--scale', type='float', default=1.0)
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--only', help='comma-separated name prefixes, e.g. python.getfolder,gae')
+    parser.add_option('--output')
+    parser.add_option('--compare')
+    parser.add_option('--tolerance', type='float', default=0.2)
+    parser.add_option('--gae-sdk')
+    parser.add_option('--gae-app')
+    options, _ = parser.parse_args()
+    prefixes = options.only.split(',') if options.only else ['']
+
+    results = {
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'scandir' : filemanager.scandir is not None,
+        'scale' : options.scale,
+        'repeat' : options.repeat,
+        'time' : int(time.time()),
+        'benchmarks' : {},
+    }
+    root = tempfile.mkdtemp()
+    try:
+        suites = [python_benchmarks(root, options.scale, options.repeat),
+                  storage_benchmarks('memory', filemanager.MemoryStorage('/memory/'), '/memory/',
+                                     options.scale, options.repeat),
+                  storage_benchmarks('s3', filemanager.S3Storage('/s3/', 'bucket', client=FakeS3Client()), '/s3/',
+                                     options.scale, options.repeat)]
+        if options.gae_sdk and options.gae_app:
+            suites.append(gae_benchmarks(options.gae_sdk, options.gae_app, options.scale, options.repeat))
+        else:
+            results['benchmarks']['gae'] = {'skipped' : 'needs --gae-sdk and --gae-app'}
+        for suite in suites:
+            for name, run in suite:
+                if any(name.startswith(p) for p in prefixes):
+                    outcome = results['benchmarks'][name] = run()
+                    if 'skipped' in outcome:
+                        print >>sys.stderr, '%-36s skipped: %s' % (name, outcome['skipped'])
+                    else:
+                        print >>sys.stderr, '%-36s %10.4f s %12s ops/s' % (name, outcome['median_seconds'], outcome['ops_per_second'])
+    finally:
+        shutil.rmtree(root)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+    if options.compare:
+        with open(options.compare) as f:
+            if compare(results, json.load(f), options.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,32 @@
 # -*- encoding: utf-8 -*-
 # GAE adapter for http://labs.corefive.com/projects/filemanager/
 
+import calendar
+import cgi
+import cProfile
 import datetime
+import email.utils
+import hashlib
+import itertools
 import logging
+import pstats
 import re
+import StringIO
+import threading
+import time
 import urllib
+import zipfile
 
 from django.utils import simplejson as json
 from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import taskqueue
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import blobstore_handlers
-from google.appengine.ext.webapp import template
 import google.appengine.ext.webapp.util
 
 from py import constants
@@ -21,11 +35,379 @@ from py import constants
 # exactly, which is not a very convenient assumption for us.
 ROOT_PATH = "/action/f"
 
+# Folder moves that don't finish within the request carry on in tasks posted
+# here, each running for up to MOVE_TASK_BUDGET seconds.
+MOVE_TASK_PATH = "/filemanager/connectors/gae/movefolder"
+MOVE_TASK_BUDGET = 300
+
+# Types that are already compressed, which archives store rather than deflate.
+COMPRESSED_EXTENSIONS = set([
+  "gif", "jpg", "jpeg", "png", "webp", "zip", "gz", "tgz", "bz2", "xz", "7z", "rar",
+  "mp3", "m4a", "ogg", "mp4", "m4v", "mov", "avi", "mkv", "webm",
+  "docx", "xlsx", "pptx", "odt", "ods", "odp", "jar",
+])
+
+# Uploads whose content (by MD5 and size) is already stored are given the stored
+# blob, and their own copy is deleted. SharedBlob counts the Files using each.
+DEDUPLICATE_UPLOADS = True
+
+# Folders and Files are stored under key names equal to their normalized
+# paths, so any path resolves with a single get by key. Entities created
+# before that were given numeric ids and can only be found by query, and folders
+# saved without a parent_path can only be listed by scanning their subtree;
+# leave this on until migrate_to_path_keys() has converted them all.
+LEGACY_PATH_QUERIES = True
+
+# Storage quota for everything under ROOT_PATH, in bytes and in files; None for
+# no limit. Usage is kept in one Usage entity, updated in a transaction by each
+# upload and deletion.
+QUOTA_BYTES = None
+QUOTA_FILES = None
+
+# The most levels of folders the file tree will list in one request.
+FILETREE_MAX_DEPTH = 3
+
+# Requests taking at least this many seconds have their cProfile stats logged.
+# None turns profiling off; it slows every request down.
+PROFILE_THRESHOLD = None
+
+_repeated_slashes = re.compile("//+")
+_trailing_slashes = re.compile(r"/+$")
+_extension = re.compile(r".+\.([^.]+)$")
+_folder_and_name = re.compile(r"(.+)/(.+)")
+
+def normalize_path(path):
+  path = _repeated_slashes.sub("/", path)
+  if path != "/":
+    path = _trailing_slashes.sub("", path)
+  return path
+
+def join_path(folder_path, name):
+  return normalize_path(folder_path + "/" + name)
+
+def parent_of(path):
+  return path.rsplit("/", 1)[0] or "/"
+
 class FileException(Exception):
   """Any error from one of the file/folder operations."""
 class EAlready(FileException):
   """File already exists."""
 
+# Substring search matches names by prefix queries on their suffixes, so every
+# suffix of the name is indexed, up to this many.
+MAX_SEARCH_SUFFIXES = 48
+
+def search_fields(name):
+  """Returns the indexed properties that search_dirents looks a dirent's name up by."""
+  lower = name.lower()
+  mo = _extension.match(lower)
+  return {
+    "name_lower": lower,
+    "name_suffixes": [ lower[i:] for i in range(min(len(lower), MAX_SEARCH_SUFFIXES)) ],
+    "extension": mo and mo.group(1),
+  }
+
+def _clone(entity, key_name, **changes):
+  """Returns an unsaved copy of entity under key_name, without dereferencing its references."""
+  values = dict(
+    (name, prop.get_value_for_datastore(entity))
+    for name, prop in entity.properties().items()
+  )
+  values.update(changes)
+  return type(entity)(key_name=key_name, **values)
+
+class LocalMemcache(object):
+  """In-process stand-in for the memcache module, for running without the memcache service."""
+  def __init__(self):
+    self.data = {}
+  
+  def get(self, key):
+    return self.data.get(key)
+  
+  def get_multi(self, keys):
+    return dict((k, self.data[k]) for k in keys if k in self.data)
+  
+  def set(self, key, value, time=0):
+    self.data[key] = value
+    return True
+  
+  def set_multi(self, mapping, time=0):
+    self.data.update(mapping)
+    return []
+  
+  def add(self, key, value, time=0):
+    if key in self.data:
+      return False
+    self.data[key] = value
+    return True
+  
+  def delete_multi(self, keys):
+    for k in keys:
+      self.data.pop(k, None)
+    return True
+  
+  def incr(self, key, delta=1, initial_value=None):
+    if key not in self.data:
+      if initial_value is None:
+        return None
+      self.data[key] = initial_value
+    self.data[key] += delta
+    return self.data[key]
+
+class DirentCache(object):
+  """Read-through cache of Folders, Files and folder listings.
+  
+  Dirents are cached by path, with "" recording that nothing is there.
+  Listings are cached under their folder's version number, which is bumped
+  whenever a child is added, removed or renamed, so a stale listing is simply
+  never read again. client is the memcache module, or a LocalMemcache.
+  """
+  max_listing = 1000
+  
+  def __init__(self, client):
+    self.client = client
+    self.hits = 0
+    self.misses = 0
+  
+  def _key(self, kind, path):
+    key = "fm:%s:%s" % (kind, path.encode("utf-8"))
+    if len(key) > 200:
+      key = "fm:%s#%s" % (kind, hashlib.sha1(key).hexdigest())
+    return key
+  
+  def _encode(self, entity):
+    return "" if entity is None else db.model_to_protobuf(entity).Encode()
+  
+  def _decode(self, data):
+    return None if data == "" else db.model_from_protobuf(entity_pb.EntityProto(data))
+  
+  def get_dirents(self, paths):
+    """Returns {path: dirent or None} for those of paths that are cached."""
+    keys = dict((self._key("d", path), path) for path in paths)
+    cached = self.client.get_multi(keys.keys())
+    self.hits += len(cached)
+    self.misses += len(keys) - len(cached)
+    return dict((keys[k], self._decode(v)) for k, v in cached.items())
+  
+  def set_dirents(self, dirents):
+    """Caches dirents, a {path: dirent or None} mapping."""
+    self.client.set_multi(dict(
+      (self._key("d", path), self._encode(dirent)) for path, dirent in dirents.items()))
+  
+  def version(self, path):
+    """The folder's listing version, which changes whenever its children do."""
+    key = self._key("v", path)
+    version = self.client.get(key)
+    if version is None:
+      # Start from the clock, so a version lost to eviction can't repeat.
+      self.client.add(key, int(time.time() * 1000))
+      version = self.client.get(key)
+    return version
+  
+  def get_listing(self, path):
+    """Returns the cached children of the folder at path, or None."""
+    data = self.client.get(self._key("l%s" % (self.version(path),), path))
+    if data is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return [ self._decode(d) for d in data ]
+  
+  def set_listing(self, path, children):
+    if len(children) <= self.max_listing:
+      try:
+        self.client.set(self._key("l%s" % (self.version(path),), path),
+          [ self._encode(c) for c in children ])
+      except ValueError:
+        pass # Too big for memcache.
+  
+  def get_fragment(self, path, depth):
+    """Returns (etag, html) of the cached file tree for the folder at path, or None.
+    
+    A fragment is only returned while none of the folders it lists has
+    changed since set_fragment.
+    """
+    data = self.client.get(self._key("t%d" % (depth,), path))
+    if data is not None:
+      versions, etag, html = data
+      keys = [ self._key("v", p) for p, v in versions ]
+      current = self.client.get_multi(keys)
+      if all(current.get(k) == v for k, (p, v) in zip(keys, versions)):
+        self.hits += 1
+        return etag, html
+    self.misses += 1
+    return None
+  
+  def set_fragment(self, path, depth, versions, etag, html):
+    """Caches a file tree fragment; versions is [(path, version)] of each folder it lists."""
+    try:
+      self.client.set(self._key("t%d" % (depth,), path), (versions, etag, html))
+    except ValueError:
+      pass # Too big for memcache.
+  
+  def invalidate(self, paths):
+    """Forgets the dirents at paths and the listings of their parent folders."""
+    self.client.delete_multi([ self._key("d", path) for path in paths ])
+    for folder in set(parent_of(path) for path in paths) | set(paths):
+      self.client.incr(self._key("v", folder), initial_value=int(time.time() * 1000))
+  
+  def stats(self):
+    total = self.hits + self.misses
+    return {
+      "hits": self.hits, "misses": self.misses,
+      "hit_rate": float(self.hits) / total if total else 0.0,
+    }
+
+dirent_cache = DirentCache(memcache)
+
+class RequestMetrics(object):
+  """Per-mode request counts, latency histograms, bytes written and datastore calls.
+  
+  Kept per instance, so each instance reports only the requests it served.
+  Datastore calls are counted by an API proxy hook while a request is
+  between start() and finish() on the same thread.
+  """
+  buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+  
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.durations = {}
+    self.totals = {}
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      "filemanager_metrics", self._count_call, "datastore_v3")
+  
+  def _count_call(self, service, call, request, response):
+    counts = getattr(self.local, "counts", None)
+    if counts is not None:
+      counts["datastore_calls"] = counts.get("datastore_calls", 0) + 1
+  
+  def start(self):
+    self.local.counts = {}
+  
+  def finish(self, mode, seconds, bytes, error=False):
+    counts = getattr(self.local, "counts", None) or {}
+    self.local.counts = None
+    counts["requests"] = 1
+    counts["bytes"] = bytes
+    if error:
+      counts["errors"] = 1
+    with self.lock:
+      histogram = self.durations.setdefault(mode, [0] * len(self.buckets) + [0.0, 0])
+      for i, bound in enumerate(self.buckets):
+        if seconds <= bound:
+          histogram[i] += 1
+      histogram[-2] += seconds
+      histogram[-1] += 1
+      for name, value in counts.items():
+        self.totals[name, mode] = self.totals.get((name, mode), 0) + value
+  
+  def render(self):
+    """Returns the metrics, and dirent_cache's hits and misses, as Prometheus text."""
+    lines = ["# TYPE filemanager_request_duration_seconds histogram"]
+    with self.lock:
+      for mode, histogram in sorted(self.durations.items()):
+        for bound, count in zip(self.buckets, histogram):
+          lines.append('filemanager_request_duration_seconds_bucket{mode="%s",le="%g"} %d' % (mode, bound, count))
+        lines.append('filemanager_request_duration_seconds_bucket{mode="%s",le="+Inf"} %d' % (mode, histogram[-1]))
+        lines.append('filemanager_request_duration_seconds_sum{mode="%s"} %r' % (mode, histogram[-2]))
+        lines.append('filemanager_request_duration_seconds_count{mode="%s"} %d' % (mode, histogram[-1]))
+      for name in ("requests", "errors", "bytes", "datastore_calls"):
+        lines.append("# TYPE filemanager_%s_total counter" % name)
+        for (counter, mode), value in sorted(self.totals.items()):
+          if counter == name:
+            lines.append('filemanager_%s_total{mode="%s"} %d' % (name, mode, value))
+    stats = dirent_cache.stats()
+    for name in ("hits", "misses"):
+      lines.append("# TYPE filemanager_dirent_cache_%s_total counter" % name)
+      lines.append("filemanager_dirent_cache_%s_total %d" % (name, stats[name]))
+    return "\n".join(lines) + "\n"
+
+request_metrics = RequestMetrics()
+
+def _put_new(entity):
+  """Puts entity, whose key name is its path, unless that key is already taken.
+  
+  The check and the put happen in one transaction, so two concurrent creates
+  of the same path can't both succeed.
+  """
+  def txn():
+    if db.get(entity.key()) is not None:
+      raise EAlready("Already exists: %s" % (entity.key().name(),))
+    entity.put()
+  db.run_in_transaction(txn)
+  dirent_cache.invalidate([entity.key().name()])
+
+def get_dirents_by_paths(paths):
+  """Returns the Folder or File at each of paths, or None.
+  
+  Paths are looked up in dirent_cache first, and the rest with one batch get.
+  """
+  paths = [ normalize_path(path) for path in paths ]
+  cached = dirent_cache.get_dirents(paths)
+  missing = [ path for path in paths if path not in cached ]
+  if missing:
+    keys = []
+    for path in missing:
+      keys.append(db.Key.from_path(Folder.kind(), path))
+      keys.append(db.Key.from_path(File.kind(), path))
+    entities = db.get(keys)
+    
+    loaded = {}
+    for i, path in enumerate(missing):
+      dirent = entities[2 * i] or entities[2 * i + 1]
+      if dirent is None and (LEGACY_PATH_QUERIES or path == ROOT_PATH):
+        dirent = Folder.get_by_path(path) or File.get_by_path(path)
+      loaded[path] = dirent
+    dirent_cache.set_dirents(loaded)
+    cached.update(loaded)
+  return [ cached[path] for path in paths ]
+
+def prefetch(dirents):
+  """Loads what getinfo needs from the Files among dirents in two batch gets.
+  
+  Each File's folder (for legacy files, whose path comes from it) and BlobInfo
+  are fetched for all of them at once and stored on the entities, instead of
+  being fetched one by one as getinfo dereferences them.
+  """
+  files = [ d for d in dirents if not d.is_folder ]
+  if not files:
+    return dirents
+  
+  folder_keys = list(set(
+    File.folder.get_value_for_datastore(f) for f in files
+    if not (f.is_saved() and f.key().name()) ))
+  folders = dict(zip(folder_keys, db.get(folder_keys))) if folder_keys else {}
+  for f in files:
+    folder = folders.get(File.folder.get_value_for_datastore(f))
+    if folder is not None:
+      f.folder = folder
+  
+  with_content = [ f for f in files if File.content.get_value_for_datastore(f) is not None ]
+  infos = blobstore.BlobInfo.get([ File.content.get_value_for_datastore(f) for f in with_content ]) if with_content else []
+  for f, info in zip(with_content, infos):
+    if info is not None:
+      f.content = info
+  return dirents
+
+def in_prefetched_batches(children, size=500):
+  """Yields the (cursor, dirent) pairs from children, prefetching size dirents at a time."""
+  batch = []
+  for child in children:
+    batch.append(child)
+    if len(batch) == size:
+      prefetch([ d for _, d in batch ])
+      for c in batch:
+        yield c
+      batch = []
+  prefetch([ d for _, d in batch ])
+  for c in batch:
+    yield c
+
+def _cursor_order(cursor):
+  kind, _, name = cursor.partition(":")
+  return (kind != "folder", name)
+
 class Folder(db.Model):
   is_folder = True
   
@@ -33,19 +415,45 @@ class Folder(db.Model):
   date_modified = db.DateTimeProperty(auto_now=True)
   
   path = db.StringProperty(required=True)
+  # The path of the containing folder, so that a folder's direct children can
+  # be fetched with one equality query (on parent_path, then path).
+  parent_path = db.StringProperty()
+  
+  # Filled in from the name, for search_dirents.
+  name_lower = db.StringProperty()
+  name_suffixes = db.StringListProperty()
+  extension = db.StringProperty()
+  
+  # Where the folder is being moved to, while it is: the key of its FolderMove.
+  moving_to = db.StringProperty()
+  
+  def __init__(self, *args, **kwargs):
+    if kwargs.get("parent_path") is None and kwargs.get("path"):
+      kwargs["parent_path"] = parent_of(kwargs["path"])
+    if kwargs.get("path"):
+      kwargs.update(search_fields(kwargs["path"].split("/")[-1]))
+      kwargs["extension"] = None
+    super(Folder, self).__init__(*args, **kwargs)
   
   @classmethod
   def get_by_path(cls, path):
-    path = re.sub("//+", "/", path)
-    if path != "/":
-      path = re.sub(r"/+$", "", path)
+    path = normalize_path(path)
     logging.info("Getting folder %s", path)
-    ds = cls.all().filter("path =", path).fetch(1)
-    if ds:
-      return ds[0]
+    cached = dirent_cache.get_dirents([path])
+    if path in cached and (cached[path] is not None or path != ROOT_PATH):
+      d = cached[path]
+      return d if d is not None and d.is_folder else None
+    d = cls.get_by_key_name(path)
+    if d is not None:
+      dirent_cache.set_dirents({path: d})
+      return d
+    if LEGACY_PATH_QUERIES:
+      ds = cls.all().filter("path =", path).fetch(1)
+      if ds:
+        return ds[0]
     if path == ROOT_PATH:
       # If the root folder doesn't exist, create it
-      d = cls(path=path)
+      d = cls(key_name=path, path=path)
       d.put()
       return d
     
@@ -58,50 +466,131 @@ class Folder(db.Model):
     return self.path.split("/")[-1]
   
   def child_folders(self):
-    r = []
-    prefix = re.sub("//+", "/", self.path + "/")
-    for d in self.all().filter("path >", prefix).order("path"):
+    return list(self._child_folders())
+  
+  def _child_folders(self, after=None):
+    """Yields the folders directly in this one, ordered by path, starting after the name after."""
+    if not LEGACY_PATH_QUERIES:
+      q = Folder.all().filter("parent_path =", self.path).order("path")
+      if after:
+        q.filter("path >", join_path(self.path, after))
+      for d in q:
+        yield d
+      return
+    # Folders without a parent_path can only be found by scanning the subtree.
+    prefix = _repeated_slashes.sub("/", self.path + "/")
+    for d in self.all().filter("path >", prefix + (after or "")).order("path"):
       if not d.path.startswith(prefix):
         break
       if '/' not in d.path[len(prefix):]:
-        r.append(d)
-    return r
+        yield d
   
-  def parent_path(self):
-    mo = re.match(r"(.+)/([^/]+)", self.path)
-    if not mo:
-      return "/"
-    return mo.group(1)
+  def _files(self, after=None):
+    """Yields the files in this folder by name, starting after the name after."""
+    q = File.all().filter("folder =", self).order("filename")
+    if after:
+      q.filter("filename >", after)
+    for f in q:
+      f.folder = self # Saves a get for each file's folder.
+      yield f
   
   def children(self):
-    return self.child_folders() + list(File.all().filter("folder =", self).order("filename"))
+    listing = dirent_cache.get_listing(self.path)
+    if listing is None:
+      listing = self.child_folders() + list(self._files())
+      dirent_cache.set_listing(self.path, listing)
+    return listing
+  
+  def iter_children(self, cursor=None):
+    """Yields (cursor, dirent) for each child, folders first, starting after cursor.
+    
+    The cursor is "folder:<name>" or "file:<name>", as yielded alongside the
+    previous child, so a listing can be resumed without re-reading the entries
+    before it.
+    
+    A cached listing is used if there is one; otherwise the children are
+    streamed from the datastore, and cached if the whole listing was read.
+    """
+    listing = dirent_cache.get_listing(self.path)
+    if listing is not None:
+      for d in listing:
+        c = ("folder:" if d.is_folder else "file:") + d.get_name()
+        if cursor is None or _cursor_order(c) > _cursor_order(cursor):
+          yield c, d
+      return
+    
+    seen = [] if cursor is None else None
+    for c, d in self._query_children(cursor):
+      if seen is not None and len(seen) <= dirent_cache.max_listing:
+        seen.append(d)
+      yield c, d
+    if seen is not None:
+      dirent_cache.set_listing(self.path, seen)
+  
+  def _query_children(self, cursor):
+    kind, _, after = (cursor or "").partition(":")
+    if kind != "file":
+      for d in self._child_folders(after if kind == "folder" else None):
+        yield "folder:" + d.get_name(), d
+      after = None
+    for f in self._files(after):
+      yield "file:" + f.filename, f
+  
+  def subtree(self):
+    """Returns this folder and all the folders below it."""
+    prefix = _repeated_slashes.sub("/", self.path + "/")
+    return [self] + list(
+      self.all().filter("path >", prefix).filter("path <", prefix + u"\ufffd"))
   
   def rename_to(self, new_name):
+    """Renames this folder and returns the new Folder."""
+    return self.move_to(join_path(parent_of(self.path), new_name))
+  
+  def move_to(self, new_path, budget=10):
+    """Moves this folder and everything below it to new_path, and returns the new Folder.
+    
+    Paths are keys, so every folder and file in the subtree is re-created under
+    its new path. The new folder is created first, in one transaction with a
+    FolderMove that records the move and reserves the path, and with marking
+    this folder as moving, so two moves of it can't both start; the subtree
+    then follows in batches through continue_move, for up to budget seconds
+    in this request and after that on the task queue.
+    """
     if self.path == "/":
       raise FileException("You can't rename the root folder")
     old_path = self.path
-    parent_path = self.parent_path()
-    new_path = re.sub("//+", "/", parent_path + "/" + new_name)
+    new_path = normalize_path(new_path)
+    if new_path == old_path or new_path.startswith(old_path + "/"):
+      raise FileException("You can't move a folder into itself")
+    if FolderMove.all().filter("old_path =", old_path).get() is not None:
+      raise FileException("Folder %s is already being moved" % (old_path,))
+    
+    renamed = _clone(self, new_path, path=new_path, parent_path=parent_of(new_path), moving_to=None)
+    move = FolderMove(key_name=new_path, old_path=old_path, folder=self.key())
+    def txn():
+      source = db.get(self.key())
+      if source is None:
+        raise FileException("Folder %s no longer exists" % (old_path,))
+      if source.moving_to and FolderMove.get_by_key_name(source.moving_to) is not None:
+        raise FileException("Folder %s is already being moved" % (old_path,))
+      if [ e for e in db.get([ renamed.key(), db.Key.from_path(File.kind(), new_path), move.key() ]) if e ]:
+        raise EAlready("Already exists: %s" % (new_path,))
+      source.moving_to = new_path
+      db.put([source, renamed, move])
+    try:
+      db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    except EAlready:
+      logging.error("%s already exists", new_path)
+      raise
+    dirent_cache.invalidate([new_path])
     
-    # This is a potential race condition. Worst case, we’ll have to clean up by hand.
-    # (The only way to avoid this would be to put all Files and Folders in the same
-    # entity group.)
-    db.run_in_transaction(self._rename, self.key(), new_path)
-    if 1 < self.all().filter("path =", new_path).count(2):
-      logging.error("Folder %s already exists", new_path)
-      db.run_in_transaction(self._rename, self.key(), old_path)
-      raise EAlready("Folder %s already exists", new_path)
-    if File.get_by_path(new_path) is not None:
-      logging.error("File %s already exists", new_path)
-      db.run_in_transaction(self._rename, self.key(), old_path)
-      raise EAlready("File %s already exists", new_path)
-    self.path = new_path
+    if not continue_move(new_path, budget):
+      taskqueue.add(url=MOVE_TASK_PATH, params={"path": new_path})
+    return renamed
   
-  @classmethod
-  def _rename(cls, key, new_path):
-    folder = cls.get(key)
-    folder.path = new_path
-    folder.put()
+  def delete(self):
+    db.delete(self)
+    dirent_cache.invalidate([self.path])
 
 class File(db.Model):
   is_folder = False
@@ -116,7 +605,19 @@ class File(db.Model):
   
   content = blobstore.BlobReferenceProperty()
   
+  # Filled in from the filename, for search_dirents.
+  name_lower = db.StringProperty()
+  name_suffixes = db.StringListProperty()
+  extension = db.StringProperty()
+  
+  def __init__(self, *args, **kwargs):
+    if kwargs.get("filename"):
+      kwargs.update(search_fields(kwargs["filename"]))
+    super(File, self).__init__(*args, **kwargs)
+  
   def get_path(self):
+    if self.is_saved() and self.key().name():
+      return self.key().name()
     if self.folder.path.endswith("/"):
       return self.folder.path + self.filename
     return self.folder.path + "/" + self.filename
@@ -125,7 +626,7 @@ class File(db.Model):
     return self.filename
   
   def get_extension(self):
-    mo = re.match(r".+\.([^.]+)$", self.filename)
+    mo = _extension.match(self.filename)
     if mo is None:
       return None
     return mo.group(1)
@@ -135,7 +636,17 @@ class File(db.Model):
   
   @classmethod
   def get_by_path(cls, path):
-    mo = re.match(r"(.+)/(.+)", path)
+    path = normalize_path(path)
+    cached = dirent_cache.get_dirents([path])
+    if path in cached:
+      f = cached[path]
+      return f if f is not None and not f.is_folder else None
+    f = cls.get_by_key_name(path)
+    if f is not None:
+      dirent_cache.set_dirents({path: f})
+    if f is not None or not LEGACY_PATH_QUERIES:
+      return f
+    mo = _folder_and_name.match(path)
     if not mo:
       return None
     folder_path, filename = mo.group(1), mo.group(2)
@@ -148,82 +659,531 @@ class File(db.Model):
     return files[0]
   
   def rename_to(self, new_name):
-    old_name = self.filename
-    # This is a potential race condition. Worst case, we’ll have to clean up by hand.
-    # (The only way to avoid this would be to put all Files and Folders in the same
-    # entity group.)
-    db.run_in_transaction(self._rename, self.key(), new_name)
-    if 1 < self.all().filter("folder =", self.folder).filter("filename =", new_name).count(2):
-      logging.error("Duplicate filename %s in folder %s", new_name, self.folder.path)
-      db.run_in_transaction(self._rename, self.key(), old_name)
-      raise EAlready("Duplicate filename %s in folder %s" % (new_name, self.folder.path))
-    if Folder.get_by_path(self.get_path()) is not None:
-      logging.error("Path %s is already in use by a folder", self.get_path())
-      db.run_in_transaction(self._rename, self.key(), old_name)
-      raise EAlready("Path %s is already in use by a folder" % (self.get_path(),))
+    """Renames this file and returns the new File, which has replaced this one."""
+    return self.move_to(self.folder, new_name)
   
-  @classmethod
-  def _rename(cls, key, new_name):
-    f = cls.get(key)
-    f.filename = new_name
-    f.put()
+  def move_to(self, folder, new_name=None):
+    """Moves this file into folder, optionally renaming it, and returns the new File."""
+    new_name = new_name or self.filename
+    folder_path = folder.path
+    new_path = join_path(folder_path, new_name)
+    if Folder.get_by_path(new_path) is not None:
+      logging.error("Path %s is already in use by a folder", new_path)
+      raise EAlready("Path %s is already in use by a folder" % (new_path,))
+    renamed = _clone(self, new_path, filename=new_name, folder=folder.key())
+    try:
+      _put_new(renamed)
+    except EAlready:
+      logging.error("Duplicate filename %s in folder %s", new_name, folder_path)
+      raise EAlready("Duplicate filename %s in folder %s" % (new_name, folder_path))
+    db.delete(self)
+    dirent_cache.invalidate([self.get_path()])
+    return renamed
   
   def delete(self):
-    if self.content is not None:
-      self.content.delete()
+    blob_key = File.content.get_value_for_datastore(self)
     db.delete(self)
+    if blob_key is not None:
+      info = blobstore.BlobInfo.get(blob_key)
+      if info is not None:
+        charge_usage(-info.size, -1)
+      release_blobs([blob_key])
+    dirent_cache.invalidate([self.get_path()])
   
   def write_to(self, out):
-    br = blobstore.BlobReader(self.content.key())
+    """Copies the blob to out, with read sizes growing up to the blobstore's fetch limit."""
+    size = 65536
+    br = blobstore.BlobReader(self.content.key(), buffer_size=blobstore.MAX_BLOB_FETCH_SIZE)
     while True:
-      buf = br.read(8192)
+      buf = br.read(size)
       if not buf:
         break
       out.write(buf)
+      size = min(size * 2, blobstore.MAX_BLOB_FETCH_SIZE)
 
-class FileTreeHandler(webapp.RequestHandler):
+class FolderMove(db.Model):
+  """A folder move in progress, keyed by the path the folder is moving to."""
+  old_path = db.StringProperty(required=True)
+  # The folder being moved; legacy folders are keyed by id, not by old_path.
+  folder = db.ReferenceProperty(Folder, collection_name="moves")
+  date_created = db.DateTimeProperty(auto_now_add=True)
+
+def _move_folder(folder, new_path):
+  """Re-creates folder's files under new_path and deletes them, then does the same for folder.
+  
+  Every step can be repeated, so this can be re-run after an interruption.
+  """
+  new_key = db.Key.from_path(Folder.kind(), new_path)
+  moved = [folder.path, new_path]
+  while True:
+    files = File.all().filter("folder =", folder.key()).fetch(500)
+    if not files:
+      break
+    db.put([ _clone(f, join_path(new_path, f.filename), folder=new_key) for f in files ])
+    db.delete(files)
+    moved += [ f.get_path() for f in files ] + [ join_path(new_path, f.filename) for f in files ]
+  if folder.path != new_path and db.get(new_key) is None:
+    db.put(_clone(folder, new_path, path=new_path, parent_path=parent_of(new_path), moving_to=None))
+  db.delete(folder)
+  dirent_cache.invalidate(moved)
+
+def continue_move(new_path, budget=None, batch_size=50):
+  """Moves the next batches of the subtree being moved to new_path; returns True once it's all moved.
+  
+  Folders below the old path are moved a batch at a time, each with its
+  files, and deleted once moved, so the next batch is simply
+  what's left. The moved folder itself goes last, found through the key
+  recorded in the FolderMove, and the FolderMove is deleted only once it has
+  moved. Stops after budget seconds, if given; it's then safe to call again,
+  even while another call is still running.
+  """
+  move = FolderMove.get_by_key_name(new_path)
+  if move is None:
+    return True
+  start = time.time()
+  old_path = move.old_path
+  prefix = old_path + "/"
+  while budget is None or time.time() - start < budget:
+    keys = Folder.all(keys_only=True).filter("path >", prefix).filter("path <", prefix + u"\ufffd").fetch(batch_size)
+    if not keys:
+      old_key = FolderMove.folder.get_value_for_datastore(move)
+      old = db.get(old_key) if old_key is not None else Folder.get_by_path(old_path)
+      if old is not None:
+        _move_folder(old, new_path)
+      move.delete()
+      return True
+    # The query can lag behind the deletes; the gets can't.
+    for folder in [ f for f in db.get(keys) if f is not None ]:
+      _move_folder(folder, new_path + folder.path[len(old_path):])
+  return False
+
+class SharedBlob(db.Model):
+  """The blob shared by the Files with one content, keyed by its MD5, and how many use it."""
+  blob = blobstore.BlobReferenceProperty(required=True)
+  size = db.IntegerProperty(required=True)
+  refs = db.IntegerProperty(default=0)
+
+def share_blob(info):
+  """Returns the key of the blob a new File of the uploaded blob info should use.
+  
+  If the same content is already shared, the upload is deleted and the shared
+  blob's count goes up; otherwise the upload becomes the shared blob.
+  """
+  key = info.key()
+  def txn():
+    shared = SharedBlob.get_by_key_name(info.md5_hash)
+    if shared is None:
+      SharedBlob(key_name=info.md5_hash, blob=key, size=info.size, refs=1).put()
+      return key
+    if shared.size != info.size:
+      return key # Same MD5, different content: don't share.
+    shared.refs += 1
+    shared.put()
+    return SharedBlob.blob.get_value_for_datastore(shared)
+  shared_key = db.run_in_transaction(txn)
+  if shared_key != key:
+    blobstore.delete(key)
+  return shared_key
+
+def release_blobs(blob_keys):
+  """Deletes each of the blobs, and its thumbnail, unless other Files still share it."""
+  unused = []
+  for key, info in zip(blob_keys, blobstore.BlobInfo.get(blob_keys)):
+    if info is None:
+      continue
+    def txn():
+      shared = SharedBlob.get_by_key_name(info.md5_hash)
+      if shared is None or SharedBlob.blob.get_value_for_datastore(shared) != key:
+        return True
+      shared.refs -= 1
+      if shared.refs > 0:
+        shared.put()
+        return False
+      shared.delete()
+      return True
+    if db.run_in_transaction(txn):
+      unused.append(key)
+  if unused:
+    db.delete([ Thumbnail.key_for(k) for k in unused ])
+    blobstore.delete(unused)
+
+class Usage(db.Model):
+  """Bytes and files stored under the root (the key name), kept current by uploads and deletions."""
+  bytes = db.IntegerProperty(default=0)
+  files = db.IntegerProperty(default=0)
+  date_reconciled = db.DateTimeProperty()
+
+def get_usage():
+  """Returns the root's Usage, or None if nothing has been stored or counted yet.
+  
+  Files stored before usage was kept are only counted by reconcile_usage().
+  """
+  return Usage.get_by_key_name(ROOT_PATH)
+
+def charge_usage(size, files=1):
+  """Adds size bytes and files to the root's usage, unless that would exceed the quota.
+  
+  Returns False, changing nothing, if it would. Negative amounts (for
+  deletions) are always applied.
+  """
+  def txn():
+    usage = Usage.get_by_key_name(ROOT_PATH) or Usage(key_name=ROOT_PATH)
+    if size > 0 or files > 0:
+      if QUOTA_BYTES is not None and usage.bytes + size > QUOTA_BYTES:
+        return False
+      if QUOTA_FILES is not None and usage.files + files > QUOTA_FILES:
+        return False
+    usage.bytes += size
+    usage.files += files
+    usage.put()
+    return True
+  return db.run_in_transaction(txn)
+
+def reconcile_usage(cursor=None, batch_size=500):
+  """Recounts the root's usage from the Files, batch_size at a time.
+  
+  Call this repeatedly, passing back the returned cursor, until it comes back
+  as None; the count so far travels in the cursor, and the last call replaces
+  the Usage entity. The blob sizes of each batch are read with one batch get.
+  Uploads and deletions during the count may be missed.
+  """
+  size, files, query_cursor = (cursor or "0:0:").split(":", 2)
+  size, files = int(size), int(files)
+  q = File.all()
+  if query_cursor:
+    q.with_cursor(query_cursor)
+  batch = q.fetch(batch_size)
+  blob_keys = [ File.content.get_value_for_datastore(f) for f in batch ]
+  for info in blobstore.BlobInfo.get([ k for k in blob_keys if k is not None ]):
+    if info is not None:
+      size += info.size
+  files += len(batch)
+  if len(batch) == batch_size:
+    return "%d:%d:%s" % (size, files, q.cursor())
+  Usage(key_name=ROOT_PATH, bytes=size, files=files, date_reconciled=datetime.datetime.now()).put()
+  return None
+
+def delete_dirents(dirents):
+  """Deletes the Files and (empty) Folders in dirents, with one batch delete for all of them.
+  
+  Does what each one's delete() would, with the blobs released together.
+  """
+  blob_keys = [ File.content.get_value_for_datastore(d) for d in dirents if not d.is_folder ]
+  db.delete(dirents)
+  blob_keys = [ k for k in blob_keys if k is not None ]
+  if blob_keys:
+    size = sum(info.size for info in blobstore.BlobInfo.get(blob_keys) if info is not None)
+    charge_usage(-size, -len(blob_keys))
+    release_blobs(blob_keys)
+  dirent_cache.invalidate([ d.get_path() for d in dirents ])
+
+def migrate_to_path_keys(cursor=None, batch_size=100):
+  """Re-creates up to batch_size legacy Folders and Files under path key names.
+  
+  Entities made before the path index have numeric ids and are only reachable
+  through LEGACY_PATH_QUERIES. Call this repeatedly, passing back the returned
+  cursor, until the cursor comes back as None; then LEGACY_PATH_QUERIES can be
+  turned off. Folders are migrated first, so that files are copied with their
+  final folder reference, and every folder is saved with its parent_path.
+  Returns (number migrated, cursor).
+  """
+  kind, _, query_cursor = (cursor or "Folder:").partition(":")
+  migrated = 0
+  while kind:
+    q = db.Query(Folder if kind == "Folder" else File)
+    if query_cursor:
+      q.with_cursor(query_cursor)
+    batch = q.fetch(batch_size)
+    for dirent in batch:
+      if dirent.key().name():
+        dirent.put() # Stores the parent_path and search fields filled in on load.
+        continue
+      if dirent.is_folder:
+        path = normalize_path(dirent.path)
+        new = _clone(dirent, path, path=path, parent_path=parent_of(path))
+        new.put()
+        for f in File.all().filter("folder =", dirent):
+          f.folder = new
+          f.put()
+      else:
+        new = _clone(dirent, dirent.get_path())
+        new.put()
+      db.delete(dirent)
+      migrated += 1
+    if len(batch) == batch_size:
+      return migrated, "%s:%s" % (kind, q.cursor())
+    kind, query_cursor = ("File" if kind == "Folder" else None), None
+  return migrated, None
+
+def search_dirents(query, match="substring", folder_path=ROOT_PATH, limit=100):
+  """Returns up to limit Folders and Files below folder_path whose name matches query, by path.
+  
+  match is "substring", "prefix" or "extension", as in the python connector.
+  Each is a single-property query on an indexed field, so no index.yaml
+  entries are needed. The folder is checked on the results, reading further
+  batches until limit matches below it are found; these are the first
+  found, in index order, rather than the first by path.
+  """
+  query = query.lower()
+  prefix = _repeated_slashes.sub("/", normalize_path(folder_path) + "/")
+  found = {}
+  for model in (Folder, File):
+    q = model.all()
+    if match == "extension":
+      q.filter("extension =", query.lstrip("."))
+    else:
+      field = "name_lower" if match == "prefix" else "name_suffixes"
+      q.filter(field + " >=", query).filter(field + " <", query + u"\ufffd")
+    count = 0
+    for d in q.run(batch_size=limit):
+      path = d.get_path()
+      # A name can match on more than one of its suffixes.
+      if path.startswith(prefix) and path not in found:
+        found[path] = d
+        count += 1
+        if count == limit:
+          break
+  return [ found[path] for path in sorted(found)[:limit] ]
+
+class Thumbnail(db.Model):
+  """A generated thumbnail image.
+  
+  The key_name is made from the source blob key and the thumbnail size. An
+  uploaded blob never changes, so a thumbnail stays valid for as long as its
+  File points at the same blob.
+  """
+  width, height = 64, 64
+  
+  data = db.BlobProperty(required=True)
+  date_created = db.DateTimeProperty(auto_now_add=True)
+  
+  @classmethod
+  def key_for(cls, blob_key):
+    return db.Key.from_path(cls.kind(), "%s:%dx%d" % (blob_key, cls.width, cls.height))
+
+def http_date(dt):
+  return email.utils.formatdate(calendar.timegm(dt.utctimetuple()), usegmt=True)
+
+def is_not_modified(request, etag, modified):
+  """True if the request's If-None-Match / If-Modified-Since match etag and the datetime modified."""
+  match = request.headers.get("If-None-Match")
+  if match is not None:
+    tags = [t.strip() for t in match.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+  since = request.headers.get("If-Modified-Since")
+  if since is not None and modified is not None:
+    parsed = email.utils.parsedate_tz(since)
+    return parsed is not None and calendar.timegm(modified.utctimetuple()) <= email.utils.mktime_tz(parsed)
+  return False
+
+def send_file(handler, f, attachment=False):
+  """Has the blobstore serve the content of File f as handler's response.
+  
+  The body is streamed by App Engine itself, not copied through the app. The
+  blob key doubles as a strong ETag, so conditional requests get a 304, and a
+  single byte range is passed on to the blobstore, which answers it with a 206.
+  (Multiple ranges aren't supported there, so they get the whole blob.)
+  """
+  blob_key = str(f.content.key())
+  etag = '"%s"' % (blob_key,)
+  headers = handler.response.headers
+  headers["ETag"] = etag
+  headers["Accept-Ranges"] = "bytes"
+  if f.date_modified is not None:
+    headers["Last-Modified"] = http_date(f.date_modified)
+  if is_not_modified(handler.request, etag, f.date_modified):
+    handler.response.set_status(304)
+    return
+  
+  headers["Content-type"] = f.content.content_type
+  if attachment:
+    headers["Content-disposition"] = "attachment; filename=" + f.filename
+  byte_range = handler.request.headers.get("Range")
+  if byte_range and "," not in byte_range and handler.request.headers.get("If-Range", etag) == etag:
+    headers[blobstore.BLOB_RANGE_HEADER] = byte_range
+  headers[blobstore.BLOB_KEY_HEADER] = blob_key
+
+class FolderMoveTaskHandler(webapp.RequestHandler):
+  """Task queue handler that finishes a folder move, re-queueing itself until it's done.
+  
+  Map MOVE_TASK_PATH to it with login: admin, so only the task queue can call it.
+  """
   def post(self):
-    path = urllib.unquote_plus(self.request.get("dir"))
-    logging.info("Generating file tree for %s", path)
-    folder = Folder.get_by_path(path)
-    if folder:
-      self.response.out.write(template.render("../templates/filemanager/filetree.tmpl", {
-        "listing": folder.children()
-      }))
+    path = self.request.get("path")
+    if not continue_move(path, MOVE_TASK_BUDGET):
+      taskqueue.add(url=MOVE_TASK_PATH, params={"path": path})
+
+def render_tree(folder, depth, versions, out, hidden_class=""):
+  """Appends the jqueryFileTree <ul> of folder's children to out, depth levels deep.
+  
+  Levels below the first are hidden, marked "prefetched" for jqueryFileTree.js.
+  (path, version) of each folder listed is appended to versions.
+  """
+  versions.append((folder.path, dirent_cache.version(folder.path)))
+  out.append('<ul class="jqueryFileTree%s" style="display: none;">' % (hidden_class,))
+  for dirent in folder.children():
+    path, name = cgi.escape(dirent.get_path(), True), cgi.escape(dirent.get_name())
+    if dirent.is_folder:
+      out.append('<li class="directory collapsed"><a href="#" rel="%s/">%s/</a>' % (path, name))
+      if depth > 1:
+        render_tree(dirent, depth - 1, versions, out, " prefetched")
+      out.append('</li>')
+    else:
+      out.append('<li class="file ext_%s"><a href="#" rel="%s">%s</a></li>' % (
+        cgi.escape(dirent.get_extension() or "", True), path, name))
+  out.append('</ul>')
+
+class FileTreeHandler(webapp.RequestHandler):
+  """Serves jqueryFileTree listings from HTML fragments cached until a folder in them changes."""
+  def get(self):
+    path = normalize_path(urllib.unquote_plus(self.request.get("dir")))
+    try:
+      depth = max(1, min(FILETREE_MAX_DEPTH, int(self.request.get("depth") or 1)))
+    except ValueError:
+      depth = 1
+    cached = dirent_cache.get_fragment(path, depth)
+    if cached is None:
+      logging.info("Generating file tree for %s", path)
+      folder = Folder.get_by_path(path)
+      if folder is None:
+        self.response.out.write("<i>not found!</i>")
+        return
+      versions, out = [], []
+      render_tree(folder, depth, versions, out)
+      html = "".join(out).encode("utf-8")
+      etag = '"%s"' % (hashlib.sha1(repr(versions) + html).hexdigest()[:16],)
+      dirent_cache.set_fragment(path, depth, versions, etag, html)
+      cached = etag, html
+    
+    etag, html = cached
+    self.response.headers["ETag"] = etag
+    self.response.headers["Cache-Control"] = "private, no-cache"
+    if is_not_modified(self.request, etag, None):
+      self.response.set_status(304)
+      return
+    self.response.out.write(html)
+  
+  post = get
+
+EXTENSIONS_WITH_ICONS = set([
+  "aac", "avi", "bmp", "chm", "css", "dll", "doc", "fla", "gif", "htm", "html", "ini", "jar",
+  "jpeg", "jpg", "js", "lasso", "mdb", "mov", "mp3", "mpg", "pdf", "php", "png", "ppt", "py",
+  "rb", "real", "reg", "rtf", "sql", "swf", "txt", "vbs", "wav", "wma", "wmv", "xls", "xml",
+  "xsl", "zip",
+])
+
+_icons = {}
+
+def file_icon(extension):
+  """Returns the preview icon for a file extension, which may be None."""
+  try:
+    return _icons[extension]
+  except KeyError:
+    icon = "/filemanager/images/fileicons/default.png"
+    if extension in EXTENSIONS_WITH_ICONS:
+      icon = "/filemanager/images/fileicons/%s.png" % (extension,)
+    _icons[extension] = icon
+    return icon
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+def _format_datetime(dt):
+  return None if dt is None else dt.strftime("%Y-%m-%d %H:%M:%S")
+
+class DirEntryInfo(object):
+  """The getinfo record of a Folder or File, written straight to JSON by json().
+  
+  Listings make one per entry, so it has slots rather than nested dicts.
+  """
+  __slots__ = ("path", "filename", "filetype", "preview", "created", "modified", "width", "height", "size")
+  
+  def __init__(self, dirent):
+    self.path = dirent.get_path()
+    self.filename = dirent.get_name()
+    self.created = _format_datetime(dirent.date_created)
+    self.modified = _format_datetime(dirent.date_modified)
+    if dirent.is_folder:
+      self.filetype = "dir"
+      self.preview = "/filemanager/images/fileicons/_Open.png"
+      self.width = self.height = self.size = None
+      return
+    extension = dirent.get_extension()
+    self.filetype = extension or "txt"
+    self.preview = file_icon(extension)
+    # Use a thumbnail for images
+    if dirent.content and dirent.content.content_type.startswith("image/"):
+      self.preview = "/action/t/" + self.path[len("/action/f/"):] if self.path.startswith("/action/f/") else self.path
+    self.width, self.height = dirent.width, dirent.height
+    self.size = dirent.get_size()
+  
+  def json(self):
+    values = [ _encode_string(v) if v is not None else "null" for v in (
+      self.path, self.filename, self.filetype, self.preview, self.created, self.modified) ]
+    if self.filetype == "dir":
+      values.append("")
     else:
-      self.response.out.write("<i>not found!</i>")
+      values.append(', "Width": %s, "Height": %s, "Size": %d' % (
+        "null" if self.width is None else self.width, "null" if self.height is None else self.height, self.size))
+    return ('{"Path": %s, "Filename": %s, "File Type": %s, "Preview": %s, "Error": "", "Code": 0, '
+            '"Properties": {"Date Created": %s, "Date Modified": %s%s}}') % tuple(values)
 
 class FileManagerHandler(blobstore_handlers.BlobstoreUploadHandler):
-  modes = ["getinfo", "getfolder", "rename", "delete", "addfolder", "download", "getuploadpath", "added"]
-  extensions_with_icons = set([
-    "aac", "avi", "bmp", "chm", "css", "dll", "doc", "fla", "gif", "htm", "html", "ini", "jar",
-    "jpeg", "jpg", "js", "lasso", "mdb", "mov", "mp3", "mpg", "pdf", "php", "png", "ppt", "py",
-    "rb", "real", "reg", "rtf", "sql", "swf", "txt", "vbs", "wav", "wma", "wmv", "xls", "xml",
-    "xsl", "zip",
-  ])
+  modes = ["getinfo", "getfolder", "rename", "delete", "addfolder", "download", "getuploadpath", "added", "search",
+           "multigetinfo", "multidelete", "multimove", "downloadarchive", "dedupstats", "usage", "metrics"]
   def get(self):
     mode = self.request.get("mode")
     if mode in self.modes:
       method = getattr(self, mode)
+      profile = cProfile.Profile() if PROFILE_THRESHOLD is not None else None
+      request_metrics.start()
+      start, error = time.time(), True
       try:
-        response = method()
-      except FileException, e:
-        logging.exception("FileException in method %s", mode)
-        response = {"Error": e.args[0], "Code": -1}
-      
-      if mode == "added":
-        # Yes, seriously.
-        self.response.out.write("<textarea>" + json.dumps(response) + "</textarea>")
-      elif mode != "download":
-        self.response.headers["Content-type"] = "application/json"
-        self.response.out.write(json.dumps(response))
+        try:
+          response = profile.runcall(method) if profile is not None else method()
+        except FileException, e:
+          logging.exception("FileException in method %s", mode)
+          response = {"Error": e.args[0], "Code": -1}
+        
+        if mode == "added":
+          # Yes, seriously.
+          self.response.out.write("<textarea>" + json.dumps(response) + "</textarea>")
+        elif response is not None:
+          # Modes that stream their own output (download, getfolder) return None.
+          self.response.headers["Content-type"] = "application/json"
+          self.response.out.write(response.json() if isinstance(response, DirEntryInfo) else json.dumps(response))
+        error = False
+      finally:
+        elapsed = time.time() - start
+        request_metrics.finish(mode, elapsed, self.response.out.tell(), error)
+        if profile is not None and elapsed >= PROFILE_THRESHOLD:
+          out = StringIO.StringIO()
+          pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(30)
+          logging.warning("Slow %s request, %.2f s:\n%s", mode, elapsed, out.getvalue())
     else:
       self.error(500)
   
   def getuploadpath(self):
-    return { "Path": blobstore.create_upload_url(self.request.path), "Error": "", "Code": -1 }
+    """Returns a blobstore upload URL, which refuses uploads too big for the quota left."""
+    if QUOTA_BYTES is None and QUOTA_FILES is None:
+      return { "Path": blobstore.create_upload_url(self.request.path), "Error": "", "Code": -1 }
+    usage = get_usage() or Usage()
+    remaining = None if QUOTA_BYTES is None else QUOTA_BYTES - usage.bytes
+    if (remaining is not None and remaining <= 0) or (QUOTA_FILES is not None and usage.files >= QUOTA_FILES):
+      return { "Error": "Quota exceeded", "Code": -1 }
+    return { "Path": blobstore.create_upload_url(self.request.path, max_bytes_total=remaining), "Error": "", "Code": -1 }
+  
+  def usage(self):
+    usage = get_usage() or Usage()
+    return {
+      "Bytes": usage.bytes, "Files": usage.files,
+      "Quota": QUOTA_BYTES, "File Quota": QUOTA_FILES,
+      "Error": "", "Code": 0,
+    }
   
   def post(self):
+    if self.request.get("mode") in ("multigetinfo", "multidelete", "multimove", "downloadarchive"):
+      # Long lists of paths are POSTed as a form.
+      return self.get()
     if self.request.get("mode") != "add":
       self.error(405)
       return
@@ -246,9 +1206,30 @@ class FileManagerHandler(blobstore_handlers.BlobstoreUploadHandler):
       }))
       return
     
-    dirent = File(folder=folder, content=uploaded_file, filename=uploaded_file.filename)
+    if not charge_usage(uploaded_file.size):
+      blobstore.delete(uploaded_file.key())
+      self.redirect(self.request.path + "?" + urllib.urlencode({
+        "mode": "added",
+        "error": "Quota exceeded",
+      }))
+      return
+    
+    content = uploaded_file.key()
+    if DEDUPLICATE_UPLOADS:
+      content = share_blob(uploaded_file)
+    dirent = File(key_name=join_path(folder.path, uploaded_file.filename),
+      folder=folder, content=content, filename=uploaded_file.filename)
     # xxxx - width/height for images
-    dirent.put()
+    try:
+      _put_new(dirent)
+    except EAlready:
+      charge_usage(-uploaded_file.size, -1)
+      release_blobs([content])
+      self.redirect(self.request.path + "?" + urllib.urlencode({
+        "mode": "added",
+        "error": "File already exists",
+      }))
+      return
     
     logging.info("path=%s, file=%s", path, uploaded_file)
     self.redirect(self.request.path + "?" + urllib.urlencode({
@@ -271,14 +1252,8 @@ class FileManagerHandler(blobstore_handlers.BlobstoreUploadHandler):
       "Error": "", "Code": 0,
     }
   
-  def _format_datetime(self, dt):
-    return None if dt is None else datetime.datetime.strftime(dt, "%Y-%m-%d %H:%M:%S")
-  
   def get_dirent_by_path(self, path):
-    dirent = Folder.get_by_path(path)
-    if dirent is None:
-      dirent = File.get_by_path(path)
-    return dirent
+    return get_dirents_by_paths([path])[0]
   
   def getinfo(self, dirent=None):
     if dirent is None:
@@ -287,70 +1262,66 @@ class FileManagerHandler(blobstore_handlers.BlobstoreUploadHandler):
       if dirent is None:
         logging.error("Path not found: %s", path)
         return {"Error": "Not found", "Code": -1}
-    
-    r = {
-      "Path": dirent.get_path(),
-      "Filename": dirent.get_name(),
-      "Properties": {
-        "Date Created": self._format_datetime(dirent.date_created),
-        "Date Modified": self._format_datetime(dirent.date_modified),
-      },
-    }
-    if dirent.is_folder:
-      r.update({
-        "File Type": "dir",
-        "Preview": "/filemanager/images/fileicons/_Open.png",
-      })
-    else:
-      icon = "/filemanager/images/fileicons/default.png"
-      extension = dirent.get_extension()
-      if extension is None:
-        extension = "txt"
-      elif extension in self.extensions_with_icons:
-        icon = "/filemanager/images/fileicons/%s.png" % (extension,)
-      
-      # Use a thumbnail for images
-      if dirent.content and dirent.content.content_type.startswith("image/"):
-        icon = re.sub(r"^/action/f/", "/action/t/", dirent.get_path())
-      
-      r.update({
-        "File Type": extension,
-        "Preview": icon,
-      })
-      r["Properties"].update({
-        "Width": dirent.width,
-        "Height": dirent.height,
-        "Size": dirent.get_size(),
-      })
-    r.update({"Error": "", "Code": 0})
-    return r
+    return DirEntryInfo(dirent)
   
   def getfolder(self):
-    path, show_thumbs = [ self.request.get(x) for x in ["path", "showThumbs"] ]
+    path, show_thumbs, cursor, offset, limit = [
+      self.request.get(x) for x in ["path", "showThumbs", "cursor", "offset", "limit"] ]
+    offset = int(offset) if offset.isdigit() else 0
+    limit = int(limit) if limit.isdigit() else None
     d = self.get_dirent_by_path(path)
     if not d:
       raise FileException("Folder %s not found" % (path,))
     if not d.is_folder:
       raise FileException("%s is not a folder" % (path,))
     
-    return dict(
+    children = d.iter_children(cursor or None)
+    if offset or limit is not None:
+      children = itertools.islice(children, offset, None if limit is None else offset + limit)
+    if limit is not None:
+      children = list(children)
+      if children and len(children) == limit:
+        self.response.headers["X-Filemanager-Cursor"] = children[-1][0]
+    
+    self.response.headers["Content-type"] = "application/json"
+    self._write_json_object(self.response.out, (
       (dirent.get_path(), self.getinfo(dirent))
-      for dirent in d.children()
-    )
+      for _, dirent in in_prefetched_batches(children)
+    ))
+  
+  def search(self):
+    path, query, match, limit = [ self.request.get(x) for x in ["path", "q", "match", "limit"] ]
+    limit = min(int(limit), 1000) if limit.isdigit() and int(limit) else 100
+    dirents = prefetch(search_dirents(query, match or "substring", path or ROOT_PATH, limit))
+    self.response.headers["Content-type"] = "application/json"
+    self._write_json_object(self.response.out, (
+      (dirent.get_path(), self.getinfo(dirent)) for dirent in dirents ))
+  
+  def _write_json_object(self, out, items, chunksize=100):
+    """Writes the (key, value) pairs from items to out as one JSON object, as they are produced."""
+    chunk = ["{"]
+    for i, (key, value) in enumerate(items):
+      if i:
+        chunk.append(", ")
+      chunk.append(json.dumps(key))
+      chunk.append(": ")
+      chunk.append(value.json() if isinstance(value, DirEntryInfo) else json.dumps(value))
+      if len(chunk) >= 4 * chunksize:
+        out.write("".join(chunk))
+        chunk = []
+    chunk.append("}")
+    out.write("".join(chunk))
   
   def addfolder(self):
     path, name = [ self.request.get(x) for x in ["path", "name"] ]
     logging.info("Creating folder: %s/%s", path, name)
-    if path.endswith("/"):
-      new_path = path + name
-    else:
-      new_path = path + "/" + name
+    new_path = join_path(path, name)
     parent_folder = Folder.get_by_path(path)
     if parent_folder is None:
       raise FileException("Folder %s does not exist" % (path,))
     if self.get_dirent_by_path(new_path) is not None:
       raise EAlready("Already exists: %s" % (new_path,))
-    Folder(path = new_path).put()
+    _put_new(Folder(key_name=new_path, path=new_path))
     return {
       "Parent": path if path.endswith("/") else path + "/",
       "Name": name,
@@ -365,7 +1336,7 @@ class FileManagerHandler(blobstore_handlers.BlobstoreUploadHandler):
       return {"Error": "File not found", "Code": -1}
     
     old_name = dirent.get_name()
-    dirent.rename_to(new_name)
+    dirent = dirent.rename_to(new_name)
     return {
       "Old Path": old_path,
       "Old Name": old_name,
@@ -386,6 +1357,89 @@ class FileManagerHandler(blobstore_handlers.BlobstoreUploadHandler):
     dirent.delete()
     return {"Error": "", "Code": 0, "Path": path}
   
+  def _paths(self):
+    """Returns the JSON array of paths given to the multi- modes, normalized."""
+    try:
+      paths = json.loads(self.request.get("paths") or "[]")
+    except ValueError:
+      paths = None
+    if not isinstance(paths, list) or not all(isinstance(p, basestring) for p in paths):
+      raise FileException("paths must be a JSON array of paths")
+    return [ normalize_path(p) for p in paths ]
+  
+  def _multiresult(self, results):
+    failed = len([ r for r in results if r["Code"] ])
+    return {
+      "Results": results,
+      "Failed": failed,
+      "Error": "%d of %d failed" % (failed, len(results)) if failed else "",
+      "Code": 0,
+    }
+  
+  def multigetinfo(self):
+    """Writes getinfo for each of the paths, fetched with one batch get and one prefetch."""
+    paths = self._paths()
+    dirents = get_dirents_by_paths(paths)
+    prefetch([ d for d in dirents if d is not None ])
+    self.response.headers["Content-type"] = "application/json"
+    self._write_json_object(self.response.out, (
+      (path, self.getinfo(d) if d is not None else {"Path": path, "Error": "Not found", "Code": -1})
+      for path, d in zip(paths, dirents) ))
+  
+  def multidelete(self):
+    """Deletes the files and empty folders at paths with one batch delete."""
+    paths = self._paths()
+    results, deletable = [], []
+    for path, d in zip(paths, get_dirents_by_paths(paths)):
+      if d is None:
+        results.append({"Path": path, "Error": "File not found", "Code": -1})
+      elif d.is_folder and 0 < len(d.children()):
+        results.append({"Path": path + "/", "Error": "Folder not empty", "Code": -1})
+      else:
+        results.append({"Path": path + "/" if d.is_folder else path, "Error": "", "Code": 0})
+        deletable.append(d)
+    if deletable:
+      delete_dirents(deletable)
+    return self._multiresult(results)
+  
+  def multimove(self):
+    """Moves each of paths into folder.
+    
+    Files are re-created under their new paths with one batch put and one batch
+    delete, after one batch get has checked the new paths are free (rather
+    than a transaction per file, as rename does). Folders are moved one at a
+    time, with their subtrees.
+    """
+    paths = self._paths()
+    folder = Folder.get_by_path(self.request.get("folder"))
+    if folder is None:
+      raise FileException("Folder %s does not exist" % (self.request.get("folder"),))
+    
+    new_paths = [ join_path(folder.path, p.split("/")[-1]) for p in paths ]
+    results, files = [], []
+    dirents = get_dirents_by_paths(paths)
+    taken = get_dirents_by_paths(new_paths)
+    for path, new_path, d, existing in zip(paths, new_paths, dirents, taken):
+      result = {"Old Path": path, "New Path": new_path, "Error": "", "Code": 0}
+      results.append(result)
+      if d is None:
+        result.update({"Error": "File not found", "Code": -1})
+      elif existing is not None or new_path in [ f[1] for f in files ]:
+        result.update({"Error": "Already exists: %s" % (new_path,), "Code": -1})
+      elif d.is_folder:
+        try:
+          d.move_to(new_path)
+        except FileException, e:
+          result.update({"Error": e.args[0], "Code": -1})
+      else:
+        files.append((d, new_path))
+    
+    if files:
+      db.put([ _clone(f, new_path, folder=folder.key()) for f, new_path in files ])
+      db.delete([ f for f, _ in files ])
+      dirent_cache.invalidate([ p for f, new_path in files for p in (f.get_path(), new_path) ])
+    return self._multiresult(results)
+  
   def download(self):
     path = self.request.get("path")
     dirent = self.get_dirent_by_path(path)
@@ -394,9 +1448,69 @@ class FileManagerHandler(blobstore_handlers.BlobstoreUploadHandler):
       self.error(404)
       return
     
-    self.response.headers["Content-type"] = dirent.content.content_type
-    self.response.headers["Content-disposition"] = "attachment; filename=" + dirent.filename
-    dirent.write_to(self.response.out)
+    send_file(self, dirent, attachment=True)
+
+  def dedupstats(self):
+    """Returns the space saved by sharing blobs between Files with the same content."""
+    blobs = stored = referenced = 0
+    for shared in SharedBlob.all().run(batch_size=1000):
+      blobs += 1
+      stored += shared.size
+      referenced += shared.size * shared.refs
+    return {
+      "Blobs": blobs, "Stored": stored, "Referenced": referenced,
+      "Ratio": round(float(referenced) / stored, 3) if stored else 1.0,
+      "Error": "", "Code": 0,
+    }
+  
+  def metrics(self):
+    """Writes this instance's request metrics in the Prometheus text format."""
+    self.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+    self.response.out.write(request_metrics.render())
+  
+  def downloadarchive(self):
+    """Sends the folder at path, or the folders and files in paths, as a zip.
+    
+    The runtime buffers whole responses, so unlike the python connector's
+    archives this one is built in memory and is limited to the maximum
+    response size. Types in COMPRESSED_EXTENSIONS are stored, not deflated.
+    """
+    if self.request.get("paths"):
+      paths = self._paths()
+    else:
+      paths = [ normalize_path(self.request.get("path")) ]
+    dirents = [ d for d in get_dirents_by_paths(paths) if d is not None ]
+    if not dirents:
+      self.error(404)
+      return
+    
+    name = dirents[0].get_name() if len(dirents) == 1 else "download"
+    self.response.headers["Content-Type"] = "application/zip"
+    self.response.headers["Content-Disposition"] = (
+      'attachment; filename="%s.zip"' % (name.replace('"', ''),)).encode("utf-8")
+    archive = zipfile.ZipFile(self.response.out, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    for d in dirents:
+      base = len(parent_of(d.get_path()).rstrip("/")) + 1
+      if not d.is_folder:
+        self._archive_file(archive, d, d.get_path()[base:])
+        continue
+      for folder in d.subtree():
+        info = zipfile.ZipInfo(folder.path[base:] + "/", folder.date_modified.timetuple()[:6])
+        info.external_attr = 040755 << 16 | 0x10
+        archive.writestr(info, "")
+        for f in folder._files():
+          self._archive_file(archive, f, f.get_path()[base:])
+    archive.close()
+  
+  def _archive_file(self, archive, f, name):
+    info = zipfile.ZipInfo(name, f.date_modified.timetuple()[:6])
+    info.external_attr = 0644 << 16
+    if (f.get_extension() or "").lower() in COMPRESSED_EXTENSIONS:
+      info.compress_type = zipfile.ZIP_STORED
+    else:
+      info.compress_type = zipfile.ZIP_DEFLATED
+    blob_key = File.content.get_value_for_datastore(f)
+    archive.writestr(info, blobstore.BlobReader(blob_key).read() if blob_key else "")
 
 class FileHandler(webapp.RequestHandler):
   def get(self, path):
@@ -407,8 +1521,7 @@ class FileHandler(webapp.RequestHandler):
       self.error(404)
       return
     
-    self.response.headers["Content-type"] = f.content.content_type
-    f.write_to(self.response.out)
+    send_file(self, f)
 
 class ThumbnailHandler(webapp.RequestHandler):
   def get(self, path_suffix):
@@ -423,13 +1536,28 @@ class ThumbnailHandler(webapp.RequestHandler):
       self.error(404)
       return
     
-    img = images.Image(blob_key=str(f.content.key()))
-    img.resize(width=64, height=64)
-    img.im_feeling_lucky()
-    thumbnail = img.execute_transforms(output_encoding=images.JPEG)
+    blob_key = str(f.content.key())
+    etag = '"%s"' % (blob_key,)
+    self.response.headers["ETag"] = etag
+    self.response.headers["Cache-Control"] = "public, max-age=86400"
+    if f.date_modified is not None:
+      self.response.headers["Last-Modified"] = http_date(f.date_modified)
+    if is_not_modified(self.request, etag, f.date_modified):
+      self.response.set_status(304)
+      return
+    
+    key = Thumbnail.key_for(blob_key)
+    thumbnail = Thumbnail.get(key)
+    if thumbnail is None:
+      img = images.Image(blob_key=blob_key)
+      img.resize(width=Thumbnail.width, height=Thumbnail.height)
+      img.im_feeling_lucky()
+      thumbnail = Thumbnail(key_name=key.name(),
+        data=db.Blob(img.execute_transforms(output_encoding=images.JPEG)))
+      thumbnail.put()
 
     self.response.headers['Content-Type'] = 'image/jpeg'
-    self.response.out.write(thumbnail)
+    self.response.out.write(thumbnail.data)
 
 def main():
   handlers = [
@@ -437,6 +1565,7 @@ def main():
     ('/filemanager/connectors/gae/filemanager.gae', FileManagerHandler),
     ('(/action/f/.+)', FileHandler),
     ('/action/t/(.+)', ThumbnailHandler),
+    (MOVE_TASK_PATH, FolderMoveTaskHandler),
   ]
 
   webapp.util.run_wsgi_app(
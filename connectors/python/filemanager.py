@@ -3,12 +3,21 @@ from __future__ import with_statement # This isn't required in Python 2.6
 __metaclass__ = type
 
 
+from collections import deque
 from contextlib import closing, contextmanager 
-import os, sys, traceback
+from datetime import date
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import atexit, base64, calendar, cProfile, cStringIO, ctypes, ctypes.util, errno, hashlib, heapq, httplib, itertools, mimetypes, multiprocessing, os, re, select, stat, struct, sys, tarfile, tempfile, threading, time, traceback, urllib, urlparse, zlib
 import os.path
+from multiprocessing.pool import ThreadPool
 
-from mod_python import apache, util
-from util import parse_qs
+from cgi import parse_header, parse_qs
+
+try:
+    from mod_python import apache, util
+except ImportError:
+    # Outside Apache (benchmarks, scripts) only the Filemanager class is usable.
+    apache = util = None
 
 today = date.today
 
@@ -23,10 +32,24 @@ except ImportError:
     raise EnvironmentError('Must have the json module.  (It is included in Python 2.6 or can be installed on version 2.5.)')
 
 
+# PIL is only needed for image formats sniff_image_size can't parse, so it
+# is imported on first use rather than at startup.
+Image = None
+
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
 try:
-    from PIL import Image
+    from os import scandir
 except ImportError:
-    raise EnvironmentError('Must have the PIL (Python Imaging Library).')
+    try:
+        from scandir import scandir # The backport from PyPI, for Python < 3.5.
+    except ImportError:
+        scandir = None
     
 
 path_exists = os.path.exists
@@ -35,11 +58,30 @@ absolute_path = os.path.abspath
 make_url = urlparse.urljoin
 split_path = os.path.split
 split_ext = os.path.splitext
+join_path = os.path.join
+
+
+encode_urlpath = urllib.quote_plus
+
+encode_json = json.JSONEncoder().encode
+
 
+imagetypes = frozenset(['gif','jpg','jpeg','png'])
 
-euncode_urlpath = urllib.quote_plus
+# Already compressed, so archives store them rather than deflating them again.
+compressedtypes = frozenset(['gif','jpg','jpeg','png','webp','zip','gz','tgz','bz2','xz','7z','rar',
+                             'mp3','m4a','ogg','mp4','m4v','mov','avi','mkv','webm',
+                             'docx','xlsx','pptx','odt','ods','odp','jar'])
 
-encode_json = json.JSONEcoder().encode
+HTTP_FORBIDDEN = 403
+HTTP_NOT_FOUND = 404
+HTTP_NOT_MODIFIED = 304
+HTTP_PARTIAL_CONTENT = 206
+HTTP_RANGE_NOT_SATISFIABLE = 416
+HTTP_SERVICE_UNAVAILABLE = 503
+HTTP_GATEWAY_TIMEOUT = 504
+
+iconroot = join_path(os.path.dirname(absolute_path(__file__)), '..', '..')
 
 
 def encodeURLsafeBase64(data):
@@ -49,13 +91,2083 @@ def image(*args):
     raise NotImplementedError 
 
 
+def scan_directory(path, follow_symlinks=True):
+    """Yields (name, stat_result) for every entry in the directory at path.
+
+    Each entry is stat-ed exactly once: with scandir the result of
+    DirEntry.stat() is cached on the entry, and without it we fall back
+    to a single os.stat per name instead of the exists/getctime/getmtime/
+    getsize round that getinfo does.  Entries that vanish between the
+    directory read and the stat are skipped.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                yield entry.name, entry.stat(follow_symlinks=follow_symlinks)
+            except OSError:
+                continue
+    else:
+        statfn = os.stat if follow_symlinks else os.lstat
+        for name in os.listdir(path):
+            try:
+                yield name, statfn(join_path(path, name))
+            except OSError:
+                continue
+
+
+def iter_names(path):
+    """Yields the names in the directory at path without stat-ing them."""
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name
+    else:
+        for name in os.listdir(path):
+            yield name
+
+
+_icon_cache = {}
+
+def file_icon(ext):
+    """Returns the preview icon for a file extension, checking the icon
+    directory only once per extension."""
+    try:
+        return _icon_cache[ext]
+    except KeyError:
+        previewPath = 'images/fileicons/' + ext + '.png'
+        if not path_exists(join_path(iconroot, previewPath)):
+            previewPath = 'images/fileicons/default.png'
+        _icon_cache[ext] = previewPath
+        return previewPath
+
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+class DirEntryInfo(object):
+
+    """The getinfo record of a file or folder, as sent to the client.
+
+    Listings make one of these per entry, so they have slots instead of
+    the nested dicts of the wire format, and json() writes that format
+    directly.  A record with a non-zero code is an error for path.
+    """
+
+    __slots__ = ('path', 'filename', 'filetype', 'preview', 'created', 'modified',
+                 'width', 'height', 'size', 'files', 'error', 'code')
+
+    def __init__(self, path, filename='', filetype='', preview='', created='', modified='',
+                 size='', error='', code=0):
+        self.path = path
+        self.filename = filename
+        self.filetype = filetype
+        self.preview = preview
+        self.created = created
+        self.modified = modified
+        self.width = self.height = ''
+        self.size = size
+        self.files = None
+        self.error = error
+        self.code = code
+
+    def json(self):
+        if self.code:
+            return '{"Path": %s, "Error": %s, "Code": %d}' % (
+                _encode_string(self.path), _encode_string(self.error), self.code)
+        # Times are floats, which json writes as repr does; the rest are numbers or ''.
+        width, height, size = self.width, self.height, self.size
+        return ('{"Filename": %s, "File Type": %s, "Preview": %s, "Path": %s, "Error": "", "Code": 0, '
+                '"Properties": {"Date Created": %r, "Date Modified": %r, "Width": %s, "Height": %s, "Size": %s%s}}') % (
+            _encode_string(self.filename), _encode_string(self.filetype), _encode_string(self.preview),
+            _encode_string(self.path), self.created, self.modified,
+            '""' if width == '' else '%d' % width, '""' if height == '' else '%d' % height,
+            '""' if size == '' else '%d' % size, '' if self.files is None else ', "Files": %d' % self.files)
+
+
+def is_true(value):
+    """Interprets a boolean request parameter such as getsize=true."""
+    if isinstance(value, basestring):
+        return value.lower() not in ('', '0', 'false', 'no')
+    return bool(value)
+
+
+def to_int(value, default=None):
+    """Interprets an integer request parameter, falling back to default."""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def write_json_object(write, items, chunksize=256):
+    """Writes the (key, value) pairs from items as one JSON object.
+
+    The object is encoded and handed to write a few hundred members at a
+    time, so neither the full dict nor its full encoding is ever held in
+    memory.  Returns the number of members written.
+    """
+    count = 0
+    chunk = ['{']
+    for key, value in items:
+        if count:
+            chunk.append(', ')
+        chunk.append(_encode_string(key))
+        chunk.append(': ')
+        chunk.append(value.json() if isinstance(value, DirEntryInfo) else encode_json(value))
+        count += 1
+        if count % chunksize == 0:
+            write(''.join(chunk))
+            chunk = []
+    chunk.append('}')
+    write(''.join(chunk))
+    return count
+
+
+_jpeg_sof_markers = frozenset(range(0xC0, 0xD0)) - frozenset([0xC4, 0xC8, 0xCC])
+
+def _sniff_jpeg(f):
+    f.seek(2)
+    for _ in xrange(64): # Give up on files with an absurd number of segments.
+        byte = f.read(1)
+        while byte and byte != '\xff':
+            byte = f.read(1)
+        while byte == '\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = ord(byte)
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            continue
+        header = f.read(2)
+        if len(header) < 2:
+            return None
+        length = struct.unpack('>H', header)[0]
+        if marker in _jpeg_sof_markers:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>xHH', data)
+            return width, height
+        f.seek(length - 2, 1)
+    return None
+
+def sniff_image_size(f):
+    """Returns (width, height) read from the header of the image file f, or None.
+
+    Understands PNG, GIF, BMP, WebP and JPEG (by scanning the segment markers
+    for the start-of-frame, seeking over everything else), reading at most a
+    few hundred bytes for each.  Returns None for anything else.
+    """
+    head = f.read(32)
+    if head[:8] == '\x89PNG\r\n\x1a\n' and head[12:16] == 'IHDR':
+        return struct.unpack('>II', head[16:24])
+    if head[:6] in ('GIF87a', 'GIF89a'):
+        return struct.unpack('<HH', head[6:10])
+    if head[:2] == 'BM' and len(head) >= 26:
+        if struct.unpack('<I', head[14:18])[0] == 12:
+            return struct.unpack('<HH', head[18:22])
+        width, height = struct.unpack('<ii', head[18:26])
+        return width, abs(height)
+    if head[:4] == 'RIFF' and head[8:12] == 'WEBP' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == 'VP8 ' and head[23:26] == '\x9d\x01\x2a':
+            width, height = struct.unpack('<HH', head[26:30])
+            return width & 0x3fff, height & 0x3fff
+        if chunk == 'VP8L' and head[20] == '\x2f':
+            bits = struct.unpack('<I', head[21:25])[0]
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == 'VP8X':
+            return (struct.unpack('<I', head[24:27] + '\0')[0] + 1,
+                    struct.unpack('<I', head[27:30] + '\0')[0] + 1)
+        return None
+    if head[:2] == '\xff\xd8':
+        return _sniff_jpeg(f)
+    return None
+
+def pil_image_size(path):
+    """Returns (width, height) of the image at path as decoded by PIL, or None."""
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+    try:
+        return Image.open(path).size
+    except IOError:
+        return None
+
+def read_image_size(path):
+    """Returns (width, height) of the image at path, or None if it can't be read.
+
+    The header sniffer handles the common formats; PIL is only consulted for
+    files it doesn't recognise.
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = sniff_image_size(f)
+    except (IOError, struct.error):
+        size = None
+    if size is None:
+        size = pil_image_size(path)
+    return size
+
+
+class ImageSizeCache:
+
+    """Persistent cache of image dimensions, kept in a SQLite sidecar file.
+
+    Entries are keyed by (st_dev, st_ino) and are only used while the file's
+    mtime and size still match, so a changed or replaced image is measured
+    again on its next lookup.  Unreadable images are cached too, so they
+    aren't reopened on every listing.  hits and misses count lookups since
+    the cache was created.
+    """
+
+    def __init__(self, filename, measure=read_image_size):
+        self.filename = filename
+        self.measure = measure
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=10, isolation_level=None)
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS imagesize ('
+                       'dev INTEGER, ino INTEGER, mtime REAL, size INTEGER, '
+                       'width INTEGER, height INTEGER, PRIMARY KEY (dev, ino))')
+            self._local.db = db
+        return db
+
+    def get(self, path, st):
+        """Returns (width, height) for the image at path with stat result st, or None."""
+        db = self._db()
+        row = db.execute('SELECT mtime, size, width, height FROM imagesize WHERE dev = ? AND ino = ?',
+                         (st.st_dev, st.st_ino)).fetchone()
+        if row is not None and row[0] == st.st_mtime and row[1] == st.st_size:
+            self.hits += 1
+            return None if row[2] is None else (row[2], row[3])
+        
+        self.misses += 1
+        size = self.measure(path)
+        width, height = size if size is not None else (None, None)
+        db.execute('INSERT OR REPLACE INTO imagesize VALUES (?, ?, ?, ?, ?, ?)',
+                   (st.st_dev, st.st_ino, st.st_mtime, st.st_size, width, height))
+        return size
+
+    def stats(self):
+        """Returns the hit and miss counters as a dict."""
+        return {'hits' : self.hits, 'misses' : self.misses}
+
+
+class FolderSizes:
+
+    """Recursive size and file count of directories, kept in a SQLite sidecar.
+
+    Each directory's row holds the size and count of the files directly in
+    it, the totals for its whole subtree and its mtime when it was scanned.
+    get() revalidates a subtree by stat-ing only its directories: one whose
+    mtime is unchanged keeps its row and its known subdirectories, and only
+    changed ones are rescanned.  The scans run level by level on a pool of
+    workers threads.  Listings use subfolder(), which checks only the
+    subfolder's own mtime.  Changes made through the connector are applied
+    with adjust(), moved() and removed() without any rescan, and others
+    reported through invalidate().  Hidden entries,
+    like the connector's own sidecars, aren't counted, and symlinked
+    directories aren't followed.
+    """
+
+    def __init__(self, filename, workers=8):
+        self.filename = filename
+        self.workers = workers
+        self._local = threading.local()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=10, isolation_level=None)
+            db.text_factory = str # Paths are byte strings, and needn't be UTF-8.
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS foldersize ('
+                       'path TEXT PRIMARY KEY, parent TEXT, mtime REAL, '
+                       'ownsize INTEGER, owncount INTEGER, size INTEGER, count INTEGER)')
+            db.execute('CREATE INDEX IF NOT EXISTS foldersize_parent ON foldersize (parent)')
+            self._local.db = db
+        return db
+
+    def _key(self, path):
+        return normalize_path(absolute_path(path))
+
+    def _ancestors(self, path):
+        while True:
+            yield path
+            parent = split_path(path)[0]
+            if parent == path:
+                return
+            path = parent
+
+    def _visit(self, path):
+        """Returns (path, mtime, ownsize, owncount, subdirectories, stored totals) for one directory, or None.
+
+        The stored totals are those of its row, if the row was still valid,
+        and otherwise None.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        db = self._db()
+        row = db.execute('SELECT mtime, ownsize, owncount, size, count FROM foldersize WHERE path = ?',
+                         (path,)).fetchone()
+        if row is not None and row[0] == st.st_mtime:
+            subdirs = [r[0] for r in db.execute('SELECT path FROM foldersize WHERE parent = ?', (path,))]
+            return path, st.st_mtime, row[1], row[2], subdirs, (row[3], row[4])
+        
+        size = count = 0
+        subdirs = []
+        for name, est in scan_directory(path, follow_symlinks=False):
+            if name[0]=='.':
+                continue
+            if stat.S_ISDIR(est.st_mode):
+                subdirs.append(join_path(path, name))
+            else:
+                size += est.st_size
+                count += 1
+        return path, st.st_mtime, size, count, subdirs, None
+
+    def get(self, path):
+        """Returns (size, file count) of everything under the directory at path, revalidating it first."""
+        root = self._key(path)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        
+        visited, level = {}, [root]
+        while level:
+            results = [r for r in self._pool.map(self._visit, level) if r is not None]
+            level = []
+            for result in results:
+                visited[result[0]] = result
+                level.extend(result[4])
+        if root not in visited:
+            return None
+        
+        totals = {}
+        for path in sorted(visited, key=lambda p: p.count('/'), reverse=True):
+            _, mtime, size, count, subdirs, stored = visited[path]
+            for subdir in subdirs:
+                if subdir in totals:
+                    size += totals[subdir][0]
+                    count += totals[subdir][1]
+            totals[path] = (size, count)
+        
+        db = self._db()
+        stale = [r[0] for r in db.execute('SELECT path FROM foldersize WHERE substr(path, 1, ?) = ?',
+                                          (len(root) + 1, root.rstrip('/') + '/'))
+                 if r[0] not in visited]
+        db.execute('BEGIN')
+        db.executemany('DELETE FROM foldersize WHERE path = ?', [(p,) for p in stale])
+        # Rows that were valid and whose totals haven't changed are left alone.
+        db.executemany('INSERT OR REPLACE INTO foldersize VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       [(p, split_path(p)[0], v[1], v[2], v[3]) + totals[p] for p, v in visited.items()
+                        if v[5] != totals[p]])
+        db.execute('COMMIT')
+        return totals[root]
+
+    def subfolder(self, path, st, rows):
+        """Returns (size, file count) of the subfolder at path, as listed with stat result st.
+
+        rows is cached(parent).  A row whose mtime matches st is trusted
+        without looking further down: changes below are applied by the
+        connector, or reported to invalidate(), which marks the ancestors
+        stale too.  Otherwise the subtree is revalidated with get().
+        Symlinked folders that have no row aren't followed; None is
+        returned for them.
+        """
+        row = rows.get(split_path(self._key(path))[1])
+        if row is not None and row[2] == st.st_mtime:
+            return row[0], row[1]
+        if row is None and os.path.islink(path.rstrip('/')):
+            return None
+        return self.get(path)
+
+    def cached(self, folder):
+        """Returns {name: (size, count, mtime)} for the known subdirectories of folder, without revalidating."""
+        rows = self._db().execute('SELECT path, size, count, mtime FROM foldersize WHERE parent = ?',
+                                  (self._key(folder),))
+        return dict((split_path(r[0])[1], (r[1], r[2], r[3])) for r in rows)
+
+    def adjust(self, folder, size, count):
+        """Records that files of size bytes (count of them) were added to folder, or removed if negative."""
+        folder = self._key(folder)
+        db = self._db()
+        db.execute('BEGIN')
+        db.execute('UPDATE foldersize SET ownsize = ownsize + ?, owncount = owncount + ? WHERE path = ?',
+                   (size, count, folder))
+        db.executemany('UPDATE foldersize SET size = size + ?, count = count + ? WHERE path = ?',
+                       [(size, count, p) for p in self._ancestors(folder)])
+        self._touch(db, folder)
+        db.execute('COMMIT')
+
+    def _touch(self, db, folder):
+        # The change was made by us, so the new mtime doesn't mean the row is stale.
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            return
+        db.execute('UPDATE foldersize SET mtime = ? WHERE path = ?', (mtime, folder))
+
+    def added(self, path):
+        """Records a new, empty directory."""
+        path = self._key(path)
+        parent = split_path(path)[0]
+        db = self._db()
+        db.execute('BEGIN')
+        if db.execute('SELECT 1 FROM foldersize WHERE path = ?', (parent,)).fetchone():
+            db.execute('INSERT OR REPLACE INTO foldersize VALUES (?, ?, ?, 0, 0, 0, 0)',
+                       (path, parent, os.stat(path).st_mtime))
+            self._touch(db, parent)
+        db.execute('COMMIT')
+
+    def removed(self, path):
+        """Records that the directory at path, and everything in it, is gone."""
+        path = self._key(path)
+        db = self._db()
+        row = db.execute('SELECT size, count FROM foldersize WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return
+        db.execute('BEGIN')
+        db.execute('DELETE FROM foldersize WHERE path = ? OR substr(path, 1, ?) = ?',
+                   (path, len(path) + 1, path + '/'))
+        parent = split_path(path)[0]
+        db.executemany('UPDATE foldersize SET size = size - ?, count = count - ? WHERE path = ?',
+                       [(row[0], row[1], p) for p in self._ancestors(parent)])
+        self._touch(db, parent)
+        db.execute('COMMIT')
+
+    def invalidate(self, folder):
+        """Forgets the scan of folder, so it's rescanned even if its mtime hasn't changed.
+
+        A file changed in place doesn't touch its directory's mtime; the
+        ChangeWatcher reports those through here.  The folders above it are
+        marked too, so that listings, which only check a subfolder's own
+        mtime, revalidate the subfolder it is in.
+        """
+        self._db().executemany('UPDATE foldersize SET mtime = NULL WHERE path = ?',
+                               [(p,) for p in self._ancestors(self._key(folder))])
+
+    def moved(self, old, new):
+        """Records that the directory old was renamed to new, within the same parent."""
+        old, new = self._key(old), self._key(new)
+        db = self._db()
+        db.execute('BEGIN')
+        db.execute('UPDATE foldersize SET path = ? || substr(path, ?), parent = ? || substr(parent, ?) '
+                   'WHERE path = ? OR substr(path, 1, ?) = ?',
+                   (new, len(old) + 1, new, len(old) + 1, old, len(old) + 1, old + '/'))
+        db.execute('UPDATE foldersize SET parent = ? WHERE path = ?', (split_path(new)[0], new))
+        self._touch(db, split_path(new)[0])
+        db.execute('COMMIT')
+
+
+class SearchIndex:
+
+    """Index of the names of everything under a folder, in a SQLite sidecar, for search().
+
+    Names are indexed lower-cased, with an index on the whole name for
+    prefix queries, on the extension, and on every three-character piece
+    of the name for substring queries, which only need to check the names
+    sharing all of the query's pieces.  update() brings folders up to date
+    by comparing their listing with the index; folders whose mtime hasn't
+    changed since their last update aren't listed again.  Changes made
+    through the connector are applied with added(), removed() and moved().
+    Hidden entries aren't indexed.
+    """
+
+    def __init__(self, filename, root, rescaninterval=3600):
+        self.filename = filename
+        self.root = normalize_path(absolute_path(root))
+        self.rescaninterval = rescaninterval
+        self.scanning = None
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=10, isolation_level=None)
+            db.text_factory = str
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS entry ('
+                       'id INTEGER PRIMARY KEY, path TEXT UNIQUE, parent TEXT, '
+                       'name TEXT, ext TEXT, isdir INTEGER, mtime REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS entry_parent ON entry (parent)')
+            db.execute('CREATE INDEX IF NOT EXISTS entry_name ON entry (name)')
+            db.execute('CREATE INDEX IF NOT EXISTS entry_ext ON entry (ext, path)')
+            db.execute('CREATE TABLE IF NOT EXISTS trigram (tri TEXT, id INTEGER, PRIMARY KEY (tri, id))')
+            db.execute('CREATE INDEX IF NOT EXISTS trigram_id ON trigram (id)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)')
+            self._local.db = db
+        return db
+
+    def _key(self, path):
+        return normalize_path(absolute_path(path))
+
+    def _trigrams(self, name):
+        return set(name[i:i + 3] for i in xrange(len(name) - 2))
+
+    def _insert(self, db, path, isdir):
+        name = split_path(path)[1].lower()
+        ext = split_ext(name)[1][1:] if not isdir else ''
+        cursor = db.execute('INSERT OR IGNORE INTO entry (path, parent, name, ext, isdir) VALUES (?, ?, ?, ?, ?)',
+                            (path, split_path(path)[0], name, ext, int(isdir)))
+        if cursor.rowcount:
+            db.executemany('INSERT OR IGNORE INTO trigram VALUES (?, ?)',
+                           [(tri, cursor.lastrowid) for tri in self._trigrams(name)])
+
+    def _delete(self, db, path):
+        ids = [(r[0],) for r in db.execute('SELECT id FROM entry WHERE path = ? OR substr(path, 1, ?) = ?',
+                                           (path, len(path) + 1, path + '/'))]
+        db.executemany('DELETE FROM trigram WHERE id = ?', ids)
+        db.executemany('DELETE FROM entry WHERE id = ?', ids)
+
+    def update(self, folder=None, recursive=False):
+        """Re-reads the folders that changed: folder, any new folders in it and, if recursive, all below it."""
+        db = self._db()
+        stack = [self._key(folder or self.root)]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            rows = db.execute('SELECT path, isdir FROM entry WHERE parent = ?', (path,)).fetchall()
+            row = db.execute('SELECT mtime FROM entry WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[0] == mtime:
+                if recursive:
+                    stack.extend(p for p, isdir in rows if isdir)
+                continue
+            
+            known = dict(rows)
+            found = {}
+            for name, st in scan_directory(path, follow_symlinks=False):
+                if name[0]!='.':
+                    found[join_path(path, name)] = int(stat.S_ISDIR(st.st_mode))
+            db.execute('BEGIN')
+            for child in known:
+                if found.get(child) != known[child]:
+                    self._delete(db, child)
+            for child, isdir in found.items():
+                if known.get(child) != isdir:
+                    self._insert(db, child, isdir)
+            self._insert(db, path, True)
+            db.execute('UPDATE entry SET mtime = ? WHERE path = ?', (mtime, path))
+            db.execute('COMMIT')
+            stack.extend(child for child, isdir in found.items()
+                         if isdir and (recursive or known.get(child) != isdir))
+
+    def rescan(self):
+        """Brings the whole index up to date in a background thread, at most every rescaninterval seconds."""
+        db = self._db()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        row = db.execute("SELECT value FROM meta WHERE key = 'scanned'").fetchone()
+        due = row is None or now - row[0] >= self.rescaninterval
+        if due:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('scanned', ?)", (now,))
+        db.execute('COMMIT')
+        if due:
+            self.scanning = threading.Thread(target=self.update, args=(self.root, True))
+            self.scanning.daemon = True
+            self.scanning.start()
+
+    def is_scanning(self):
+        return self.scanning is not None and self.scanning.is_alive()
+
+    def added(self, path):
+        """Records a new file or folder."""
+        path = self._key(path)
+        db = self._db()
+        db.execute('BEGIN')
+        self._insert(db, path, os.path.isdir(path))
+        db.execute('COMMIT')
+
+    def removed(self, path):
+        """Records that the file or folder at path, and anything in it, is gone."""
+        db = self._db()
+        db.execute('BEGIN')
+        self._delete(db, self._key(path))
+        db.execute('COMMIT')
+
+    def moved(self, old, new):
+        """Records that old was renamed to new, within the same folder."""
+        old, new = self._key(old), self._key(new)
+        db = self._db()
+        db.execute('BEGIN')
+        db.execute('DELETE FROM trigram WHERE id IN (SELECT id FROM entry WHERE path = ?)', (old,))
+        db.execute('DELETE FROM entry WHERE path = ?', (old,))
+        # Below the renamed folder only the paths change, not the names.
+        db.execute('UPDATE entry SET path = ? || substr(path, ?), parent = ? || substr(parent, ?) '
+                   'WHERE substr(path, 1, ?) = ?',
+                   (new, len(old) + 1, new, len(old) + 1, len(old) + 1, old + '/'))
+        self._insert(db, new, os.path.isdir(new))
+        db.execute('COMMIT')
+
+    def search(self, query, match='substring', folder=None, limit=100):
+        """Returns the paths, in order, of up to limit entries whose name matches query.
+
+        match is 'substring' (the name contains query), 'prefix' (the name
+        starts with it) or 'extension'.  Matching ignores ASCII case.  With
+        folder, only entries below it are returned.
+        """
+        query = query.lower()
+        if match == 'extension':
+            where, args = 'ext = ?', [query.lstrip('.')]
+        elif match == 'prefix':
+            where, args = 'name >= ? AND name < ?', [query, query + '\xff']
+        else:
+            # Intersecting a few of the pieces narrows it down enough for
+            # instr() to check the rest.
+            tris = sorted(self._trigrams(query))[:8]
+            where = 'instr(name, ?) > 0'
+            args = [query]
+            if tris:
+                where += ' AND id IN (%s)' % ' INTERSECT '.join(['SELECT id FROM trigram WHERE tri = ?'] * len(tris))
+                args += tris
+        folder = self._key(folder or self.root).rstrip('/') + '/'
+        where += ' AND substr(path, 1, ?) = ?'
+        args += [len(folder), folder]
+        return [r[0] for r in self._db().execute(
+            'SELECT path FROM entry WHERE %s ORDER BY path LIMIT ?' % where, args + [limit])]
+
+
+class ChangeWatcher:
+
+    """Watches a directory tree with Linux inotify and keeps a log of the folders that changed.
+
+    A daemon thread reads the events; every change to a visible entry
+    records its folder under a new sequence number and is passed to the
+    listeners, which the Filemanager uses to invalidate its caches; their
+    errors are written to stderr.
+    changes() returns the folders changed after a token, waiting for one
+    if there are none yet, so clients can long-poll instead of re-reading
+    every folder.  Only the last maxlog changes are kept; older tokens,
+    tokens from another process and a kernel queue overflow all make
+    changes() ask for a full reload.  Raises EnvironmentError where
+    inotify isn't available.
+    """
+
+    IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x4, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF = 0x100, 0x200, 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = 0x4000, 0x8000, 0x1000000, 0x40000000
+    IN_CLOEXEC = 0x80000
+    
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    event = struct.Struct('iIII')
+
+    def __init__(self, root, maxlog=10000):
+        self.root = normalize_path(absolute_path(root))
+        self.instance = encodeURLsafeBase64(os.urandom(6))
+        self.listeners = []
+        self.log = deque(maxlen=maxlog)
+        self.seq = self.floor = 0
+        self.changed = threading.Condition()
+        self.watches = {}
+        
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise EnvironmentError(errno.ENOSYS, 'inotify is not available.')
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise EnvironmentError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._watchtree(self.root)
+        
+        # Closing the inotify descriptor doesn't wake a blocked read, so
+        # close() writes to this pipe instead.
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Stops the watcher thread and releases the inotify descriptor."""
+        if self.thread.is_alive():
+            os.write(self.wakeup[1], 'x')
+            self.thread.join()
+            for fd in (self.fd,) + self.wakeup:
+                os.close(fd)
+
+    def _watchtree(self, top):
+        for path, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if d[0]!='.']
+            wd = self.libc.inotify_add_watch(self.fd, path, self.mask)
+            if wd >= 0:
+                self.watches[wd] = path
+
+    def _unwatchtree(self, top):
+        for wd, path in self.watches.items():
+            if path == top or path.startswith(top + '/'):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def _run(self):
+        size = self.event.size
+        while True:
+            try:
+                ready = select.select([self.fd, self.wakeup[0]], [], [])[0]
+                if self.wakeup[0] in ready:
+                    return
+                data = os.read(self.fd, 65536)
+            except (OSError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            folders, pos = set(), 0
+            while pos < len(data):
+                wd, mask, cookie, length = self.event.unpack_from(data, pos)
+                name = data[pos + size:pos + size + length].rstrip('\0')
+                pos += size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    self._reset()
+                    continue
+                folder = self.watches.get(wd)
+                if folder is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    folders.add(folder)
+                    continue
+                if not name or name[0]=='.':
+                    continue
+                path = join_path(folder, name)
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self._watchtree(path)
+                        folders.update(p for p in self.watches.values()
+                                       if p == path or p.startswith(path + '/'))
+                    elif mask & self.IN_MOVED_FROM:
+                        self._unwatchtree(path)
+                folders.add(folder)
+            if folders:
+                self._record(folders)
+
+    def _record(self, folders):
+        with self.changed:
+            for folder in folders:
+                self.seq += 1
+                self.log.append((self.seq, folder))
+            if len(self.log) == self.log.maxlen:
+                self.floor = self.log[0][0] - 1
+            self.changed.notifyAll()
+        for folder in folders:
+            for listener in self.listeners:
+                # A listener's failure (a locked cache, a folder gone
+                # since) mustn't stop the thread, and with it the log.
+                try:
+                    listener(folder)
+                except Exception:
+                    sys.stderr.write('filemanager: change listener failed for %s:\n%s'
+                                     % (folder, traceback.format_exc()))
+
+    def _reset(self):
+        with self.changed:
+            self.seq += 1
+            self.floor = self.seq
+            self.log.clear()
+            self.changed.notifyAll()
+
+    def token(self, seq=None):
+        return '%s-%d' % (self.instance, self.seq if seq is None else seq)
+
+    def changes(self, token=None, timeout=0):
+        """Returns (token, folders) for the changes after token, or (token, None) for a full reload.
+
+        Waits up to timeout seconds for a change if there's none yet.
+        """
+        instance, _, seq = (token or '').rpartition('-')
+        with self.changed:
+            if instance != self.instance or not seq.isdigit() or int(seq) < self.floor:
+                return self.token(), None
+            seq = int(seq)
+            deadline = time.time() + timeout
+            while self.seq <= seq and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+            if seq < self.floor:
+                return self.token(), None
+            folders = set(folder for n, folder in self.log if n > seq)
+            return self.token(), folders
+
+
+def http_date(timestamp):
+    """Formats a timestamp for Last-Modified and similar headers."""
+    return formatdate(timestamp, usegmt=True)
+
+
+def is_not_modified(req, etag, mtime):
+    """Returns True if the request's validators show the client's copy is current.
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 7232.
+    """
+    match = req.headers_in.get('If-None-Match')
+    if match is not None:
+        tags = [t.strip() for t in match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    since = req.headers_in.get('If-Modified-Since')
+    if since is not None:
+        parsed = parsedate_tz(since)
+        return parsed is not None and int(mtime) <= mktime_tz(parsed)
+    return False
+
+
+
+def file_etag(st):
+    """Returns a strong ETag for the file with stat result st."""
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+
+def parse_range(header, size, maxranges=16):
+    """Parses a Range header against a resource of size bytes.
+
+    Returns None if the header is absent or not a byte range (so the whole
+    resource should be sent), or a sorted list of inclusive (first, last)
+    pairs with overlapping and adjacent ranges merged.  An empty list means
+    no range is satisfiable.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        first, sep, last = spec.strip().partition('-')
+        try:
+            if not sep:
+                return None
+            if not first:
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                first, last = max(0, size - suffix), size - 1
+            else:
+                first = int(first)
+                last = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if first <= last and first < size:
+            ranges.append((first, last))
+    
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    if len(merged) > maxranges:
+        return None # Not worth honouring; send the whole file instead.
+    return merged
+
+
+def if_range_matches(req, etag, mtime):
+    """Returns True unless an If-Range header says the client's partial copy is stale."""
+    condition = req.headers_in.get('If-Range')
+    if condition is None:
+        return True
+    if condition.startswith('"'):
+        return condition == etag
+    parsed = parsedate_tz(condition)
+    return parsed is not None and int(mtime) == mktime_tz(parsed)
+
+
+def thumbnail_key(st, size):
+    """Returns the cache key for a thumbnail of the file with stat result st.
+
+    The key covers the file's identity, mtime and size, so a changed image
+    gets a new key and its thumbnail is regenerated.
+    """
+    return hashlib.sha1('%d:%d:%r:%d:%dx%d' % ((st.st_dev, st.st_ino, st.st_mtime, st.st_size) + tuple(size))).hexdigest()
+
+
+def make_thumbnail(source, target, size):
+    """Writes a JPEG thumbnail of the image at source to target, atomically."""
+    global Image
+    if Image is None:
+        from PIL import Image
+    img = Image.open(source)
+    img.thumbnail(size, Image.ANTIALIAS)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    directory = split_path(target)[0]
+    if not path_exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass # Created concurrently.
+    tmp = '%s.%d.tmp' % (target, os.getpid())
+    img.save(tmp, 'JPEG', quality=85)
+    os.rename(tmp, target)
+
+
+def warm_thumbnail(directory, source, size):
+    """Makes sure the thumbnail for source exists; run in the thumbnail pool."""
+    try:
+        target = join_path(directory, *thumbnail_path(thumbnail_key(os.stat(source), size)))
+        if not path_exists(target):
+            make_thumbnail(source, target, size)
+    except Exception:
+        pass # The thumbnail will be retried, and the error reported, when it's requested.
+    return source
+
+
+def thumbnail_path(key):
+    return key[:2], key + '.jpg'
+
+
+class ThumbnailCache:
+
+    """On-disk cache of JPEG thumbnails.
+
+    Thumbnails are stored under directory by thumbnail_key, so each is made
+    once per version of its source image.  warm() generates thumbnails for
+    a whole folder in the background on a process pool of at most workers
+    processes.
+    """
+
+    def __init__(self, directory, size=(64, 64), workers=2):
+        self.directory = directory
+        self.size = size
+        self.workers = workers
+        self._pool = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def get(self, path, st):
+        """Returns (key, filename) of the thumbnail for path, making it now if needed.
+
+        filename is None if the image can't be thumbnailed.
+        """
+        key = thumbnail_key(st, self.size)
+        target = join_path(self.directory, *thumbnail_path(key))
+        if not path_exists(target):
+            try:
+                make_thumbnail(path, target, self.size)
+            except (IOError, OSError, ImportError):
+                return key, None
+        return key, target
+
+    def warm(self, paths):
+        """Queues thumbnail generation for paths on the pool without waiting for it."""
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.workers)
+            paths = [p for p in paths if p not in self._pending]
+            self._pending.update(paths)
+        for path in paths:
+            self._pool.apply_async(warm_thumbnail, (self.directory, path, self.size),
+                                   callback=self._pending.discard)
+
+
+
+class MultipartReader:
+
+    """Incremental parser for a multipart/form-data request body.
+
+    The body is pulled from read(size) at most chunksize bytes at a time,
+    and never past length bytes, so a part of any size passes through in
+    bounded memory.  parts() yields (name, filename, chunks) for each part,
+    where chunks is an iterator over the part's data that must be consumed
+    (or abandoned via the next iteration of parts) in order.
+    """
+
+    maxheader = 16384
+
+    def __init__(self, read, boundary, length, chunksize=65536):
+        self._read = read
+        self.remaining = length
+        self.chunksize = chunksize
+        self.delimiter = '\r\n--' + boundary
+        # The first boundary isn't preceded by a line break; pretend it is.
+        self.buf = '\r\n'
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        data = self._read(min(self.chunksize, self.remaining))
+        if not data:
+            self.remaining = 0
+            return False
+        self.remaining -= len(data)
+        self.buf += data
+        return True
+
+    def _chunks(self):
+        """Yields data up to the next delimiter, and consumes the delimiter."""
+        delimiter = self.delimiter
+        while True:
+            index = self.buf.find(delimiter)
+            if index >= 0:
+                if index:
+                    yield self.buf[:index]
+                self.buf = self.buf[index + len(delimiter):]
+                return
+            keep = len(delimiter) - 1
+            if len(self.buf) > keep:
+                yield self.buf[:-keep]
+                self.buf = self.buf[-keep:]
+            if not self._fill():
+                raise ValueError('Truncated multipart body.')
+
+    def parts(self):
+        for _ in self._chunks():
+            pass # Preamble.
+        while True:
+            while len(self.buf) < 2 and self._fill():
+                pass
+            if self.buf.startswith('--'):
+                return
+            while '\r\n\r\n' not in self.buf:
+                if len(self.buf) > self.maxheader or not self._fill():
+                    raise ValueError('Malformed multipart headers.')
+            head, self.buf = self.buf.split('\r\n\r\n', 1)
+            headers = {}
+            for line in head.split('\r\n')[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            disposition, params = parse_header(headers.get('content-disposition', ''))
+            chunks = self._chunks()
+            yield params.get('name'), params.get('filename'), chunks
+            for _ in chunks:
+                pass # Skip whatever the caller didn't read.
+
+
+def upload_filename(name):
+    """Turns a client-supplied filename into a safe name in the target folder."""
+    name = name.replace('\\', '/').split('/')[-1].lstrip('.')
+    return encode_urlpath(name)
+
+
+@contextmanager
+def atomic_upload(folder, name, prefix='.upload-', commit=None):
+    """Context manager giving a hidden temporary file in folder to write an upload to.
+
+    On success the file is flushed, fsync-ed and renamed to name, so a
+    partial upload is never visible under its final name; commit, if
+    given, is called with the temporary file and the target to do the
+    renaming instead of commit_upload.  On failure the temporary file is
+    removed.  Raises EnvironmentError if name exists.
+    """
+    target = join_path(folder, name)
+    fd, tmp = tempfile.mkstemp(prefix=prefix, dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        (commit or commit_upload)(tmp, target)
+    except:
+        if path_exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def commit_upload(tmp, target):
+    """Moves a completed upload into place without replacing an existing file."""
+    try:
+        os.link(tmp, target)
+    except OSError, e:
+        if e.errno == errno.EEXIST:
+            raise EnvironmentError(errno.EEXIST, 'File already exists.')
+        # Hard links not supported here: fall back to a checked rename.
+        if path_exists(target):
+            raise EnvironmentError(errno.EEXIST, 'File already exists.')
+        os.rename(tmp, target)
+    else:
+        os.remove(tmp)
+
+
+class BlobStore:
+
+    """Content-addressed store that deduplicates uploads with hard links.
+
+    Each stored upload is also linked into directory under its SHA-256, so
+    a later upload of the same content becomes another hard link to that
+    copy rather than a new one.  The stored copy's link count is its
+    reference count: when deleting a file leaves the store with the only
+    link, release() removes it.  The connector only ever replaces files,
+    never rewrites them, so the links can't diverge; other tools writing
+    into fileroot must do the same.  The digest of each stored copy is
+    indexed by inode in a SQLite file in directory.  Where hard links
+    aren't supported uploads are simply stored as they are.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            db = sqlite3.connect(join_path(self.directory, 'index.sqlite'), timeout=10, isolation_level=None)
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS blob ('
+                       'digest TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER)')
+            db.execute('CREATE INDEX IF NOT EXISTS blob_inode ON blob (dev, ino)')
+            self._local.db = db
+        return db
+
+    def path(self, digest):
+        return join_path(self.directory, digest[:2], digest)
+
+    def digest(self, path):
+        """Returns the SHA-256 of the file at path, in hex."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(262144), ''):
+                digest.update(data)
+        return digest.hexdigest()
+
+    def commit(self, tmp, target, digest):
+        """Moves the upload at tmp, with SHA-256 digest, to target as commit_upload would.
+
+        Returns True if the content was already stored, and target became
+        a link to it.
+        """
+        blob = self.path(digest)
+        for attempt in (0, 1):
+            try:
+                os.link(blob, target)
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    raise EnvironmentError(errno.EEXIST, 'File already exists.')
+                if e.errno != errno.ENOENT:
+                    break # No hard links here.
+            else:
+                os.remove(tmp)
+                return True
+            
+            try:
+                if not os.path.isdir(split_path(blob)[0]):
+                    os.makedirs(split_path(blob)[0])
+                os.link(tmp, blob)
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    continue # Stored by a concurrent upload meanwhile.
+                break
+            st = os.stat(blob)
+            self._db().execute('INSERT OR REPLACE INTO blob VALUES (?, ?, ?, ?)',
+                               (digest, st.st_dev, st.st_ino, st.st_size))
+            try:
+                commit_upload(tmp, target)
+            except EnvironmentError:
+                self.release(st)
+                raise
+            return False
+        
+        commit_upload(tmp, target)
+        return False
+
+    def release(self, st):
+        """Removes the stored copy of a deleted file, with stat result st, if nothing else links to it."""
+        if st.st_nlink > 2:
+            return
+        db = self._db()
+        row = db.execute('SELECT digest FROM blob WHERE dev = ? AND ino = ?', (st.st_dev, st.st_ino)).fetchone()
+        if row is None:
+            return
+        blob = self.path(row[0])
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except OSError:
+            pass
+        if not path_exists(blob):
+            db.execute('DELETE FROM blob WHERE digest = ?', row)
+
+    def collect(self):
+        """Removes stored copies that are no longer linked from anywhere, e.g. after files were deleted outside the connector."""
+        db = self._db()
+        for digest, in db.execute('SELECT digest FROM blob').fetchall():
+            try:
+                st = os.stat(self.path(digest))
+            except OSError:
+                db.execute('DELETE FROM blob WHERE digest = ?', (digest,))
+                continue
+            self.release(st)
+
+    def stats(self):
+        """Returns the number of stored copies, their total size and the total size of the files linking to them."""
+        blobs = stored = referenced = 0
+        for digest, size in self._db().execute('SELECT digest, size FROM blob').fetchall():
+            try:
+                links = os.stat(self.path(digest)).st_nlink - 1
+            except OSError:
+                continue
+            blobs += 1
+            stored += size
+            referenced += size * links
+        return {'blobs' : blobs, 'stored' : stored, 'referenced' : referenced}
+
+
+def tree_usage(path):
+    """Returns (bytes, files) of the regular files under path, skipping hidden entries and symlinks."""
+    size = count = 0
+    stack = [path]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = list(scan_directory(folder, follow_symlinks=False))
+        except OSError:
+            continue
+        for name, st in entries:
+            if name[0] == '.':
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(join_path(folder, name))
+            elif stat.S_ISREG(st.st_mode):
+                size += st.st_size
+                count += 1
+    return size, count
+
+
+class UsageLedger:
+
+    """Bytes and files used under a root, kept in a SQLite sidecar for quotas.
+
+    The root has one row, so usage() and the quota check for an upload are
+    one indexed read however big the tree is.  An upload reserve()s its
+    announced size before its body is read, which fails if the root would
+    go over quota, and settle()s the reservation with its actual size once
+    stored; deletions are applied with adjust().  Each of these is a
+    single UPDATE, so concurrent uploads can't overshoot together.
+    reconcile() recounts the tree on a pool of workers threads and drops
+    reservations left behind by interrupted uploads; usage() runs it the
+    first time.  Hidden entries aren't counted, as in FolderSizes.
+    """
+
+    def __init__(self, filename, root, quota=None, filequota=None, workers=8):
+        self.filename = filename
+        self.root = normalize_path(absolute_path(root))
+        self.quota = quota
+        self.filequota = filequota
+        self.workers = workers
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.filename, timeout=10, isolation_level=None)
+            db.text_factory = str
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS usage ('
+                       'root TEXT PRIMARY KEY, bytes INTEGER, files INTEGER, '
+                       'reserved INTEGER, reservedfiles INTEGER, reconciled REAL)')
+            self._local.db = db
+        return db
+
+    def usage(self):
+        """Returns (bytes, files, bytes reserved by uploads in progress)."""
+        row = self._db().execute('SELECT bytes, files, reserved FROM usage WHERE root = ?', (self.root,)).fetchone()
+        if row is None:
+            self.reconcile()
+            return self.usage()
+        return row
+
+    def reserve(self, size, files=1):
+        """Sets aside size bytes and files for an upload.
+
+        Raises EnvironmentError (EDQUOT) if they would take the root over
+        its quota.
+        """
+        if self.quota is None and self.filequota is None:
+            return
+        self.usage() # Makes sure the row exists.
+        cursor = self._db().execute(
+            'UPDATE usage SET reserved = reserved + ?, reservedfiles = reservedfiles + ? WHERE root = ? '
+            'AND (? IS NULL OR bytes + reserved + ? <= ?) AND (? IS NULL OR files + reservedfiles + ? <= ?)',
+            (size, files, self.root, self.quota, size, self.quota, self.filequota, files, self.filequota))
+        if cursor.rowcount != 1:
+            raise EnvironmentError(errno.EDQUOT, 'Quota exceeded.')
+
+    def settle(self, reserved, reservedfiles=1, size=0, files=0):
+        """Replaces a reservation with the size and files actually stored (none if the upload failed)."""
+        if self.quota is not None or self.filequota is not None:
+            self._db().execute(
+                'UPDATE usage SET bytes = bytes + ?, files = files + ?, '
+                'reserved = MAX(0, reserved - ?), reservedfiles = MAX(0, reservedfiles - ?) WHERE root = ?',
+                (size, files, reserved, reservedfiles, self.root))
+        else:
+            self.adjust(size, files)
+
+    def adjust(self, size, files):
+        self._db().execute('UPDATE usage SET bytes = bytes + ?, files = files + ? WHERE root = ?',
+                           (size, files, self.root))
+
+    def reconcile(self):
+        """Recounts the tree, scanning each top-level folder on its own thread, and replaces the row.
+
+        Changes made while the scan runs may be missed or counted twice;
+        run it when the root is quiet, e.g. from cron.
+        """
+        size = count = 0
+        folders = []
+        for name, st in scan_directory(self.root, follow_symlinks=False):
+            if name[0] == '.':
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                folders.append(join_path(self.root, name))
+            elif stat.S_ISREG(st.st_mode):
+                size += st.st_size
+                count += 1
+        pool = ThreadPool(max(1, min(self.workers, len(folders))))
+        try:
+            for folder_size, folder_count in pool.imap_unordered(tree_usage, folders):
+                size += folder_size
+                count += folder_count
+        finally:
+            pool.close()
+        self._db().execute('INSERT OR REPLACE INTO usage VALUES (?, ?, ?, 0, 0, ?)',
+                           (self.root, size, count, time.time()))
+
+
+valid_upload_id = re.compile(r'^[A-Za-z0-9_-]{8,64}$').match
+
+
+
+class ZipStream:
+
+    """Writes a zip archive to write() in one pass, without seeking.
+
+    Each member's CRC and sizes follow its data in a data descriptor, so
+    files are read once, a chunk at a time, and only the central directory
+    records are kept until close().  Members and archives over 4 GB, or
+    over 65535 members, get ZIP64 records.  Files are read with opener,
+    a storage's open.
+    """
+
+    def __init__(self, write, level=6, chunksize=262144, opener=None):
+        self._write = write
+        self.opener = opener or LocalStorage().open
+        self.level = level
+        self.chunksize = chunksize
+        self.offset = 0
+        self.entries = []
+
+    def write(self, data):
+        self._write(data)
+        self.offset += len(data)
+
+    def _dostime(self, mtime):
+        t = time.localtime(max(mtime, 315532800)) # Zip dates start in 1980.
+        return ((t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+                t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2)
+
+    def add(self, name, st, path=None, compress=True):
+        """Adds the file at path, or a folder if path is None, as name, with stat result st."""
+        isdir = path is None
+        if isdir:
+            name = name.rstrip('/') + '/'
+        method = 8 if compress and not isdir else 0
+        zip64 = st.st_size >= 0xFFFF0000 and not isdir
+        flags = 0x08 | (0x800 if re.search(r'[\x80-\xff]', name) else 0) # Data descriptor, UTF-8 name.
+        date, dostime = self._dostime(st.st_mtime)
+        offset = self.offset
+        
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else ''
+        self.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags, method,
+                               dostime, date, 0, 0xFFFFFFFF if zip64 else 0, 0xFFFFFFFF if zip64 else 0,
+                               len(name), len(extra)) + name + extra)
+        
+        crc = usize = csize = 0
+        if not isdir:
+            deflate = zlib.compressobj(self.level, zlib.DEFLATED, -15) if method else None
+            with closing(self.opener(path)) as f:
+                while True:
+                    data = f.read(self.chunksize)
+                    if not data:
+                        break
+                    crc = zlib.crc32(data, crc)
+                    usize += len(data)
+                    if deflate is not None:
+                        data = deflate.compress(data)
+                    csize += len(data)
+                    self.write(data)
+            if deflate is not None:
+                data = deflate.flush()
+                csize += len(data)
+                self.write(data)
+        crc &= 0xFFFFFFFF
+        
+        if zip64:
+            self.write(struct.pack('<IIQQ', 0x08074b50, crc, csize, usize))
+        else:
+            self.write(struct.pack('<IIII', 0x08074b50, crc, csize, usize))
+        mode = (st.st_mode & 0xFFFF) << 16 | (0x10 if isdir else 0)
+        self.entries.append((name, flags, method, dostime, date, crc, csize, usize, offset, mode))
+
+    def close(self):
+        """Writes the central directory."""
+        start = self.offset
+        for name, flags, method, dostime, date, crc, csize, usize, offset, mode in self.entries:
+            big = [v for v in (usize, csize, offset) if v >= 0xFFFFFFFF]
+            extra = struct.pack('<HH', 1, 8 * len(big)) + struct.pack('<%dQ' % len(big), *big) if big else ''
+            clamp = lambda v: 0xFFFFFFFF if v >= 0xFFFFFFFF else v
+            self.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | 45, 45 if big else 20,
+                                   flags, method, dostime, date, crc, clamp(csize), clamp(usize),
+                                   len(name), len(extra), 0, 0, 0, mode, clamp(offset)) + name + extra)
+        count, size = len(self.entries), self.offset - start
+        
+        if count >= 0xFFFF or size >= 0xFFFFFFFF or start >= 0xFFFFFFFF:
+            end64 = self.offset
+            self.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 3 << 8 | 45, 45, 0, 0,
+                                   count, count, size, start))
+            self.write(struct.pack('<IIQI', 0x07064b50, 0, end64, 1))
+            count, size, start = 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF
+        self.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, start, 0))
+
+
+class WriteAdapter:
+
+    """A file-like object whose writes go to a write function, for tarfile's stream mode."""
+
+    def __init__(self, write):
+        self.write = write
+
+
+def archive_members(paths, storage=None):
+    """Yields (name in archive, path, stat result) for paths and everything in the folders among them.
+
+    Names are relative to each path's parent folder.  Hidden entries and
+    anything that isn't a regular file or folder, such as symlinks that
+    could lead outside fileroot, are left out.
+    """
+    storage = storage or LocalStorage()
+    for top in paths:
+        top = top.rstrip('/')
+        base = len(split_path(top)[0].rstrip('/')) + 1
+        try:
+            st = storage.stat(top, follow_symlinks=False)
+        except EnvironmentError:
+            continue
+        stack = [(top, st)]
+        while stack:
+            path, st = stack.pop()
+            if stat.S_ISREG(st.st_mode):
+                yield path[base:], path, st
+            elif stat.S_ISDIR(st.st_mode):
+                yield path[base:], path, st
+                entries = sorted(storage.list(path, follow_symlinks=False), reverse=True)
+                stack.extend((join_path(path, name), est) for name, est in entries if name[0]!='.')
+
+
+class Metrics:
+
+    """Request counts, latency histograms and per-request counters by mode.
+
+    A request's counters are collected with add() between start() and
+    finish(), on the thread handling it; work it hands to other threads
+    is counted with collect().  render() gives everything in the
+    Prometheus text format.  The numbers are per process: under a prefork
+    Apache each child keeps and reports its own.
+    """
+
+    buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+    
+    # Counter name: help text.
+    counters = {
+        'requests' : 'Requests handled.',
+        'errors' : 'Requests that failed with an exception.',
+        'bytes' : 'Response body bytes written.',
+        'entries' : 'Entries listed by getfolder, search and multigetinfo.',
+        'image_seconds' : 'Time spent reading image sizes and making thumbnails.',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.totals = {}
+        self.local = threading.local()
+
+    def start(self):
+        self.local.counts = {}
+
+    def add(self, name, value):
+        counts = getattr(self.local, 'counts', None)
+        if counts is not None:
+            counts[name] = counts.get(name, 0) + value
+
+    def collect(self, fn, *args):
+        """Returns fn(*args) and the counters it added, for a thread working for another's request."""
+        self.start()
+        try:
+            return fn(*args), self.local.counts
+        finally:
+            self.local.counts = None
+
+    def finish(self, mode, seconds, error=False):
+        counts = getattr(self.local, 'counts', None) or {}
+        self.local.counts = None
+        counts['requests'] = 1
+        if error:
+            counts['errors'] = 1
+        with self.lock:
+            histogram = self.durations.setdefault(mode, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            for name, value in counts.items():
+                self.totals[name, mode] = self.totals.get((name, mode), 0) + value
+
+    def render(self, extra=()):
+        """Returns the metrics as Prometheus text; extra adds (name, help, value) counters."""
+        lines = ['# HELP filemanager_request_duration_seconds Time to handle a request.',
+                 '# TYPE filemanager_request_duration_seconds histogram']
+        with self.lock:
+            for mode, histogram in sorted(self.durations.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append('filemanager_request_duration_seconds_bucket{mode="%s",le="%g"} %d' % (mode, bound, count))
+                lines.append('filemanager_request_duration_seconds_bucket{mode="%s",le="+Inf"} %d' % (mode, histogram[-1]))
+                lines.append('filemanager_request_duration_seconds_sum{mode="%s"} %r' % (mode, histogram[-2]))
+                lines.append('filemanager_request_duration_seconds_count{mode="%s"} %d' % (mode, histogram[-1]))
+            for name, description in sorted(self.counters.items()):
+                lines.append('# HELP filemanager_%s_total %s' % (name, description))
+                lines.append('# TYPE filemanager_%s_total counter' % name)
+                for (counter, mode), value in sorted(self.totals.items()):
+                    if counter == name:
+                        lines.append('filemanager_%s_total{mode="%s"} %r' % (name, mode, value))
+        for name, description, value in extra:
+            lines.append('# HELP filemanager_%s_total %s' % (name, description))
+            lines.append('# TYPE filemanager_%s_total counter' % name)
+            lines.append('filemanager_%s_total %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MeteredRequest:
+
+    """Wraps a request so that the bytes written through it are added to metrics."""
+
+    def __init__(self, req, metrics):
+        self.__dict__.update(_req=req, _metrics=metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._req, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._req, name, value)
+
+    def write(self, data, flush=1):
+        self._metrics.add('bytes', len(data))
+        self._req.write(data, flush)
+
+    def sendfile(self, path, offset=0, length=-1):
+        self._metrics.add('bytes', length if length >= 0 else os.path.getsize(path) - offset)
+        self._req.sendfile(path, offset, length)
+
+
+def make_stat(isdir, size=0, mtime=0.0, ino=0):
+    """Returns an os.stat_result for a file or folder of storage that has no real ones."""
+    mode = stat.S_IFDIR | 0755 if isdir else stat.S_IFREG | 0644
+    return os.stat_result((mode, ino, 0, 1, 0, 0, size, mtime, mtime, mtime))
+
+
+class Storage:
+
+    """Where a Filemanager's files are kept.
+
+    Paths are the absolute paths the client sees, under the Filemanager's
+    fileroot; folders may be given with or without a trailing slash.
+    Drivers report missing files and refused operations as EnvironmentError
+    with the errno os would use, and stat results as os.stat_result.
+    local is True only for LocalStorage, whose paths are real files: the
+    caches and indexes kept in the root as SQLite files, thumbnails, change
+    notification, deduplication, usage accounting and resumable uploads
+    need it, and are off with other drivers.
+    """
+
+    local = False
+
+    def stat(self, path, follow_symlinks=True):
+        raise NotImplementedError
+
+    def list(self, path, follow_symlinks=True):
+        """Yields (name, stat result) for the entries of the folder at path."""
+        raise NotImplementedError
+
+    def names(self, path):
+        """Yields the names of the entries of the folder at path, where that's cheaper than list."""
+        for name, st in self.list(path):
+            yield name
+
+    def open(self, path):
+        """Returns a file object to read the file at path from."""
+        raise NotImplementedError
+
+    def create(self, folder, name):
+        """Context manager giving a file to write a new file name in folder to.
+
+        The file appears only when the block completes, and never replaces
+        an existing one: that raises EnvironmentError(EEXIST).
+        """
+        raise NotImplementedError
+
+    def mkdir(self, path):
+        raise NotImplementedError
+
+    def rename(self, old, new):
+        """Renames or moves the file or folder old to new, which mustn't exist."""
+        raise NotImplementedError
+
+    def remove(self, path):
+        raise NotImplementedError
+
+    def rmdir(self, path):
+        """Removes the empty folder at path; raises EnvironmentError(ENOTEMPTY) if it isn't."""
+        raise NotImplementedError
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except EnvironmentError:
+            return False
+        return True
+
+    def isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except EnvironmentError:
+            return False
+
+    def chunks(self, path, offset=0, length=-1, chunksize=262144):
+        """Yields length bytes (or the rest) of the file at path from offset, a chunk at a time."""
+        with closing(self.open(path)) as f:
+            f.seek(offset)
+            while length != 0:
+                data = f.read(chunksize if length < 0 else min(length, chunksize))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+
+    def sendfile(self, req, path, offset=0, length=-1):
+        """Sends length bytes (or the rest) of the file at path from offset as the response body."""
+        for data in self.chunks(path, offset, length):
+            req.write(data)
+
+
+class LocalStorage(Storage):
+
+    """Files on a local, or mounted, filesystem."""
+
+    local = True
+
+    def stat(self, path, follow_symlinks=True):
+        return os.stat(path) if follow_symlinks else os.lstat(path)
+
+    def list(self, path, follow_symlinks=True):
+        return scan_directory(path, follow_symlinks)
+
+    def names(self, path):
+        return iter_names(path)
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def create(self, folder, name):
+        return atomic_upload(folder, name)
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def rename(self, old, new):
+        if path_exists(new):
+            raise OSError(errno.EEXIST, 'There is already a file or folder with that name.')
+        os.rename(old, new)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def chunks(self, path, offset=0, length=-1, chunksize=262144):
+        return FileRange(path, offset, length, chunksize)
+
+    def sendfile(self, req, path, offset=0, length=-1):
+        req.sendfile(path, offset, length)
+
+
+class MemoryStorage(Storage):
+
+    """Files kept in a dict, for tests and benchmarks that shouldn't touch the disk.
+
+    Nothing is persisted, and each process has its own copy; root and the
+    folders above it are created empty.
+    """
+
+    def __init__(self, root='/'):
+        self.lock = threading.Lock()
+        self.inodes = itertools.count(1)
+        # path: [contents, or None for a folder, mtime, inode number]
+        self.nodes = {}
+        # folder path: set of the names in it
+        self.children = {}
+        path = '/'
+        for part in [''] + normalize_path(root).strip('/').split('/'):
+            path = join_path(path, part)
+            if path not in self.nodes:
+                self._add(path, None)
+
+    def _add(self, path, data):
+        self.nodes[path] = [data, time.time(), self.inodes.next()]
+        if data is None:
+            self.children[path] = set()
+        folder, name = split_path(path)
+        if name:
+            self.children[folder].add(name)
+            self.nodes[folder][1] = time.time()
+
+    def _node(self, path):
+        node = self.nodes.get(path)
+        if node is None:
+            raise OSError(errno.ENOENT, 'No such file or directory', path)
+        return node
+
+    def _stat(self, node):
+        data, mtime, ino = node
+        return make_stat(data is None, len(data or ''), mtime, ino)
+
+    def stat(self, path, follow_symlinks=True):
+        with self.lock:
+            return self._stat(self._node(normalize_path(path)))
+
+    def list(self, path, follow_symlinks=True):
+        path = normalize_path(path)
+        with self.lock:
+            names = self.children.get(path)
+            if names is None:
+                self._node(path)
+                raise OSError(errno.ENOTDIR, 'Not a directory', path)
+            entries = [(name, self._stat(self.nodes[join_path(path, name)])) for name in names]
+        return iter(entries)
+
+    def open(self, path):
+        with self.lock:
+            data = self._node(normalize_path(path))[0]
+        if data is None:
+            raise IOError(errno.EISDIR, 'Is a directory', path)
+        return cStringIO.StringIO(data)
+
+    @contextmanager
+    def create(self, folder, name):
+        folder = normalize_path(folder)
+        if not self.isdir(folder):
+            raise OSError(errno.ENOENT, 'No such file or directory', folder)
+        f = cStringIO.StringIO()
+        yield f
+        path = join_path(folder, name)
+        with self.lock:
+            if path in self.nodes:
+                raise EnvironmentError(errno.EEXIST, 'File already exists.')
+            self._add(path, f.getvalue())
+
+    def mkdir(self, path):
+        path = normalize_path(path)
+        with self.lock:
+            if path in self.nodes:
+                raise OSError(errno.EEXIST, 'File exists', path)
+            if split_path(path)[0] not in self.children:
+                raise OSError(errno.ENOENT, 'No such file or directory', path)
+            self._add(path, None)
+
+    def rename(self, old, new):
+        old, new = normalize_path(old), normalize_path(new)
+        with self.lock:
+            node = self._node(old)
+            if new in self.nodes:
+                raise OSError(errno.EEXIST, 'There is already a file or folder with that name.')
+            if split_path(new)[0] not in self.children or new.startswith(old + '/'):
+                raise OSError(errno.EINVAL, 'Invalid argument', new)
+            moved = [old] + [p for p in self.nodes if p.startswith(old + '/')]
+            for path in moved:
+                target = new + path[len(old):]
+                self.nodes[target] = self.nodes.pop(path)
+                if path in self.children:
+                    self.children[target] = self.children.pop(path)
+            folder, name = split_path(old)
+            self.children[folder].discard(name)
+            self.nodes[folder][1] = time.time()
+            folder, name = split_path(new)
+            self.children[folder].add(name)
+            self.nodes[folder][1] = time.time()
+
+    def _unlink(self, path):
+        del self.nodes[path]
+        self.children.pop(path, None)
+        folder, name = split_path(path)
+        self.children[folder].discard(name)
+        self.nodes[folder][1] = time.time()
+
+    def remove(self, path):
+        path = normalize_path(path)
+        with self.lock:
+            if self._node(path)[0] is None:
+                raise OSError(errno.EISDIR, 'Is a directory', path)
+            self._unlink(path)
+
+    def rmdir(self, path):
+        path = normalize_path(path)
+        with self.lock:
+            if self._node(path)[0] is not None:
+                raise OSError(errno.ENOTDIR, 'Not a directory', path)
+            if self.children[path]:
+                raise OSError(errno.ENOTEMPTY, 'Directory not empty', path)
+            self._unlink(path)
+
+
+class S3Reader:
+
+    """A read-only, seekable file over an S3 object, fetched with ranged GETs of at least blocksize bytes."""
+
+    def __init__(self, client, bucket, key, size, blocksize=65536):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.blocksize = blocksize
+        self.pos = 0
+        self.buffer = ''
+        self.bufferpos = 0
+
+    def seek(self, offset, whence=0):
+        self.pos = offset + (self.pos if whence == 1 else self.size if whence == 2 else 0)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.pos
+        start = self.pos - self.bufferpos
+        if not 0 <= start or start + size > len(self.buffer):
+            if self.pos >= self.size:
+                return ''
+            last = min(self.size, self.pos + max(size, self.blocksize)) - 1
+            self.buffer = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                                 Range='bytes=%d-%d' % (self.pos, last))['Body'].read()
+            self.bufferpos, start = self.pos, 0
+        data = self.buffer[start:start + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.buffer = ''
+
+
+def _s3_error_code(e):
+    """Returns the error code of a botocore ClientError, or None for other exceptions."""
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+class S3Storage(Storage):
+
+    """Files kept as objects in a bucket of S3, or of a compatible store such as MinIO.
+
+    The object for a path is prefix followed by the path relative to root.
+    Folders are the "/"-separated key prefixes, and mkdir makes them
+    exist while empty with a zero-byte "name/" marker object, as the S3
+    console does.  client is a boto3 S3 client; without one, one is made
+    with clientoptions (e.g. endpoint_url for MinIO), which needs boto3.
+    Renaming copies each object and deletes the old one, so it takes time
+    in proportion to the size of what is renamed, and S3's copy limits
+    files to 5 GB.  S3 can't refuse to overwrite, so a file made by
+    another client between create's check and its upload is replaced.
+    """
+
+    def __init__(self, root, bucket, prefix='', client=None, **clientoptions):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise EnvironmentError('S3Storage needs the boto3 module.')
+            client = boto3.client('s3', **clientoptions)
+        self.client = client
+        self.root = normalize_path(root)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, path):
+        """Returns the object key for path, without a trailing "/"; the root's is prefix itself."""
+        path = normalize_path(path)
+        if path == self.root:
+            return self.prefix.rstrip('/')
+        if not path.startswith(self.root.rstrip('/') + '/'):
+            raise OSError(errno.EACCES, 'Outside the bucket\'s root.', path)
+        return self.prefix + path[len(self.root.rstrip('/')) + 1:]
+
+    def _folderprefix(self, key):
+        return key + '/' if key else ''
+
+    def _objectstat(self, size, modified, etag):
+        mtime = calendar.timegm(modified.utctimetuple()) + modified.microsecond / 1e6
+        return make_stat(False, size, mtime, int(etag.strip('"')[:15] or '0', 16))
+
+    def _pages(self, prefix, delimiter=''):
+        kwargs = {'Bucket' : self.bucket, 'Prefix' : prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            yield page
+            if not page.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+    def stat(self, path, follow_symlinks=True):
+        if normalize_path(path) == self.root:
+            return make_stat(True)
+        key = self.key(path)
+        if not path.endswith('/'):
+            try:
+                head = self.client.head_object(Bucket=self.bucket, Key=key)
+                return self._objectstat(head['ContentLength'], head['LastModified'], head['ETag'])
+            except Exception, e:
+                if _s3_error_code(e) not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise
+        if self.client.list_objects_v2(Bucket=self.bucket, Prefix=key + '/', MaxKeys=1).get('KeyCount'):
+            return make_stat(True)
+        raise OSError(errno.ENOENT, 'No such file or directory', path)
+
+    def list(self, path, follow_symlinks=True):
+        prefix = self._folderprefix(self.key(path))
+        found = False
+        for page in self._pages(prefix, '/'):
+            for common in page.get('CommonPrefixes', ()):
+                found = True
+                yield common['Prefix'][len(prefix):].rstrip('/'), make_stat(True)
+            for item in page.get('Contents', ()):
+                found = True
+                if item['Key'] != prefix:
+                    yield item['Key'][len(prefix):], self._objectstat(item['Size'], item['LastModified'], item['ETag'])
+        if not found and normalize_path(path) != self.root:
+            raise OSError(errno.ENOENT, 'No such file or directory', path)
+
+    def open(self, path):
+        st = self.stat(path)
+        if stat.S_ISDIR(st.st_mode):
+            raise IOError(errno.EISDIR, 'Is a directory', path)
+        return S3Reader(self.client, self.bucket, self.key(path), st.st_size)
+
+    def chunks(self, path, offset=0, length=-1, chunksize=262144):
+        kwargs = {'Bucket' : self.bucket, 'Key' : self.key(path)}
+        if offset or length >= 0:
+            kwargs['Range'] = 'bytes=%d-%s' % (offset, '' if length < 0 else offset + length - 1)
+        body = self.client.get_object(**kwargs)['Body']
+        try:
+            while True:
+                data = body.read(chunksize)
+                if not data:
+                    break
+                yield data
+        finally:
+            body.close()
+
+    @contextmanager
+    def create(self, folder, name):
+        path = join_path(folder, name)
+        if self.exists(path):
+            raise EnvironmentError(errno.EEXIST, 'File already exists.')
+        with tempfile.SpooledTemporaryFile(max_size=8 << 20) as f:
+            yield f
+            f.seek(0)
+            self.client.upload_fileobj(f, self.bucket, self.key(path))
+
+    def mkdir(self, path):
+        if self.exists(path):
+            raise OSError(errno.EEXIST, 'File exists', path)
+        self.client.put_object(Bucket=self.bucket, Key=self.key(path) + '/', Body='')
+
+    def rename(self, old, new):
+        if self.exists(new):
+            raise OSError(errno.EEXIST, 'There is already a file or folder with that name.')
+        oldkey, newkey = self.key(old), self.key(new)
+        if self.isdir(old):
+            keys = [item['Key'] for page in self._pages(oldkey + '/') for item in page.get('Contents', ())]
+        else:
+            keys = [oldkey]
+        for key in keys:
+            self.client.copy_object(Bucket=self.bucket, Key=newkey + key[len(oldkey):],
+                                    CopySource={'Bucket' : self.bucket, 'Key' : key})
+        for key in keys:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def remove(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(path))
+
+    def rmdir(self, path):
+        prefix = self._folderprefix(self.key(path))
+        page = self.client.list_objects_v2(Bucket=self.bucket, Prefix=prefix, MaxKeys=2)
+        if [item for item in page.get('Contents', ()) if item['Key'] != prefix]:
+            raise OSError(errno.ENOTEMPTY, 'Directory not empty', path)
+        self.client.delete_object(Bucket=self.bucket, Key=prefix)
+
 
 class Filemanager:
 
     """Replacement for FCKEditor's built-in file manager."""
     
-    def __init__(self, fileroot= '/'):
+    # The methods that can be requested as a mode.
+    modes = ['getinfo', 'getfolder', 'rename', 'delete', 'add', 'addchunk', 'uploadstatus',
+             'addfolder', 'download', 'thumbnail', 'changes', 'search',
+             'multigetinfo', 'multidelete', 'multimove', 'downloadarchive', 'dedupstats', 'usage', 'metrics']
+    
+    def __init__(self, fileroot= '/', imagesizecache=True, thumbnails=True, foldersizes=True,
+                 searchindex=True, watch=False, batchworkers=8, dedup=False,
+                 usage=True, quota=None, filequota=None, profiledir=None, profilethreshold=1.0,
+                 storage=None, connectorurl='connectors/py/filemanager.py'):
         self.fileroot = fileroot
+        self.connectorurl = connectorurl
+        self.storage = storage or LocalStorage()
+        # The caches and indexes below live in the root as real files.
+        local = self.storage.local
+        self.imagesizes = None
+        if imagesizecache and sqlite3 is not None and local:
+            self.imagesizes = ImageSizeCache(join_path(fileroot, '.filemanager-imagesizes.sqlite'))
+        self.thumbnails = None
+        if thumbnails and local:
+            self.thumbnails = ThumbnailCache(join_path(fileroot, '.filemanager-thumbnails'))
+        self.foldersizes = None
+        if foldersizes and sqlite3 is not None and local:
+            self.foldersizes = FolderSizes(join_path(fileroot, '.filemanager-foldersizes.sqlite'))
+        self.searchindex = None
+        if searchindex and sqlite3 is not None and local:
+            self.searchindex = SearchIndex(join_path(fileroot, '.filemanager-search.sqlite'), fileroot)
+        self.requestmetrics = Metrics()
+        self.profiledir = profiledir
+        self.profilethreshold = profilethreshold
+        self.blobs = None
+        if dedup and sqlite3 is not None and local:
+            self.blobs = BlobStore(join_path(fileroot, '.filemanager-blobs'))
+        self.ledger = None
+        if (usage or quota is not None or filequota is not None) and sqlite3 is not None and local:
+            self.ledger = UsageLedger(join_path(fileroot, '.filemanager-usage.sqlite'), fileroot,
+                                      quota, filequota, batchworkers)
+        self.batchworkers = batchworkers
+        self._batchpool = None
+        self._batchlock = threading.Lock()
+        self.watcher = None
+        if watch and local:
+            self.watcher = ChangeWatcher(fileroot)
+            if self.foldersizes is not None:
+                self.watcher.listeners.append(self.foldersizes.invalidate)
+            if self.searchindex is not None:
+                self.watcher.listeners.append(self.searchindex.update)
         self.patherror = encode_json(
                 {
                     'Error' : 'No permission to operate on specified path.',
@@ -63,228 +2175,1452 @@ class Filemanager:
                 }
             )
 
-    def isvalidrequest(self, **kwargs):
-        """Returns an error if the given path is not within the specified root path."""
-                
-        assert split_path(kwargs['path'])[0]==self.fileroot
-        assert not kwargs['req'] is None
+    def isvalidrequest(self, path=None, req=None):
+        """Returns False if the given path is not within the specified root path.
+
+        On local storage both are resolved with realpath first, so neither
+        a sibling folder sharing the root's name as a prefix nor a symlink
+        leading out of the root passes.  The connector's own hidden files
+        in the root (caches, indexes, the blob store) are refused too.
+        """
+
+        if path is None or req is None:
+            return False
+        resolve = os.path.realpath if self.storage.local else absolute_path
+        root, path = resolve(self.fileroot), resolve(path)
+        if path != root and not path.startswith(root.rstrip('/') + '/'):
+            return False
+        return not any(part.startswith('.filemanager-') for part in path[len(root):].split('/'))
+
+
+    def fileinfo(self, path, st, getsize=True):
+        """Builds the DirEntryInfo for path from an already-obtained stat result.
+
+        No further syscalls are made except to read image dimensions, so a
+        listing costs one stat per entry.
+        """
+        
+        if stat.S_ISDIR(st.st_mode):
+            if not path.endswith('/'):
+                path += '/'
+            return DirEntryInfo(path, path[:-1].rpartition('/')[2], 'dir', 'images/fileicons/_Open.png',
+                                st.st_ctime, st.st_mtime)
+        
+        name = path.rpartition('/')[2]
+        ext = split_ext(name)[1][1:].lower()
+        thefile = DirEntryInfo(path, name, ext or 'txt', path, st.st_ctime, st.st_mtime, st.st_size)
+        if ext in imagetypes:
+            if self.thumbnails is not None:
+                thefile.preview = self.connectorurl + '?mode=thumbnail&path=' + urllib.quote(path)
+            if getsize:
+                img = self.imagesize(path, st)
+                if img is not None:
+                    thefile.width, thefile.height = img
+        else:
+            thefile.preview = file_icon(ext)
+        return thefile
+
+
+    def imagesize(self, path, st):
+        """Returns (width, height) of the image at path, using the size cache if enabled."""
+        start = time.time()
+        try:
+            if self.imagesizes is not None:
+                return self.imagesizes.get(path, st)
+            if self.storage.local:
+                return read_image_size(path)
+            try:
+                with closing(self.storage.open(path)) as f:
+                    return sniff_image_size(f)
+            except (EnvironmentError, struct.error):
+                return None
+        finally:
+            self.requestmetrics.add('image_seconds', time.time() - start)
+
+
+    def folderinfo(self, path, getsizes=True, cursor=None, offset=0, limit=None, page=None):
+        """Yields (path, DirEntryInfo) for every visible entry of a directory.
+
+        This is the listing engine behind getfolder: it works from a single
+        pass of the storage's list (scan_directory, on local storage) rather
+        than calling getinfo per entry.
+
+        When cursor, offset or limit is given the entries are instead paged
+        in filename order: only names after cursor are considered, offset of
+        them are skipped and at most limit are returned.  The page is picked
+        with a bounded heap over the bare names, so only the entries on the
+        page are ever stat-ed.  page, if given, is the names on the page as
+        pagenames picked them.
+        """
+        
+        if not path.endswith('/'):
+            path += '/'
+        
+        fileinfo = self.fileinfo
+        if getsizes and self.foldersizes is not None:
+            fileinfo = self._withfoldersize(path)
+        if page is None and cursor is None and not offset and limit is None:
+            for name, st in self.storage.list(path):
+                if name[0]=='.':
+                    continue
+                thefile = fileinfo(path + name, st, getsizes)
+                yield thefile.path, thefile
+            return
+        
+        if page is None:
+            page = self.pagenames(path, cursor, offset, limit)
+        for name in page:
+            try:
+                st = self.storage.stat(path + name)
+            except EnvironmentError:
+                continue # Removed since the names were read.
+            thefile = fileinfo(path + name, st, getsizes)
+            yield thefile.path, thefile
+
+
+    def pagenames(self, path, cursor=None, offset=0, limit=None):
+        """Returns the sorted names of the visible entries of a directory on one page, as folderinfo pages them."""
+        names = (name for name in self.storage.names(path)
+                 if name[0]!='.' and (cursor is None or name > cursor))
+        if limit is None:
+            return sorted(names)[offset:]
+        return heapq.nsmallest(offset + limit, names)[offset:]
+
+
+    def _withfoldersize(self, path):
+        """Returns fileinfo for entries of path that also fills in the Size of subfolders.
+
+        Each subfolder listed is checked against its cached row by its own
+        mtime, from the stat result the listing already has; only changed
+        subfolders are revalidated.
+        """
+        rows = self.foldersizes.cached(path)
+        
+        def fileinfo(entrypath, st, getsize):
+            thefile = self.fileinfo(entrypath, st, getsize)
+            if thefile.filetype == 'dir':
+                totals = self.foldersizes.subfolder(entrypath, st, rows)
+                if totals is not None:
+                    thefile.size, thefile.files = totals
+            return thefile
+        return fileinfo
+
+
+    def getinfo(self, path=None, getsize=True, req=None):
+        """Returns a JSON object containing information about the given file."""
+
+        if not self.isvalidrequest(path,req):
+            return (self.patherror, None, 'application/json')
+
+        req.content_type = 'application/json'
+        req.write(self._getinfo(path, is_true(getsize)).json())
+
+
+    def _getinfo(self, path, getsize):
+        try:
+            st = self.storage.stat(path)
+        except EnvironmentError:
+            return DirEntryInfo(path, error='File does not exist.', code=-1)
+        
+        thefile = self.fileinfo(path, st, getsize)
+        if thefile.filetype == 'dir' and getsize and self.foldersizes is not None:
+            totals = self.foldersizes.get(path)
+            if totals is not None:
+                thefile.size, thefile.files = totals
+        return thefile
+
+
+    def getfolder(self, path=None, getsizes=True, showThumbs=False, cursor=None, offset=0, limit=None, req=None):
+        """Writes a JSON object mapping each entry's path to its getinfo dict.
+
+        The object is streamed to the client while the directory is being
+        read.  With limit (and optionally cursor or offset) only one page of
+        the folder is returned, in filename order; if limit names were read
+        for the page (some may have been deleted before they could be
+        listed) the X-Filemanager-Cursor header carries the cursor for the
+        next page.
+        
+        With showThumbs, thumbnails for the images in the listing start being
+        generated in the background as soon as they are listed.
+        """
+    
+        if not self.isvalidrequest(path,req):
+            return (self.patherror, None, 'application/json')
+
+        limit, offset = to_int(limit), to_int(offset, 0)
+        page = None
+        if limit is not None:
+            # The cursor is the last name on the page even if that entry has
+            # gone since, so a vanished entry doesn't end the paging early.
+            page = self.pagenames(path, cursor or None, offset, limit)
+            if len(page) == limit and page:
+                req.headers_out['X-Filemanager-Cursor'] = page[-1]
+        entries = self.folderinfo(path, is_true(getsizes), cursor or None, offset, limit, page)
+        
+        if is_true(showThumbs) and self.thumbnails is not None:
+            entries = self._warmthumbnails(entries)
+
+        req.content_type = 'application/json'
+        self.requestmetrics.add('entries', write_json_object(req.write, entries))
+    
+    
+    def _warmthumbnails(self, entries):
+        for key, thefile in entries:
+            if thefile.filetype in imagetypes:
+                self.thumbnails.warm([key])
+            yield key, thefile
+    
+    
+    def thumbnail(self, path=None, req=None):
+        """Serves a JPEG thumbnail of the image at path.
+
+        Thumbnails come from the on-disk cache and are revalidated with ETag
+        and Last-Modified.  If no thumbnail can be made the image itself is
+        served.
+        """
+        
+        if not self.isvalidrequest(path,req):
+            return (self.patherror, None, 'application/json')
+        
+        try:
+            st = self.storage.stat(path)
+        except EnvironmentError:
+            return HTTP_NOT_FOUND
+        
+        key, target = thumbnail_key(st, (0, 0)), None
+        if self.thumbnails is not None:
+            start = time.time()
+            key, target = self.thumbnails.get(path, st)
+            self.requestmetrics.add('image_seconds', time.time() - start)
+        
+        etag = '"%s"' % key
+        req.headers_out['ETag'] = etag
+        req.headers_out['Last-Modified'] = http_date(st.st_mtime)
+        req.headers_out['Cache-Control'] = 'public, max-age=86400'
+        if is_not_modified(req, etag, st.st_mtime):
+            return HTTP_NOT_MODIFIED
+        
+        if target is None:
+            req.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            self.storage.sendfile(req, path)
+        else:
+            req.content_type = 'image/jpeg'
+            req.sendfile(target)
+    
+    
+    def rename(self, old=None, new=None, req=None):
+        """Renames the file or folder at old to new, within the same folder."""
+        
+        if not self.isvalidrequest(path=old,req=req):
+            return (self.patherror, None, 'application/json')
+        
+        old = old.rstrip('/')
+        folder, oldname = split_path(old)
+        newname = encode_urlpath(new or '')
+        newpath = join_path(folder, newname)
+        
+        result = {
+            'Old Path' : old,
+            'Old Name' : oldname,
+            'New Path' : newpath,
+            'New Name' : newname,
+            'Error' : '',
+            'Code' : 0
+        }
         
+        try:
+            if not newname or newname[0]=='.':
+                raise OSError(errno.EINVAL, 'Invalid name.')
+            self._move(old, newpath)
+        except EnvironmentError, e:
+            result.update({'Error' : e.strerror or str(e), 'Code' : -1})
+        
+        req.content_type = 'application/json'
+        req.write(encode_json(result))
+    
+    
+    def _move(self, old, new):
+        """Renames or moves old to new, which mustn't exist yet, and updates the caches."""
+        st = self.storage.stat(old, follow_symlinks=False)
+        self.storage.rename(old, new)
+        
+        oldfolder, newfolder = split_path(old)[0], split_path(new)[0]
+        if self.foldersizes is not None:
+            if not stat.S_ISDIR(st.st_mode):
+                if oldfolder != newfolder:
+                    self.foldersizes.adjust(oldfolder, -st.st_size, -1)
+                    self.foldersizes.adjust(newfolder, st.st_size, 1)
+            elif oldfolder == newfolder:
+                self.foldersizes.moved(old, new)
+            else:
+                # The destination picks it up with a rescan on its next get.
+                self.foldersizes.removed(old)
+        if self.searchindex is not None:
+            self.searchindex.moved(old, new)
+    
 
-
-    def getinfo(self, path=None, getsize=true, req=None):
-        """Returns a JSON object containing information about the given file."""
-
+    def delete(self, path=None, req=None):
+        """Deletes the file, or empty folder, at path."""
+    
         if not self.isvalidrequest(path,req):
             return (self.patherror, None, 'application/json')
-
-        thefile = {
-            'Filename' : split_path(path)[-1],
-            'File Type' : '',
-            'Preview' : path if split_path(path)[-1] else 'images/fileicons/_Open.png',
+        
+        req.content_type = 'application/json'
+        req.write(encode_json(self._delete(path)))
+    
+    
+    def _delete(self, path):
+        result = {
             'Path' : path,
             'Error' : '',
-            'Code' : 0,
-            'Properties' : {
-                    'Date Created' : '',
-                    'Date Modified' : '',
-                    'Width' : '',
-                    'Height' : '',
-                    'Size' : ''
-                }
-            }
-            
-        imagetypes = set('gif','jpg','jpeg','png')
+            'Code' : 0
+        }
         
+        path = path.rstrip('/')
+        try:
+            st = self.storage.stat(path, follow_symlinks=False)
+            if stat.S_ISDIR(st.st_mode):
+                self.storage.rmdir(path)
+                if self.foldersizes is not None:
+                    self.foldersizes.removed(path)
+            else:
+                self.storage.remove(path)
+                if self.foldersizes is not None:
+                    self.foldersizes.adjust(split_path(path)[0], -st.st_size, -1)
+                if self.ledger is not None and stat.S_ISREG(st.st_mode):
+                    self.ledger.adjust(-st.st_size, -1)
+                if self.blobs is not None:
+                    self.blobs.release(st)
+            if self.searchindex is not None:
+                self.searchindex.removed(path)
+        except EnvironmentError, e:
+            if e.errno == errno.ENOTEMPTY:
+                result.update({'Error' : 'Folder not empty', 'Code' : -1})
+            else:
+                result.update({'Error' : e.strerror or str(e), 'Code' : -1})
+        return result
     
-        if not path_exists(path):
-            thefile['Error'] = 'File does not exist.'
-            return (encode_json(thefile), None, 'application/json')
-        
+    
+    def _pathlist(self, paths, req):
+        """Decodes the JSON array of paths given to the multi- modes.
+
+        Returns (valid paths, results for the paths that were refused).
+        """
+        try:
+            paths = json.loads(paths or '[]')
+        except ValueError:
+            paths = None
+        if not isinstance(paths, list) or not all(isinstance(p, basestring) for p in paths):
+            raise KeyError('paths') # Answered with 400 Bad Request.
         
-        if split_path(path)[-1]=='/':
-            thefile['File Type'] = 'Directory'
-        else:
-            thefile['File Type'] = split_ext(path)
-            
-            if ext in imagetypes:
-                img = Image(path).size()
-                thefile['Properties']['Width'] = img[0]
-                thefile['Properties']['Height'] = img[1]
-                
+        valid, refused = [], []
+        for path in paths:
+            path = path.encode('utf-8') if isinstance(path, unicode) else path
+            if self.isvalidrequest(path,req):
+                valid.append(path)
             else:
-                previewPath = 'images/fileicons/' + ext.upper + '.png'
-                thefile['Preview'] = previewPath if path_exists('../../' + previewPath) else 'images/fileicons/default.png'
-        
-        thefile['Properties']['Date Created'] = os.path.getctime(path) 
-        thefile['Properties']['Date Modified'] = os.path.getmtime(path) 
-        thefile['Properties']['Size'] = os.path.getsize(path)
-
-        req.content_type('application/json')
-        req.write(encode_json(thefile))
-
-
-    def getfolder(self, path=None, getsizes=true, req=None):
+                refused.append({'Path' : path, 'Error' : 'No permission to operate on specified path.', 'Code' : -1})
+        return valid, refused
     
-        if not self.isvalidrequest(path,req):
-            return (self.patherror, None, 'application/json')
-
-        result = []         
-        filtlist = file_listdirectory(path)
+    
+    def _batch(self, fn, items):
+        """Maps fn over items on the bulk worker threads, in order.
 
-        for i in filelist:
-             if i[0]=='.':
-                result += literal(self.getinfo(path + i, getsize=getsizes))
+        The counters the calls add to requestmetrics, such as image_seconds,
+        are collected on each worker and added to the calling request's.
+        """
+        with self._batchlock:
+            if self._batchpool is None:
+                self._batchpool = ThreadPool(self.batchworkers)
+        metrics = self.requestmetrics
+        for result, counts in self._batchpool.imap(lambda item: metrics.collect(fn, item), items):
+            for name, value in counts.items():
+                metrics.add(name, value)
+            yield result
+    
+    
+    def _multiresult(self, results, req):
+        results = list(results)
+        failed = len([r for r in results if r['Code']])
+        req.content_type = 'application/json'
+        req.write(encode_json({
+            'Results' : results,
+            'Failed' : failed,
+            'Error' : '%d of %d failed' % (failed, len(results)) if failed else '',
+            'Code' : 0
+        }))
+    
+    
+    def multigetinfo(self, paths=None, getsize=True, req=None):
+        """Writes a getfolder-style JSON object with the getinfo dict for each of paths.
 
-        req.content_type('application/json')
-        req.write(encode_json(result))
+        paths is a JSON array; paths that don't exist, or aren't allowed,
+        get an error dict as getinfo would return.  The files are stat-ed
+        in parallel, and the object is streamed in the order given.
+        """
+        
+        valid, refused = self._pathlist(paths, req)
+        getsize = is_true(getsize)
+        infos = self._batch(lambda path: self._getinfo(path, getsize), valid)
+        req.content_type = 'application/json'
+        self.requestmetrics.add('entries', write_json_object(req.write, itertools.chain(
+            ((r.path, r) for r in infos), ((r['Path'], r) for r in refused))))
     
     
-    def rename(self, old=None, new=None, req=None):
-                
-        if not self.isvalidrequest(path=new,req=req):
-            return (self.patherror, None, 'application/json')
+    def multidelete(self, paths=None, req=None):
+        """Deletes each of paths, a JSON array, in parallel.
+
+        The response lists a result for each path, as delete would give it,
+        and the number that Failed; the others are deleted regardless.
+        """
         
-        if old[-1]=='/':
-            old=old[:-1]
-            
-        oldname = split_path(path)[-1]
-        path = string(old)
-        path = split_path(path)[0]
+        valid, refused = self._pathlist(paths, req)
+        self._multiresult(itertools.chain(self._batch(self._delete, valid), refused), req)
+    
+    
+    def multimove(self, paths=None, folder=None, req=None):
+        """Moves each of paths, a JSON array, into folder, in parallel.
+
+        Nothing is overwritten: a path whose name is already used in folder
+        fails.  The response is like multidelete's, with each result giving
+        the Old Path and New Path.
+        """
         
-        if not path[-1]=='/':
-            path += '/'
+        if not self.isvalidrequest(folder,req) or not self.storage.isdir(folder):
+            return (self.patherror, None, 'application/json')
         
-        newname = encode_urlpath(new)
-        newpath = path + newname
+        def move(path):
+            path = path.rstrip('/')
+            newpath = join_path(folder, split_path(path)[1])
+            result = {'Old Path' : path, 'New Path' : newpath, 'Error' : '', 'Code' : 0}
+            try:
+                if absolute_path(newpath).startswith(absolute_path(path) + '/'):
+                    raise OSError(errno.EINVAL, 'Can\'t move a folder into itself.')
+                self._move(path, newpath)
+            except EnvironmentError, e:
+                result.update({'Error' : e.strerror or str(e), 'Code' : -1})
+            return result
         
-        os.path.rename(old, newpath)
+        valid, refused = self._pathlist(paths, req)
+        self._multiresult(itertools.chain(self._batch(move, valid), refused), req)
+    
+    
+    def add(self, path=None, currentpath=None, req=None):
+        """Stores a file uploaded as multipart/form-data.
+
+        The body is parsed as it arrives and the file streamed to a
+        temporary file in the target folder, which is fsync-ed and renamed
+        into place once complete; the upload is never held in memory.  The
+        target folder is the currentpath form field (or the path or
+        currentpath query parameter).  With a quota, uploads whose
+        Content-Length doesn't fit are refused once the target folder is
+        known, before the file itself is read.
+        """
         
         result = {
-            'Old Path' : old,
-            'Old Name' : oldname,
-            'New Path' : newpath,
-            'New Name' : newname,
-            'Error' : 'There was an error renaming the file.' # todo: get the actual error
+            'Path' : currentpath or path,
+            'Name' : '',
+            'Error' : 'No file was uploaded.',
+            'Code' : -1
         }
         
-        req.content_type('application/json')
-        req.write(encode_json(result))
+        reserved = None
+        try:
+            ctype, params = parse_header(req.headers_in.get('Content-Type', ''))
+            length = int(req.headers_in.get('Content-Length', 0))
+            reader = MultipartReader(req.read, params['boundary'], length)
+            
+            for name, filename, chunks in reader.parts():
+                if filename is None:
+                    value = ''.join(chunks)
+                    if name == 'currentpath':
+                        result['Path'] = value
+                    continue
+                if not filename:
+                    continue
+                
+                folder = result['Path']
+                if not self.isvalidrequest(folder,req):
+                    return (self.patherror, None, 'application/json')
+                if self.ledger is not None:
+                    self.ledger.reserve(length)
+                    reserved = length
+                
+                result['Name'] = upload_filename(filename)
+                digest, commit = hashlib.sha256(), None
+                if self.blobs is not None:
+                    commit = lambda tmp, target: self.blobs.commit(tmp, target, digest.hexdigest())
+                    upload = atomic_upload(folder, result['Name'], commit=commit)
+                else:
+                    upload = self.storage.create(folder, result['Name'])
+                with upload as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        if commit is not None:
+                            digest.update(chunk)
+                    size = f.tell()
+                if self.ledger is not None:
+                    self.ledger.settle(reserved, 1, size, 1)
+                    reserved = None
+                if self.foldersizes is not None:
+                    self.foldersizes.adjust(folder, size, 1)
+                if self.searchindex is not None:
+                    self.searchindex.added(join_path(folder, result['Name']))
+                result['Error'] = ''
+                result['Code'] = 0
+                break
+                
+        except (KeyError, ValueError), e:
+            result['Error'] = 'Malformed upload: %s' % (e,)
+        except EnvironmentError, e:
+            result['Error'] = e.strerror or str(e)
+        finally:
+            if reserved is not None and self.ledger is not None:
+                self.ledger.settle(reserved)
+    
+        if result['Path'] and not result['Path'].endswith('/'):
+            result['Path'] += '/'
+        req.content_type = 'text/html'
+        req.write(('<textarea>' + encode_json(result) + '</textarea>'))
+    
+    
+    def _partialupload(self, path, uploadid):
+        if not valid_upload_id(uploadid or ''):
+            raise ValueError('Invalid upload id.')
+        return join_path(path, '.upload-' + uploadid + '.part')
     
-
-    def delete(self, path=None, req=None):
     
+    def addchunk(self, path=None, name=None, uploadid=None, offset=0, total=None, req=None):
+        """Appends one chunk of a resumable upload, sent as the raw request body.
+
+        The client picks an uploadid and sends the file in pieces, each at
+        the given offset; total is the size of the whole file.  Chunks go
+        to a hidden partial file in the folder at path; when it reaches
+        total bytes it is fsync-ed and renamed to name.  A chunk at the
+        wrong offset is refused, and the response's Offset tells the client
+        where to resume, as does uploadstatus after a dropped connection.
+        With a quota, total is reserved when the first chunk arrives, and
+        an upload that doesn't fit is refused then.  If the first chunk
+        fails, or the finished file can't be put in place (name may be
+        taken by then), the partial file is removed and the reservation
+        released, and the upload has to start again.
+        """
+        
         if not self.isvalidrequest(path,req):
             return (self.patherror, None, 'application/json')
-
-        os.path.remove(path)
         
         result = {
             'Path' : path,
-            'Error' : 'There was an error renaming the file.' # todo: get the actual error
+            'Name' : upload_filename(name or ''),
+            'Offset' : 0,
+            'Complete' : False,
+            'Error' : '',
+            'Code' : 0
         }
         
-        req.content_type('application/json')
+        partial = reserved = None
+        created = False
+        try:
+            if not self.storage.local:
+                raise EnvironmentError(errno.EOPNOTSUPP, 'Resumable uploads need local storage.')
+            partial = self._partialupload(path, uploadid)
+            offset, total = to_int(offset, 0), to_int(total)
+            if not result['Name'] or total is None:
+                raise ValueError('name and total are required.')
+            
+            # Nothing is created until the chunk is known to be the next one.
+            started = path_exists(partial)
+            current = os.path.getsize(partial) if started else 0
+            if offset != current:
+                raise ValueError('Expected offset %d.' % current)
+            if not started:
+                os.close(os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666))
+                created = True
+                if self.ledger is not None:
+                    self.ledger.reserve(total)
+                    reserved = total
+            with open(partial, 'ab') as f:
+                if f.tell() != current:
+                    raise ValueError('Expected offset %d.' % f.tell())
+                remaining = min(int(req.headers_in.get('Content-Length', 0)), total - current)
+                while remaining > 0:
+                    data = req.read(min(65536, remaining))
+                    if not data:
+                        break
+                    f.write(data)
+                    remaining -= len(data)
+                f.flush()
+                if f.tell() == total:
+                    os.fsync(f.fileno())
+                result['Offset'] = f.tell()
+            
+            if result['Offset'] == total:
+                # The upload ends here, either way, and so does its reservation.
+                created = True
+                if self.ledger is not None:
+                    reserved = total
+                if self.blobs is not None:
+                    self.blobs.commit(partial, join_path(path, result['Name']), self.blobs.digest(partial))
+                else:
+                    commit_upload(partial, join_path(path, result['Name']))
+                created, reserved = False, None
+                result['Complete'] = True
+                if self.ledger is not None:
+                    self.ledger.settle(total, 1, total, 1)
+                if self.foldersizes is not None:
+                    self.foldersizes.adjust(path, total, 1)
+                if self.searchindex is not None:
+                    self.searchindex.added(join_path(path, result['Name']))
+            created, reserved = False, None
+                
+        except ValueError, e:
+            result.update({'Error' : str(e), 'Code' : -1})
+        except EnvironmentError, e:
+            result.update({'Error' : e.strerror or str(e), 'Code' : -1})
+        finally:
+            if created and path_exists(partial):
+                os.remove(partial)
+            if reserved is not None:
+                self.ledger.settle(reserved)
+        if partial is not None and result['Code'] and path_exists(partial):
+            result['Offset'] = os.path.getsize(partial)
+        
+        req.content_type = 'application/json'
         req.write(encode_json(result))
     
     
-    def add(self, path=None, req=None):     
-
+    def uploadstatus(self, path=None, uploadid=None, req=None):
+        """Returns the Offset at which a resumable upload should continue."""
+        
         if not self.isvalidrequest(path,req):
             return (self.patherror, None, 'application/json')
         
+        result = {'Path' : path, 'Offset' : 0, 'Error' : '', 'Code' : 0}
+        try:
+            if not self.storage.local:
+                raise ValueError('Resumable uploads need local storage.')
+            result['Offset'] = os.path.getsize(self._partialupload(path, uploadid))
+        except ValueError, e:
+            result.update({'Error' : str(e), 'Code' : -1})
+        except OSError:
+            pass # Nothing received yet.
+        
+        req.content_type = 'application/json'
+        req.write(encode_json(result))
+        
     
+    def addfolder(self, path=None, name=None, req=None):
+        """Creates the folder name inside the folder at path."""
+
+        if not self.isvalidrequest(path,req):
+            return (self.patherror, None, 'application/json')
+
+        newName = encode_urlpath(name or '')
+        result = {
+            'Parent' : path,
+            'Name' : newName,
+            'Error' : '',
+            'Code' : 0
+        }
+        
         try:
-            thefile = util.FieldStorage(req)['file'] #TODO get the correct param name for the field holding the file            
-            newName = thefile.filename
-            
-            with open(newName, 'rb') as f:
-                            f.write(thefile.value) 
+            if not newName or newName[0]=='.':
+                raise OSError(errno.EINVAL, 'Invalid name.')
+            newPath = join_path(path, newName)
+            self.storage.mkdir(newPath)
+            if self.foldersizes is not None:
+                self.foldersizes.added(newPath)
+            if self.searchindex is not None:
+                self.searchindex.added(newPath)
+        except EnvironmentError, e:
+            result.update({'Error' : e.strerror or str(e), 'Code' : -1})
+        
+        req.content_type = 'application/json'
+        req.write(encode_json(result))
             
-        except:
+    
+    def changes(self, path=None, since=None, timeout=25, req=None):
+        """Long-polls for the folders that changed after the since token.
 
-            result = {
-                'Path' : path,
-                'Name' : newName,
-                'Error' : file_currenterror
-            }
-            
+        Responds as soon as something has changed, or after timeout seconds
+        (at most 60) with an empty list.  Changed lists the folders to
+        re-read with getfolder, limited to those under path if it's given;
+        Token is the since for the next request.  Reload is true when the
+        changes since that token aren't known (the first request, or too
+        many changes since) and the client should re-read everything.
+        Needs the Filemanager to be created with watch=True.
+        """
+        
+        path = path or self.fileroot
+        if not self.isvalidrequest(path,req):
+            return (self.patherror, None, 'application/json')
+        
+        result = {'Token' : '', 'Changed' : [], 'Reload' : False, 'Error' : '', 'Code' : 0}
+        if self.watcher is None:
+            result.update({'Error' : 'Change notification is not enabled.', 'Code' : -1})
         else:
-            result = {
-                'Path' : path,
-                'Name' : newName,
-                'Error' : 'No file was uploaded.'
-            }
-    
-        req.content_type('text/html')
-        req.write(('<textarea>' + encode_json(result) + '</textarea>'))
+            timeout = max(0, min(to_int(timeout, 25), 60))
+            result['Token'], folders = self.watcher.changes(since, timeout)
+            if folders is None:
+                result['Reload'] = True
+            else:
+                top = normalize_path(absolute_path(path))
+                result['Changed'] = sorted(folder.rstrip('/') + '/' for folder in folders
+                                           if folder == top or folder.startswith(top.rstrip('/') + '/'))
         
+        req.headers_out['Cache-Control'] = 'no-cache'
+        req.content_type = 'application/json'
+        req.write(encode_json(result))
     
-    def addfolder(self, path, name):        
+    
+    def search(self, path=None, q=None, match='substring', limit=100, getsizes=False, req=None):
+        """Writes a getfolder-style JSON object of the entries below path whose name matches q.
 
+        match is "substring" (the default), "prefix" or "extension", and at
+        most limit entries (up to 1000) are returned, in path order.  The
+        index is refreshed in the background when it's older than its
+        rescan interval; while that's running the X-Filemanager-Indexing
+        header is set, as results may be incomplete.
+        """
+        
+        path = path or self.fileroot
         if not self.isvalidrequest(path,req):
             return (self.patherror, None, 'application/json')
-
-        newName = encode_urlpath(name)
-        newPath = path + newName + '/'
         
-        if not path_exists(newPath):
+        if self.searchindex is None:
+            req.content_type = 'application/json'
+            req.write(encode_json({'Error' : 'Search is not enabled.', 'Code' : -1}))
+            return
+        
+        self.searchindex.rescan()
+        if self.searchindex.is_scanning():
+            req.headers_out['X-Filemanager-Indexing'] = '1'
+        
+        limit = max(1, min(to_int(limit, 100), 1000))
+        paths = self.searchindex.search(q or '', match, path, limit)
+        
+        req.content_type = 'application/json'
+        self.requestmetrics.add('entries', write_json_object(req.write, self._searchresults(paths, is_true(getsizes))))
+    
+    
+    def _searchresults(self, paths, getsizes):
+        for path in paths:
             try:
-                os.mkdir(newPath)
-            except:
-            
-                result = {
-                    'Path' : path,
-                    'Name' : newName,
-                    'Error' : 'There was an error creating the directory.' # TODO grab the actual traceback.
-                }
-            
+                st = os.stat(path)
+            except OSError:
+                continue # Gone since it was indexed.
+            thefile = self.fileinfo(path, st, getsizes)
+            yield thefile.path, thefile
+    
     
     def download(self, path=None, req=None):
+        """Sends the file at path as an attachment.
+
+        Supports conditional requests (If-None-Match, If-Modified-Since,
+        If-Range) and single or multiple byte ranges.  On local storage
+        every part is sent with req.sendfile, which hands the file to the
+        kernel's sendfile where the platform has one, so nothing is copied
+        through Python.
+        """
     
         if not self.isvalidrequest(path,req):
             return (self.patherror, None, 'application/json')
+        
+        try:
+            st = self.storage.stat(path)
+        except EnvironmentError:
+            return HTTP_NOT_FOUND
+        if stat.S_ISDIR(st.st_mode):
+            return HTTP_NOT_FOUND
             
         name = path.split('/')[-1]
-                  
-        req.content_type('application/x-download')
-        req.filename=name
-        req.sendfile(path)
+        size = st.st_size
+        etag = file_etag(st)
+        
+        req.headers_out['ETag'] = etag
+        req.headers_out['Last-Modified'] = http_date(st.st_mtime)
+        req.headers_out['Accept-Ranges'] = 'bytes'
+        if is_not_modified(req, etag, st.st_mtime):
+            return HTTP_NOT_MODIFIED
+        
+        req.headers_out['Content-Disposition'] = 'attachment; filename="%s"' % name.replace('"', '')
+        
+        ranges = None
+        if if_range_matches(req, etag, st.st_mtime):
+            ranges = parse_range(req.headers_in.get('Range'), size)
+        
+        if ranges is None:
+            req.content_type = 'application/x-download'
+            req.set_content_length(size)
+            self.storage.sendfile(req, path)
+            return
+        
+        if not ranges:
+            req.headers_out['Content-Range'] = 'bytes */%d' % size
+            return HTTP_RANGE_NOT_SATISFIABLE
+        
+        req.status = HTTP_PARTIAL_CONTENT
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            req.content_type = 'application/x-download'
+            req.headers_out['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            req.set_content_length(last - first + 1)
+            self.storage.sendfile(req, path, first, last - first + 1)
+            return
+        
+        boundary = encodeURLsafeBase64(os.urandom(18))
+        req.content_type = 'multipart/byteranges; boundary=' + boundary
+        for first, last in ranges:
+            req.write('\r\n--%s\r\nContent-Type: application/x-download\r\n'
+                      'Content-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, first, last, size), 0)
+            self.storage.sendfile(req, path, first, last - first + 1)
+        req.write('\r\n--%s--\r\n' % boundary)
+
+
+
+    def dedupstats(self, req=None):
+        """Returns how much space deduplicated uploads are saving.
+
+        Stored is the size of the distinct contents kept, Referenced the
+        total size of the files using them, and Ratio the second over the
+        first.
+        """
+        
+        result = {'Blobs' : 0, 'Stored' : 0, 'Referenced' : 0, 'Ratio' : 1.0, 'Error' : '', 'Code' : 0}
+        if self.blobs is None:
+            result.update({'Error' : 'Deduplication is not enabled.', 'Code' : -1})
+        else:
+            stats = self.blobs.stats()
+            result.update({'Blobs' : stats['blobs'], 'Stored' : stats['stored'], 'Referenced' : stats['referenced']})
+            if stats['stored']:
+                result['Ratio'] = round(float(stats['referenced']) / stats['stored'], 3)
+        
+        req.content_type = 'application/json'
+        req.write(encode_json(result))
+
+
+    def usage(self, req=None):
+        """Returns the bytes and files stored under the root, and the quotas."""
+        
+        if self.ledger is None:
+            result = {'Error' : 'Usage accounting is not enabled.', 'Code' : -1}
+        else:
+            size, files, reserved = self.ledger.usage()
+            result = {
+                'Bytes' : size,
+                'Files' : files,
+                'Reserved' : reserved,
+                'Quota' : self.ledger.quota,
+                'File Quota' : self.ledger.filequota,
+                'Error' : '',
+                'Code' : 0
+            }
+        req.content_type = 'application/json'
+        req.write(encode_json(result))
+
+
+    def metrics(self, req=None):
+        """Writes the request metrics, and the cache counters, in the Prometheus text format."""
+        
+        extra = []
+        if self.imagesizes is not None:
+            stats = self.imagesizes.stats()
+            extra.append(('imagesize_cache_hits', 'Image size cache hits.', stats['hits']))
+            extra.append(('imagesize_cache_misses', 'Image size cache misses.', stats['misses']))
+        req.content_type = 'text/plain; version=0.0.4'
+        req.write(self.requestmetrics.render(extra))
+
+
+    def downloadarchive(self, path=None, paths=None, format='zip', req=None):
+        """Sends the folder at path, or the files and folders in paths (a JSON array), as an archive.
+
+        format is "zip", "tar" or "tgz".  The archive is written to the
+        client as the files are read, with no temporary file.  Zip members
+        are deflated, except those of types in compressedtypes, which are
+        stored as they are.
+        """
+        
+        if paths is not None:
+            paths, refused = self._pathlist(paths, req)
+            if refused or not paths:
+                return (self.patherror, None, 'application/json')
+        elif self.isvalidrequest(path,req) and self.storage.isdir(path):
+            paths = [path]
+        else:
+            return (self.patherror, None, 'application/json')
+        
+        if format not in ('zip', 'tar', 'tgz'):
+            raise KeyError(format)
+        name = split_path(paths[0].rstrip('/'))[1] if len(paths) == 1 else 'download'
+        req.headers_out['Content-Disposition'] = 'attachment; filename="%s.%s"' % (name.replace('"', ''), format)
+        
+        if format == 'zip':
+            req.content_type = 'application/zip'
+            archive = ZipStream(req.write, opener=self.storage.open)
+            for arcname, path, st in archive_members(paths, self.storage):
+                if stat.S_ISDIR(st.st_mode):
+                    archive.add(arcname, st)
+                else:
+                    archive.add(arcname, st, path, split_ext(path)[1][1:].lower() not in compressedtypes)
+            archive.close()
+            return
+        
+        req.content_type = 'application/x-tar' if format == 'tar' else 'application/x-gzip'
+        archive = tarfile.open(mode='w|' if format == 'tar' else 'w|gz', fileobj=WriteAdapter(req.write),
+                               format=tarfile.PAX_FORMAT, encoding='utf-8', errors='replace',
+                               bufsize=262144)
+        for arcname, path, st in archive_members(paths, self.storage):
+            if self.storage.local:
+                info = archive.gettarinfo(path, arcname)
+            else:
+                info = tarfile.TarInfo(arcname)
+                info.type = tarfile.DIRTYPE if stat.S_ISDIR(st.st_mode) else tarfile.REGTYPE
+                info.mode, info.mtime = stat.S_IMODE(st.st_mode), st.st_mtime
+                info.size = 0 if info.isdir() else st.st_size
+            if info.isreg():
+                with closing(self.storage.open(path)) as f:
+                    archive.addfile(info, f)
+            else:
+                archive.addfile(info)
+        archive.close()
 
-    
 
 
 
 myFilemanager = Filemanager(fileroot='/var/www/html/dev/fmtest/UserFiles/') #modify fileroot as a needed
+# To serve many roots, with root_for_user(req, mode, kwargs) returning the logged-in user's root:
+# myFilemanager = FilemanagerPool(['/srv/files/a/', '/srv/files/b/'], resolve=root_for_user)
 
 
-def handler(req): 
-    #req.content_type = 'text/plain' 
-    #req.write("Hello World!") 
+def request_arguments(req):
+    """Returns the mode and the other parameters of a request as a dict.
 
+    Parameters come from the query string and, for form-encoded POSTs, the
+    body.  Multipart bodies are left unread for add to stream.
+    """
+    kwargs = parse_qs(req.args or '')
     if req.method == 'POST':
-        kwargs = parse_qs(req.read())
-    elif req.method == 'GET': 
-        kwargs = parse_qs(req.args)
+        ctype = req.headers_in.get('Content-Type', '')
+        if ctype.startswith('multipart/form-data'):
+            kwargs.setdefault('mode', ['add'])
+        elif ctype.startswith('application/x-www-form-urlencoded'):
+            kwargs.update(parse_qs(req.read(int(req.headers_in.get('Content-Length', 0)))))
+    mode = kwargs.pop('mode', [None])[0]
+    return mode, dict((str(k), v[0]) for k, v in kwargs.items())
+
+
+def dispatch(filemanager, req, arguments=None, runner=None):
+    """Runs the mode a request asks for; returns its HTTP status, or None for OK.
+
+    The request is timed and counted in filemanager.requestmetrics.  If
+    filemanager.profiledir is set every request runs under cProfile, and
+    the profile of any taking profilethreshold seconds or more is saved
+    there.  Raises KeyError if the mode isn't one of filemanager.modes.
+    
+    filemanager may be a FilemanagerPool, which picks the Filemanager and
+    calls back here with the already parsed (mode, kwargs) as arguments,
+    and for modes run in a worker process, the runner to call instead of
+    the Filemanager's method.
+    """
+    if isinstance(filemanager, FilemanagerPool):
+        return filemanager.dispatch(req, arguments)
+    
+    mode, kwargs = arguments or request_arguments(req)
+    if mode not in filemanager.modes:
+        raise KeyError(mode)
+    
+    metrics = filemanager.requestmetrics
+    method = runner or getattr(filemanager, mode)
+    profile = cProfile.Profile() if filemanager.profiledir else None
+    metrics.start()
+    metered = MeteredRequest(req, metrics)
+    start, error = time.time(), True
+    try:
+        if profile is not None:
+            status = profile.runcall(method, req=metered, **kwargs)
+        else:
+            status = method(req=metered, **kwargs)
+        status = response_status(metered, status)
+        error = False
+    finally:
+        elapsed = time.time() - start
+        metrics.finish(mode, elapsed, error)
+        if profile is not None and elapsed >= filemanager.profilethreshold:
+            profile.dump_stats(join_path(filemanager.profiledir, '%s-%d-%d.prof' % (mode, start * 1000, os.getpid())))
+    return status
+
+
+def response_status(req, status):
+    """Turns what a mode returned into the HTTP status to answer with, or None for OK.
+
+    Modes may return an HTTP status, e.g. 304 from a conditional GET.  A
+    mode refusing a path returns the (body, None, content type) of the
+    error, which is written here as a 403 response.
+    """
+    if isinstance(status, tuple):
+        body, _, ctype = status
+        req.status = HTTP_FORBIDDEN
+        req.content_type = ctype
+        req.write(body)
+        return None
+    if isinstance(status, int):
+        return status
+    return None
+
+
+class PipeRequest:
+
+    """The request a pool worker runs a mode with; its output is sent to the parent over conn.
+
+    The parent replays the messages on the client's request: ('start',
+    status, content_type, headers_out) before the first output, then
+    ('write', data) for each piece, so listings and archives are streamed
+    as they are made.  sendfile reads the file here and sends its contents,
+    so the parent never touches the worker's mount itself.
+    """
+
+    def __init__(self, conn, method, args, headers_in):
+        self.conn = conn
+        self.method = method
+        self.args = args
+        self.headers_in = headers_in
+        self.headers_out = {}
+        self.content_type = 'text/plain'
+        self.status = 200
+        self.started = False
+
+    def read(self, size=-1):
+        return '' # Any form-encoded body has been read by the parent already.
+
+    def set_content_length(self, length):
+        self.headers_out['Content-Length'] = str(length)
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.conn.send(('start', self.status, self.content_type, self.headers_out))
+
+    def write(self, data, flush=1):
+        self.start()
+        self.conn.send(('write', data))
+
+    def sendfile(self, path, offset=0, length=-1):
+        rng = FileRange(path, offset, length)
+        try:
+            for chunk in rng:
+                self.write(chunk)
+        finally:
+            rng.close()
+
+
+def pool_worker(conn, roots):
+    """Runs the requests a MountPool sends over conn until it sends None or goes away.
+
+    roots maps each root to its Filemanager options; a Filemanager is made
+    for a root the first time one of its requests arrives.  Each request is
+    answered with PipeRequest's messages and then ('done', status, counts),
+    counts being the request's metrics, or ('error', iskeyerror, message).
+    """
+    parent = os.getppid()
+    filemanagers = {}
+    while True:
+        try:
+            while not conn.poll(1):
+                if os.getppid() != parent:
+                    return
+            message = conn.recv()
+        except (EOFError, IOError):
+            return
+        if message is None:
+            return
+        root, mode, kwargs, method, args, headers_in = message
+        
+        req = PipeRequest(conn, method, args, headers_in)
+        filemanager = filemanagers.get(root)
+        try:
+            if filemanager is None:
+                filemanager = filemanagers[root] = Filemanager(fileroot=root, **dict(roots[root], watch=False))
+            filemanager.requestmetrics.start()
+            status = response_status(req, getattr(filemanager, mode)(req=req, **kwargs))
+            req.start()
+        except KeyError, e:
+            conn.send(('error', True, e.args and e.args[0]))
+            continue
+        except Exception:
+            conn.send(('error', False, traceback.format_exc()))
+            continue
+        counts = filemanager.requestmetrics.local.counts
+        filemanager.requestmetrics.local.counts = None
+        conn.send(('done', status, counts))
+
+
+class MountPool:
+
+    """Worker processes running the heavy modes for the roots on one mount.
+
+    At most workers requests run at once, one per process; processes are
+    started as they are needed.  A request that can't get a worker within
+    queuetimeout seconds is answered 503.  If a worker sends nothing for
+    timeout seconds it is killed and replaced, and its request answered 504
+    (or cut short, if the response had started), so a hung mount ties up
+    its own pool's workers and nothing else.
+    """
+
+    def __init__(self, roots, workers=4, timeout=30, queuetimeout=5):
+        self.roots = roots
+        self.workers = workers
+        self.timeout = timeout
+        self.queuetimeout = queuetimeout
+        self.idle = []
+        self.processes = set()
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """Returns an idle (process, conn), starting one if there are fewer than workers; None if none frees up in time."""
+        deadline = time.time() + self.queuetimeout
+        with self.cond:
+            while not self.idle and len(self.processes) >= self.workers:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            if self.idle:
+                return self.idle.pop()
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=pool_worker, args=(child, self.roots))
+            process.start()
+            child.close()
+            self.processes.add(process)
+            return process, conn
+
+    def release(self, worker, reuse):
+        process, conn = worker
+        if not reuse:
+            process.terminate()
+            conn.close()
+        with self.cond:
+            if reuse:
+                self.idle.append(worker)
+            else:
+                self.processes.discard(process)
+            self.cond.notify()
+
+    def run(self, root, mode, kwargs, req, metrics):
+        """Runs mode for req on a worker, replaying its output on req; returns the HTTP status, or None for OK."""
+        worker = self.acquire()
+        if worker is None:
+            return HTTP_SERVICE_UNAVAILABLE
+        conn, reuse = worker[1], False
+        try:
+            conn.send((root, mode, kwargs, req.method, req.args, dict(req.headers_in.items())))
+            while True:
+                if not conn.poll(self.timeout):
+                    return HTTP_GATEWAY_TIMEOUT
+                message = conn.recv()
+                if message[0] == 'write':
+                    req.write(message[1])
+                elif message[0] == 'start':
+                    status, req.content_type, headers = message[1:]
+                    for key, value in headers.items():
+                        req.headers_out[key] = value
+                    if status != 200:
+                        req.status = status
+                elif message[0] == 'done':
+                    reuse = True
+                    for name, value in (message[2] or {}).items():
+                        metrics.add(name, value)
+                    return message[1]
+                else:
+                    reuse = True
+                    if message[1]:
+                        raise KeyError(message[2])
+                    raise RuntimeError('%s failed in a worker process:\n%s' % (mode, message[2]))
+        finally:
+            self.release(worker, reuse)
+
+    def runner(self, root, mode, metrics):
+        """Returns a function to call in place of the Filemanager's method for mode."""
+        return lambda req, **kwargs: self.run(root, mode, kwargs, req, metrics)
+
+    def close(self):
+        with self.cond:
+            processes, self.processes, self.idle = self.processes, set(), []
+        for process in processes:
+            process.terminate()
+
+
+class FilemanagerPool:
+
+    """Serves many fileroots, each with its own Filemanager, running heavy modes in per-mount worker processes.
+
+    roots is a list of fileroots, or a dict mapping each to the options
+    for its Filemanager (added to the options given here).  The server
+    picks the root: resolve(req, mode, kwargs), typically from the
+    logged-in user, returns the request's root, or a list of the roots it
+    may use, in which case it goes to the one its path (path, currentpath
+    or old, or the first of paths) is under.  Only with routebypath does
+    the path choose among all the roots, for when every client may use
+    every root.  Otherwise the request goes to default; a request with
+    no root gets a 400.
     
+    The heavymodes run in a MountPool for the root's mount, so that a slow
+    disk only holds up requests for the roots on it.  A root's mount is the
+    longest prefix of it in mounts, a dict mapping paths to MountPool
+    options (workers, timeout, queuetimeout) overriding the ones given
+    here, or otherwise its device number.  Other modes, uploads among
+    them, run in the calling thread.  Metrics are kept for all roots
+    together.
+    """
+
+    heavymodes = frozenset(['getfolder', 'getinfo', 'multigetinfo', 'thumbnail', 'downloadarchive'])
+
+    def __init__(self, roots, default=None, resolve=None, routebypath=False, mounts=None, workers=4, timeout=30,
+                 queuetimeout=5, **options):
+        if not isinstance(roots, dict):
+            roots = dict.fromkeys(roots, {})
+        self.roots = dict((self._normalize(root), dict(options, **extra)) for root, extra in roots.items())
+        self.byprefix = sorted(self.roots, key=len, reverse=True)
+        self.default = default and self._normalize(default)
+        self.resolve = resolve
+        self.routebypath = routebypath
+        self.mounts = sorted(((self._normalize(prefix), settings) for prefix, settings in (mounts or {}).items()),
+                             key=lambda m: len(m[0]), reverse=True)
+        self.pooloptions = {'workers' : workers, 'timeout' : timeout, 'queuetimeout' : queuetimeout}
+        self.requestmetrics = Metrics()
+        self.filemanagers = {}
+        self.pools = {}
+        self.rootmounts = {}
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _normalize(path):
+        return absolute_path(path).rstrip('/') + '/'
+
+    def rootof(self, path, roots=None):
+        """Returns the root path is under, of roots if given, or None."""
+        if not isinstance(path, basestring):
+            return None
+        path = self._normalize(path)
+        for root in self.byprefix:
+            if path.startswith(root) and (roots is None or root in roots):
+                return root
+        return None
+
+    def route(self, req, mode, kwargs):
+        """Returns the root a request is for, or None."""
+        roots = frozenset(self.roots) if self.routebypath else frozenset()
+        if self.resolve is not None:
+            resolved = self.resolve(req, mode, kwargs)
+            if isinstance(resolved, basestring):
+                return self._normalize(resolved)
+            if resolved is not None:
+                roots = frozenset(self._normalize(root) for root in resolved)
+        if roots:
+            path = kwargs.get('path') or kwargs.get('currentpath') or kwargs.get('old')
+            if path is None and kwargs.get('paths'):
+                try:
+                    path = json.loads(kwargs['paths'])[0]
+                except (ValueError, TypeError, IndexError, KeyError):
+                    pass
+            root = self.rootof(path, roots)
+            if root is not None:
+                return root
+        return self.default
+
+    def filemanager(self, root):
+        with self.lock:
+            filemanager = self.filemanagers.get(root)
+            if filemanager is None:
+                filemanager = self.filemanagers[root] = Filemanager(fileroot=root, **self.roots[root])
+                filemanager.requestmetrics = self.requestmetrics
+            return filemanager
+
+    def mountpool(self, root):
+        if root not in self.rootmounts:
+            for prefix, settings in self.mounts:
+                if root.startswith(prefix):
+                    mount = prefix
+                    break
+            else:
+                settings = {}
+                try:
+                    mount = os.stat(root).st_dev
+                except OSError:
+                    mount = root
+            self.rootmounts[root] = (mount, settings)
+        mount, settings = self.rootmounts[root]
+        with self.lock:
+            pool = self.pools.get(mount)
+            if pool is None:
+                pool = self.pools[mount] = MountPool(self.roots, **dict(self.pooloptions, **settings))
+            return pool
+
+    def dispatch(self, req, arguments=None):
+        """Runs a request on its root's Filemanager, as dispatch does; raises KeyError if it has no root."""
+        mode, kwargs = arguments or request_arguments(req)
+        root = self.route(req, mode, kwargs)
+        if root not in self.roots:
+            raise KeyError(root)
+        runner = None
+        if mode in self.heavymodes:
+            runner = self.mountpool(root).runner(root, mode, self.requestmetrics)
+        return dispatch(self.filemanager(root), req, (mode, kwargs), runner)
+
+    def close(self):
+        with self.lock:
+            pools = self.pools.values()
+        for pool in pools:
+            pool.close()
+
+
+def handler(req): 
     #oldid = os.getuid()
     #os.setuid(501)
 
     try:
-        method=str(kwargs['mode'][0])
-        methodKWargs=kwargs.remove('mode')
-        methodKWargs['req']=req
-        
-        myFilemanager.__dict__['method'](**methodKWargs)
-        
-        return apache.OK 
+        return dispatch(myFilemanager, req) or apache.OK
 
 
     except KeyError:
         return apache.HTTP_BAD_REQUEST   
 
-    except Exception, (errno, strerror):
-        apache.log_error(strerror, apache.APLOG_CRIT)
+    except Exception:
+        apache.log_error(traceback.format_exc(), apache.APLOG_CRIT)
         return apache.HTTP_INTERNAL_SERVER_ERROR
 
     #os.setuid(oldid)
 
+
+
+class FileRange:
+
+    """Iterates over length bytes of a file from offset, a chunk at a time."""
+
+    def __init__(self, path, offset=0, length=-1, chunksize=262144):
+        self.f = open(path, 'rb')
+        self.f.seek(offset)
+        self.remaining = length if length >= 0 else os.fstat(self.f.fileno()).st_size - offset
+        self.chunksize = chunksize
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        data = self.f.read(min(self.chunksize, self.remaining))
+        if not data:
+            raise StopIteration
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class WSGIRequest:
+
+    """The part of mod_python's request object that Filemanager uses, over WSGI.
+
+    Output is passed to the server as it is written: the headers are sent
+    on the first write.  A whole-file sendfile before anything else has been
+    written becomes the response body itself, through wsgi.file_wrapper if
+    the server has one, so the server can send it with sendfile(2).
+    """
+
+    def __init__(self, environ, start_response):
+        self.environ = environ
+        self.start_response = start_response
+        self.method = environ['REQUEST_METHOD']
+        self.args = environ.get('QUERY_STRING', '')
+        self.headers_in = {}
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                self.headers_in[key[5:].replace('_', '-').title()] = value
+        for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if environ.get(key):
+                self.headers_in[key.replace('_', '-').title()] = environ[key]
+        self.headers_out = {}
+        self.content_type = 'text/plain'
+        self.status = 200
+        self.body = []
+        self._write = None
+
+    def read(self, size=-1):
+        return self.environ['wsgi.input'].read(size)
+
+    def set_content_length(self, length):
+        self.headers_out['Content-Length'] = str(length)
+
+    def start(self, status=None):
+        """Sends the status line and headers, if they haven't been sent yet."""
+        if self._write is None:
+            status = status or self.status
+            headers = [('Content-Type', self.content_type)] + [(k, str(v)) for k, v in self.headers_out.items()]
+            self._write = self.start_response('%d %s' % (status, httplib.responses.get(status, '')), headers)
+
+    def write(self, data, flush=1):
+        self.start()
+        self._write(data)
+
+    def sendfile(self, path, offset=0, length=-1):
+        if self._write is None and offset == 0 and length < 0:
+            f = open(path, 'rb')
+            self.start()
+            wrapper = self.environ.get('wsgi.file_wrapper')
+            self.body = wrapper(f, 262144) if wrapper else FileRange(path)
+            if not wrapper:
+                f.close()
+            return
+        rng = FileRange(path, offset, length)
+        try:
+            for chunk in rng:
+                self.write(chunk)
+        finally:
+            rng.close()
+
+
+class WSGIApplication:
+
+    """WSGI front end for a Filemanager, as an alternative to the mod_python handler.
+
+    Modes are dispatched through Filemanager.modes, as in handler.  The
+    modes that do heavy filesystem or image work are limited to
+    concurrency requests at a time, so that a burst of listings or
+    thumbnails can't tie up every server thread while cheap requests and
+    downloads wait behind them.  A FilemanagerPool limits them per mount
+    itself, so isn't limited here.
+    """
+
+    heavymodes = FilemanagerPool.heavymodes
+
+    def __init__(self, filemanager, concurrency=8):
+        self.filemanager = filemanager
+        self.limit = None
+        if not isinstance(filemanager, FilemanagerPool):
+            self.limit = threading.BoundedSemaphore(concurrency)
+
+    def __call__(self, environ, start_response):
+        req = WSGIRequest(environ, start_response)
+        heavy = False
+        try:
+            # Parsed here, so that a mode POSTed in a form body counts as heavy too.
+            arguments = request_arguments(req)
+            heavy = self.limit is not None and arguments[0] in self.heavymodes
+            if heavy:
+                self.limit.acquire()
+            status = dispatch(self.filemanager, req, arguments)
+        except KeyError:
+            status = 400
+        except Exception:
+            environ['wsgi.errors'].write(traceback.format_exc())
+            status = 500
+        finally:
+            if heavy:
+                self.limit.release()
+        req.start(status)
+        return req.body
+
+
+application = WSGIApplication(myFilemanager)
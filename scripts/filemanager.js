@@ -635,6 +635,14 @@ $(function(){
 
 	$('#uploader').ajaxForm({
 		target: '#uploadresponse',
+		beforeSerialize: function(form, options){
+			// The python connector also gets the folder in the query
+			// string, so that a pool of several roots can route the
+			// upload before reading its body.
+			if (lang == "py") {
+				options.url = fileConnector + '?currentpath=' + encodeURIComponent($('#currentpath').val());
+			}
+		},
 		success: function(result){
 			eval('var data = ' + $('#uploadresponse').find('textarea').text());
 
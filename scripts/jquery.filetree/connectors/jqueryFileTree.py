@@ -3,23 +3,114 @@
 # Python/Django connector script
 # By Martin Skou
 #
+# Listings are read with scandir, whose entries know whether they are
+# directories without a stat each, and the rendered <ul> fragments are
+# cached until a directory they list changes. Responses carry an ETag, so
+# a client that GETs the tree can be answered 304. With depth=N in the
+# request, folders are listed N levels down; the levels below the first are
+# sent hidden, for jqueryFileTree.js to show without another request.
+#
+import cgi
+import hashlib
 import os
+import threading
 import urllib
+from collections import OrderedDict
+
+from django.http import HttpResponse, HttpResponseNotModified
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # The backport from PyPI, for Python < 3.5.
+    except ImportError:
+        scandir = None
+
+MAX_DEPTH = 4
+MAX_FRAGMENTS = 1000
+
+# (dir, depth): (stamps, etag, html), where stamps is [(path, stamp)] for
+# each directory the fragment lists; most recently used last.
+_fragments = OrderedDict()
+_lock = threading.Lock()
+
+
+def _stamp(path):
+    """Changes whenever an entry is added to, removed from or renamed in the directory."""
+    st = os.stat(path)
+    return (st.st_mtime, st.st_ino)
+
+
+def _entries(d):
+    """Returns (name, isdir) for the entries in directory d, sorted folders first."""
+    if scandir is not None:
+        entries = [(e.name, e.is_dir()) for e in scandir(d)]
+    else:
+        entries = [(f, os.path.isdir(os.path.join(d, f))) for f in os.listdir(d)]
+    entries.sort(key=lambda e: (not e[1], e[0].lower()))
+    return entries
+
+
+def _render(d, depth, stamps, r, hidden_class=''):
+    stamps.append((d, _stamp(d)))
+    r.append('<ul class="jqueryFileTree%s" style="display: none;">' % hidden_class)
+    for f, isdir in _entries(d):
+        ff = cgi.escape(os.path.join(d, f), True)
+        if isdir:
+            r.append('<li class="directory collapsed"><a href="#" rel="%s/">%s</a>' % (ff, cgi.escape(f)))
+            if depth > 1:
+                try:
+                    _render(os.path.join(d, f), depth - 1, stamps, r, ' prefetched')
+                except OSError:
+                    pass # Unreadable; it's fetched, and the error shown, when expanded.
+            r.append('</li>')
+        else:
+            e = os.path.splitext(f)[1][1:] # get .ext and remove dot
+            r.append('<li class="file ext_%s"><a href="#" rel="%s">%s</a></li>' % (cgi.escape(e, True), ff, cgi.escape(f)))
+    r.append('</ul>')
+
+
+def fragment(d, depth=1):
+    """Returns (etag, html) of the listing of directory d, from the cache while it's current."""
+    key = (d, depth)
+    with _lock:
+        cached = _fragments.pop(key, None)
+        if cached is not None:
+            _fragments[key] = cached
+    if cached is not None:
+        stamps, etag, html = cached
+        try:
+            if all(_stamp(path) == stamp for path, stamp in stamps):
+                return etag, html
+        except OSError:
+            pass
+    stamps, r = [], []
+    _render(d, depth, stamps, r)
+    html = ''.join(r)
+    etag = '"%s"' % hashlib.sha1(repr(stamps) + html).hexdigest()[:16]
+    with _lock:
+        _fragments[key] = (stamps, etag, html)
+        while len(_fragments) > MAX_FRAGMENTS:
+            _fragments.popitem(last=False)
+    return etag, html
+
 
 def dirlist(request):
-   r=['<ul class="jqueryFileTree" style="display: none;">']
-   try:
-       r=['<ul class="jqueryFileTree" style="display: none;">']
-       d=urllib.unquote(request.POST.get('dir','c:\\temp'))
-       for f in os.listdir(d):
-           ff=os.path.join(d,f)
-           if os.path.isdir(ff):
-               r.append('<li class="directory collapsed"><a href="#" rel="%s/">%s</a></li>' % (ff,f))
-           else:
-               e=os.path.splitext(f)[1][1:] # get .ext and remove dot
-               r.append('<li class="file ext_%s"><a href="#" rel="%s">%s</a></li>' % (e,ff,f))
-       r.append('</ul>')
-   except Exception,e:
-       r.append('Could not load directory: %s' % str(e))
-   r.append('</ul>')
-   return HttpResponse(''.join(r))
\ No newline at end of file
+    params = request.POST if request.method == 'POST' else request.GET
+    d = urllib.unquote(params.get('dir', 'c:\\temp'))
+    try:
+        depth = max(1, min(MAX_DEPTH, int(params.get('depth', 1))))
+    except ValueError:
+        depth = 1
+    try:
+        etag, html = fragment(d, depth)
+    except Exception, e:
+        return HttpResponse('<ul class="jqueryFileTree" style="display: none;">Could not load directory: %s</ul>' % cgi.escape(str(e)))
+    if etag in [t.strip() for t in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(html)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
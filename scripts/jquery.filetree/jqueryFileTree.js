@@ -19,6 +19,8 @@
 //           collapseEasing - easing function to use on collapse (optional)
 //           multiFolder    - whether or not to limit the browser to one subfolder at a time
 //           loadMessage    - Message to display while initial tree loads (can be HTML)
+//           depth          - levels of folders to fetch in one request, if the connector supports it; default = 1
+//           method         - HTTP method for requests; GET lets connectors answer unchanged folders with 304; default = POST
 //
 // History:
 //
@@ -45,6 +47,8 @@ if(jQuery) (function($){
 			if( o.collapseEasing == undefined ) o.collapseEasing = null;
 			if( o.multiFolder == undefined ) o.multiFolder = true;
 			if( o.loadMessage == undefined ) o.loadMessage = 'Loading...';
+			if( o.depth == undefined ) o.depth = 1;
+			if( o.method == undefined ) o.method = 'POST';
 			if( o.folderCallback == undefined ) o.folderCallback = null;
 			if( o.after == undefined ) o.after = null;
 			
@@ -53,13 +57,15 @@ if(jQuery) (function($){
 				function showTree(c, t) {
 					$(c).addClass('wait');
 					$(".jqueryFileTree.start").remove();
-					$.post(o.script, { dir: t }, function(data) {
+					var params = { dir: t };
+					if( o.depth > 1 ) params.depth = o.depth;
+					$.ajax({ type: o.method, url: o.script, data: params, success: function(data) {
 						$(c).find('.start').html('');
 						$(c).removeClass('wait').append(data);
-						if( o.root == t ) $(c).find('UL:hidden').show(); else $(c).find('UL:hidden').slideDown({ duration: o.expandSpeed, easing: o.expandEasing });
+						if( o.root == t ) $(c).children('UL:hidden').show(); else $(c).children('UL:hidden').slideDown({ duration: o.expandSpeed, easing: o.expandEasing });
 						bindTree(c);
-						o.after(data);
-					});
+						if( o.after ) o.after(data);
+					}});
 				}
 				
 				function bindTree(t) {
@@ -71,11 +77,17 @@ if(jQuery) (function($){
 									$(this).parent().parent().find('UL').slideUp({ duration: o.collapseSpeed, easing: o.collapseEasing });
 									$(this).parent().parent().find('LI.directory').removeClass('expanded').addClass('collapsed');
 								}
-								$(this).parent().find('UL').remove(); // cleanup
-								showTree( $(this).parent(), escape($(this).attr('rel').match( /.*\// )) );
+								var prefetched = $(this).parent().children('UL.prefetched');
+								if( prefetched.length ) {
+									// Listed with its parent; show it without another request
+									prefetched.removeClass('prefetched').slideDown({ duration: o.expandSpeed, easing: o.expandEasing });
+								} else {
+									$(this).parent().find('UL').remove(); // cleanup
+									showTree( $(this).parent(), escape($(this).attr('rel').match( /.*\// )) );
+								}
 								$(this).parent().removeClass('collapsed').addClass('expanded');
 								
-								o.folderCallback($(this).attr('rel'));
+								if( o.folderCallback ) o.folderCallback($(this).attr('rel'));
 							} else {
 								// Collapse
 								$(this).parent().find('UL').slideUp({ duration: o.collapseSpeed, easing: o.collapseEasing });
@@ -0,0 +1,151 @@
+"""An in-memory stand-in for a boto3 S3 client, for running S3Storage without S3.
+
+It has just the calls S3Storage makes, with the arguments, results and
+errors boto3 gives for them.  The tests and benchmarks/suite.py use it.
+"""
+import bisect, datetime, hashlib
+
+
+class ClientError(Exception):
+    """Stands in for botocore's ClientError, which carries the S3 error code in its response."""
+
+    def __init__(self, code, operation):
+        Exception.__init__(self, 'An error occurred (%s) when calling the %s operation' % (code, operation))
+        self.response = {'Error' : {'Code' : code}}
+
+
+class StreamingBody:
+    """The Body of a get_object response."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, amt=None):
+        end = len(self.data) if amt is None else self.pos + amt
+        data = self.data[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class FakeS3Client:
+    """Buckets of objects kept in dicts, with each bucket's keys also kept sorted for listing.
+
+    calls counts the requests made, by operation, so tests can check how
+    many round trips something takes.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.keys = {}
+        self.calls = {}
+
+    def _count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def _objects(self, bucket):
+        if bucket not in self.buckets:
+            self.buckets[bucket] = {}
+            self.keys[bucket] = []
+        return self.buckets[bucket]
+
+    def _get(self, bucket, key, operation):
+        try:
+            return self._objects(bucket)[key]
+        except KeyError:
+            raise ClientError('404' if operation == 'HeadObject' else 'NoSuchKey', operation)
+
+    def _put(self, bucket, key, data):
+        objects = self._objects(bucket)
+        if key not in objects:
+            bisect.insort(self.keys[bucket], key)
+        objects[key] = {
+            'Body' : data,
+            'LastModified' : datetime.datetime.utcnow(),
+            'ETag' : '"%s"' % hashlib.md5(data).hexdigest(),
+        }
+
+    def head_object(self, Bucket, Key):
+        self._count('HeadObject')
+        obj = self._get(Bucket, Key, 'HeadObject')
+        return {'ContentLength' : len(obj['Body']), 'LastModified' : obj['LastModified'], 'ETag' : obj['ETag']}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._count('GetObject')
+        obj = self._get(Bucket, Key, 'GetObject')
+        data = obj['Body']
+        if Range:
+            first, last = Range[len('bytes='):].split('-')
+            data = data[int(first):int(last) + 1 if last else len(data)]
+        return {'Body' : StreamingBody(data), 'ContentLength' : len(data),
+                'LastModified' : obj['LastModified'], 'ETag' : obj['ETag']}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter='', MaxKeys=1000, ContinuationToken=None, StartAfter=None):
+        """Lists keys in order, rolling those with Delimiter after Prefix up into CommonPrefixes.
+
+        The continuation token is the last key or common prefix returned.
+        """
+        self._count('ListObjectsV2')
+        self._objects(Bucket)
+        keys = self.keys[Bucket]
+        after = ContinuationToken or StartAfter
+        i = bisect.bisect_left(keys, Prefix)
+        if after is not None:
+            i = max(i, bisect.bisect_right(keys, after))
+            if Delimiter and after.endswith(Delimiter) and after != Prefix:
+                while i < len(keys) and keys[i].startswith(after):
+                    i += 1
+        contents, prefixes, last, truncated = [], [], None, False
+        while i < len(keys) and keys[i].startswith(Prefix):
+            if len(contents) + len(prefixes) == MaxKeys:
+                truncated = True
+                break
+            key = keys[i]
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                last = key[:len(Prefix) + rest.index(Delimiter) + len(Delimiter)]
+                prefixes.append({'Prefix' : last})
+                while i < len(keys) and keys[i].startswith(last):
+                    i += 1
+                continue
+            obj = self.buckets[Bucket][key]
+            contents.append({'Key' : key, 'Size' : len(obj['Body']), 'LastModified' : obj['LastModified'],
+                             'ETag' : obj['ETag']})
+            last = key
+            i += 1
+        page = {'KeyCount' : len(contents) + len(prefixes), 'IsTruncated' : truncated, 'Prefix' : Prefix,
+                'MaxKeys' : MaxKeys}
+        if contents:
+            page['Contents'] = contents
+        if prefixes:
+            page['CommonPrefixes'] = prefixes
+        if truncated:
+            page['NextContinuationToken'] = last
+        return page
+
+    def put_object(self, Bucket, Key, Body=''):
+        self._count('PutObject')
+        self._put(Bucket, Key, Body if isinstance(Body, str) else Body.read())
+        return {'ETag' : self.buckets[Bucket][Key]['ETag']}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self._count('PutObject')
+        self._put(Bucket, Key, Fileobj.read())
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self._count('CopyObject')
+        self._put(Bucket, Key, self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')['Body'])
+        return {'CopyObjectResult' : {'ETag' : self.buckets[Bucket][Key]['ETag']}}
+
+    def delete_object(self, Bucket, Key):
+        """Deletes the object, if there is one; like S3, a missing key isn't an error."""
+        self._count('DeleteObject')
+        objects = self._objects(Bucket)
+        if Key in objects:
+            del objects[Key]
+            keys = self.keys[Bucket]
+            del keys[bisect.bisect_left(keys, Key)]
+        return {}
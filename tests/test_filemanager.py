@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+"""Tests of the python connector.
+
+Run from the repository root with: python -m unittest discover tests
+"""
+import hashlib, json, os, shutil, StringIO, struct, sys, tempfile, time, unittest, zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'connectors', 'python'))
+import filemanager
+
+
+class FakeRequest:
+    """Enough of a mod_python request for the connector's modes; the body is kept in out."""
+
+    def __init__(self, body='', headers=None, args=''):
+        self.headers_in = headers or {}
+        self.headers_out = {}
+        self.content_type = None
+        self.status = 200
+        self.method = 'POST' if body else 'GET'
+        self.args = args
+        self.out = []
+        self._body = StringIO.StringIO(body)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def write(self, data, flush=1):
+        self.out.append(data)
+
+    def set_content_length(self, length):
+        self.headers_out['Content-Length'] = str(length)
+
+    def sendfile(self, path, offset=0, length=-1):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            self.out.append(f.read() if length < 0 else f.read(length))
+
+    def body(self):
+        return ''.join(self.out)
+
+
+class TempRootTestCase(unittest.TestCase):
+    """Gives each test a temporary folder, self.base, with a fileroot in it."""
+
+    def setUp(self):
+        self.base = os.path.realpath(tempfile.mkdtemp())
+        self.root = os.path.join(self.base, 'root') + '/'
+        os.mkdir(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def write(self, path, data=''):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+class PathValidationTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        self.fm = filemanager.Filemanager(fileroot=self.root, searchindex=False)
+        os.mkdir(os.path.join(self.base, 'root2'))
+        self.secret = os.path.join(self.base, 'root2', 'secret.txt')
+        self.write(self.secret, 'secret')
+        self.write(self.root + 'public.txt', 'public')
+
+    def test_paths_in_root(self):
+        req = FakeRequest()
+        self.assertTrue(self.fm.isvalidrequest(self.root, req))
+        self.assertTrue(self.fm.isvalidrequest(self.root.rstrip('/'), req))
+        self.assertTrue(self.fm.isvalidrequest(self.root + 'public.txt', req))
+        self.assertTrue(self.fm.isvalidrequest(self.root + 'new/folder', req))
+
+    def test_sibling_with_root_as_prefix(self):
+        self.assertFalse(self.fm.isvalidrequest(self.secret, FakeRequest()))
+        req = FakeRequest()
+        self.fm.getinfo(path=self.secret, req=req)
+        self.assertNotIn('secret', req.body())
+        req = FakeRequest()
+        self.fm.download(path=self.secret, req=req)
+        self.assertNotIn('secret', req.body())
+
+    def test_dotdot_out_of_root(self):
+        self.assertFalse(self.fm.isvalidrequest(self.root + '../root2/secret.txt', FakeRequest()))
+
+    def test_symlink_out_of_root(self):
+        os.symlink(os.path.join(self.base, 'root2'), self.root + 'link')
+        os.symlink(self.secret, self.root + 'file-link')
+        self.assertFalse(self.fm.isvalidrequest(self.root + 'link/secret.txt', FakeRequest()))
+        self.assertFalse(self.fm.isvalidrequest(self.root + 'file-link', FakeRequest()))
+        req = FakeRequest()
+        self.fm.download(path=self.root + 'file-link', req=req)
+        self.assertNotIn('secret', req.body())
+
+    def test_symlink_within_root(self):
+        os.mkdir(self.root + 'sub')
+        os.symlink(self.root + 'sub', self.root + 'alias')
+        self.assertTrue(self.fm.isvalidrequest(self.root + 'alias', FakeRequest()))
+
+    def test_sidecar_files_refused(self):
+        for name in ('.filemanager-imagesizes.sqlite', '.filemanager-usage.sqlite',
+                     '.filemanager-blobs/index.sqlite', '.filemanager-thumbnails/ab/x.jpg'):
+            self.assertFalse(self.fm.isvalidrequest(self.root + name, FakeRequest()), name)
+
+
+class PagingTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        self.fm = filemanager.Filemanager(fileroot=self.root, searchindex=False)
+        for i in xrange(10):
+            self.write(self.root + 'file%02d' % i)
+
+    def page(self, cursor=None, limit=4):
+        req = FakeRequest()
+        self.fm.getfolder(path=self.root, cursor=cursor, limit=str(limit), req=req)
+        return sorted(os.path.basename(p) for p in json.loads(req.body())), req.headers_out.get('X-Filemanager-Cursor')
+
+    def test_pages_cover_folder(self):
+        names, cursor = [], None
+        while True:
+            page, cursor = self.page(cursor)
+            names.extend(page)
+            if cursor is None:
+                break
+        self.assertEqual(names, ['file%02d' % i for i in xrange(10)])
+
+    def test_vanished_entry_keeps_cursor(self):
+        storage = self.fm.storage
+        stat = storage.stat
+        def vanishing(path, follow_symlinks=True):
+            if path.endswith('file03'):
+                raise OSError(2, 'No such file or directory', path)
+            return stat(path, follow_symlinks)
+        storage.stat = vanishing
+        page, cursor = self.page()
+        self.assertEqual(page, ['file00', 'file01', 'file02'])
+        self.assertEqual(cursor, 'file03')
+        self.assertEqual(self.page(cursor)[0], ['file04', 'file05', 'file06', 'file07'])
+
+
+class ImageSizeTest(TempRootTestCase):
+
+    def size(self, name, data):
+        self.write(self.root + name, data)
+        return filemanager.read_image_size(self.root + name)
+
+    def test_png(self):
+        data = '\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + 'IHDR' + struct.pack('>II', 640, 480) + '\x08\x02\0\0\0'
+        self.assertEqual(self.size('a.png', data), (640, 480))
+
+    def test_gif(self):
+        self.assertEqual(self.size('a.gif', 'GIF89a' + struct.pack('<HH', 320, 200) + '\0' * 16), (320, 200))
+        self.assertEqual(self.size('b.gif', 'GIF87a' + struct.pack('<HH', 1, 2) + '\0' * 16), (1, 2))
+
+    def test_bmp(self):
+        header = 'BM' + '\0' * 12
+        info = struct.pack('<Iii', 40, 100, -50) + '\0' * 28
+        self.assertEqual(self.size('top-down.bmp', header + info), (100, 50))
+        core = struct.pack('<IHH', 12, 30, 40) + '\0' * 4
+        self.assertEqual(self.size('os2.bmp', header + core + '\0' * 8), (30, 40))
+
+    def test_webp(self):
+        def riff(chunk, payload):
+            return 'RIFF' + struct.pack('<I', 4 + 8 + len(payload)) + 'WEBP' + chunk + struct.pack('<I', len(payload)) + payload
+        lossy = '\0\0\0' + '\x9d\x01\x2a' + struct.pack('<HH', 800 | 0x4000, 600) + '\0' * 4
+        self.assertEqual(self.size('lossy.webp', riff('VP8 ', lossy)), (800, 600))
+        lossless = '\x2f' + struct.pack('<I', (800 - 1) | (600 - 1) << 14) + '\0' * 8
+        self.assertEqual(self.size('lossless.webp', riff('VP8L', lossless)), (800, 600))
+        extended = '\0' * 4 + struct.pack('<I', 70000 - 1)[:3] + struct.pack('<I', 2 - 1)[:3] + '\0' * 4
+        self.assertEqual(self.size('extended.webp', riff('VP8X', extended)), (70000, 2))
+
+    def test_jpeg(self):
+        app0 = '\xff\xe0' + struct.pack('>H', 16) + 'JFIF\0' + '\0' * 9
+        padding = '\xff\xff'
+        sof = '\xff\xc2' + struct.pack('>HBHHB', 11, 8, 480, 640, 1) + '\0' * 3
+        self.assertEqual(self.size('a.jpg', '\xff\xd8' + app0 + padding + sof + '\xff\xd9'), (640, 480))
+        self.assertEqual(self.size('truncated.jpg', '\xff\xd8' + app0[:10]), None)
+
+    def test_not_an_image(self):
+        self.assertEqual(self.size('a.txt', 'just some text, not an image at all'), None)
+        self.assertEqual(self.size('empty.png', ''), None)
+
+
+class DownloadTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        self.fm = filemanager.Filemanager(fileroot=self.root, searchindex=False)
+        self.path = self.root + 'digits.txt'
+        self.write(self.path, '0123456789')
+
+    def download(self, **headers):
+        """Downloads the file with the given request headers; returns the mode's result and the request."""
+        req = FakeRequest(headers=headers)
+        return self.fm.download(path=self.path, req=req), req
+
+    def test_parse_range(self):
+        self.assertEqual(filemanager.parse_range(None, 10), None)
+        self.assertEqual(filemanager.parse_range('items=0-1', 10), None)
+        self.assertEqual(filemanager.parse_range('bytes=2-4', 10), [(2, 4)])
+        self.assertEqual(filemanager.parse_range('bytes=7-', 10), [(7, 9)])
+        self.assertEqual(filemanager.parse_range('bytes=-3', 10), [(7, 9)])
+        self.assertEqual(filemanager.parse_range('bytes=-30', 10), [(0, 9)])
+        self.assertEqual(filemanager.parse_range('bytes=5-100', 10), [(5, 9)])
+        self.assertEqual(filemanager.parse_range('bytes=6-8, 0-1, 2-3, 7-9', 10), [(0, 3), (6, 9)])
+        self.assertEqual(filemanager.parse_range('bytes=10-, 4-2, -0', 10), [])
+        self.assertEqual(filemanager.parse_range('bytes=x-1', 10), None)
+        self.assertEqual(filemanager.parse_range('bytes=0-0,2-2,4-4', 10, maxranges=2), None)
+
+    def test_whole_file(self):
+        status, req = self.download()
+        self.assertEqual((status, req.status, req.body()), (None, 200, '0123456789'))
+        self.assertEqual(req.headers_out['Content-Length'], '10')
+        self.assertEqual(req.headers_out['Accept-Ranges'], 'bytes')
+
+    def test_single_range(self):
+        status, req = self.download(Range='bytes=2-4')
+        self.assertEqual((req.status, req.body()), (filemanager.HTTP_PARTIAL_CONTENT, '234'))
+        self.assertEqual(req.headers_out['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(req.headers_out['Content-Length'], '3')
+
+    def test_multiple_ranges(self):
+        status, req = self.download(Range='bytes=0-1,-2')
+        self.assertEqual(req.status, filemanager.HTTP_PARTIAL_CONTENT)
+        self.assertTrue(req.content_type.startswith('multipart/byteranges; boundary='))
+        boundary = req.content_type.split('=', 1)[1]
+        parts = req.body().split('\r\n--' + boundary)
+        self.assertEqual((parts[0], parts[-1]), ('', '--\r\n'))
+        self.assertEqual([p.split('\r\n\r\n', 1)[1] for p in parts[1:-1]], ['01', '89'])
+        self.assertIn('Content-Range: bytes 0-1/10', parts[1])
+        self.assertIn('Content-Range: bytes 8-9/10', parts[2])
+
+    def test_unsatisfiable_range(self):
+        status, req = self.download(Range='bytes=20-30')
+        self.assertEqual((status, req.body()), (filemanager.HTTP_RANGE_NOT_SATISFIABLE, ''))
+        self.assertEqual(req.headers_out['Content-Range'], 'bytes */10')
+
+    def test_stale_if_range_sends_everything(self):
+        status, req = self.download(Range='bytes=2-4', **{'If-Range' : '"stale"'})
+        self.assertEqual((req.status, req.body()), (200, '0123456789'))
+
+    def test_not_modified(self):
+        headers = self.download()[1].headers_out
+        for validators in ({'If-None-Match' : headers['ETag']}, {'If-None-Match' : '"other", ' + headers['ETag']},
+                           {'If-Modified-Since' : headers['Last-Modified']}):
+            status, req = self.download(**validators)
+            self.assertEqual((status, req.body()), (filemanager.HTTP_NOT_MODIFIED, ''), validators)
+            self.assertEqual(req.headers_out['ETag'], headers['ETag'])
+        for validators in ({'If-None-Match' : '"other"'}, {'If-Modified-Since' : filemanager.http_date(time.time() - 3600)},
+                           {'If-None-Match' : '"other"', 'If-Modified-Since' : headers['Last-Modified']}):
+            status, req = self.download(**validators)
+            self.assertEqual((status, req.body()), (None, '0123456789'), validators)
+
+
+class SearchIndexTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        os.makedirs(self.root + 'Reports/2019')
+        for path in ('Reports/Annual-Report.PDF', 'Reports/2019/summary.pdf', 'Reports/2019/report.docx',
+                     'notes.txt', 'preport.txt', '.hidden-report.pdf'):
+            self.write(self.root + path)
+        self.index = filemanager.SearchIndex(os.path.join(self.base, 'index.sqlite'), self.root)
+        self.index.update(recursive=True)
+
+    def search(self, query, match='substring', folder=None):
+        return [p[len(self.root):] for p in self.index.search(query, match, folder)]
+
+    def test_prefix(self):
+        self.assertEqual(self.search('rep', 'prefix'), ['Reports', 'Reports/2019/report.docx'])
+        self.assertEqual(self.search('ANNUAL', 'prefix'), ['Reports/Annual-Report.PDF'])
+        self.assertEqual(self.search('x', 'prefix'), [])
+
+    def test_substring(self):
+        self.assertEqual(self.search('report'), ['Reports', 'Reports/2019/report.docx', 'Reports/Annual-Report.PDF',
+                                                 'preport.txt'])
+        self.assertEqual(self.search('-R'), ['Reports/Annual-Report.PDF'])
+        self.assertEqual(self.search('report', folder=self.root + 'Reports/2019'), ['Reports/2019/report.docx'])
+        self.assertEqual(self.search('reportx'), [])
+
+    def test_extension(self):
+        self.assertEqual(self.search('pdf', 'extension'), ['Reports/2019/summary.pdf', 'Reports/Annual-Report.PDF'])
+        self.assertEqual(self.search('.TXT', 'extension'), ['notes.txt', 'preport.txt'])
+
+    def test_changes(self):
+        self.write(self.root + 'Reports/2019/draft.pdf')
+        self.index.added(self.root + 'Reports/2019/draft.pdf')
+        os.rename(self.root + 'Reports', self.root + 'Archive')
+        self.index.moved(self.root + 'Reports', self.root + 'Archive')
+        os.remove(self.root + 'notes.txt')
+        self.index.removed(self.root + 'notes.txt')
+        self.assertEqual(self.search('pdf', 'extension'), ['Archive/2019/draft.pdf', 'Archive/2019/summary.pdf',
+                                                           'Archive/Annual-Report.PDF'])
+        self.assertEqual(self.search('arch', 'prefix'), ['Archive'])
+        self.assertEqual(self.search('txt', 'extension'), ['preport.txt'])
+
+    def test_update_finds_changes(self):
+        self.write(self.root + 'Reports/new-report.txt')
+        shutil.rmtree(self.root + 'Reports/2019')
+        self.index.update(recursive=True)
+        self.assertEqual(self.search('report'), ['Reports', 'Reports/Annual-Report.PDF', 'Reports/new-report.txt',
+                                                 'preport.txt'])
+
+
+def upload(fm, data, folder, name='new.txt'):
+    """Uploads data as name into folder with the add mode, and returns the result object."""
+    body = ('--b\r\nContent-Disposition: form-data; name="currentpath"\r\n\r\n%s\r\n'
+            '--b\r\nContent-Disposition: form-data; name="newfile"; filename="%s"\r\n'
+            'Content-Type: text/plain\r\n\r\n%s\r\n--b--\r\n') % (folder, name, data)
+    req = FakeRequest(body, {'Content-Type' : 'multipart/form-data; boundary=b',
+                             'Content-Length' : str(len(body))})
+    fm.add(req=req)
+    return json.loads(req.body()[len('<textarea>'):-len('</textarea>')])
+
+
+class UploadTest(TempRootTestCase):
+
+    def test_upload(self):
+        fm = filemanager.Filemanager(fileroot=self.root, searchindex=False, quota=1000)
+        result = upload(fm, 'hello', self.root)
+        self.assertEqual((result['Code'], result['Path'], result['Name']), (0, self.root, 'new.txt'))
+        self.assertEqual(open(self.root + 'new.txt').read(), 'hello')
+
+    def test_over_quota_reports_the_folder(self):
+        fm = filemanager.Filemanager(fileroot=self.root, searchindex=False, quota=10)
+        result = upload(fm, 'x' * 100, self.root)
+        self.assertEqual(result['Code'], -1)
+        self.assertEqual(result['Error'], 'Quota exceeded.')
+        self.assertEqual(result['Path'], self.root)
+        self.assertFalse(os.path.exists(self.root + 'new.txt'))
+
+    def test_multipart_across_reads(self):
+        body = ('preamble\r\n--XyZ\r\nContent-Disposition: form-data; name="currentpath"\r\n\r\n/a/\r\n'
+                '--XyZ\r\nContent-Disposition: form-data; name="newfile"; filename="f.bin"\r\n\r\n'
+                + 'x\r\n--XY' * 50 + '\r\n--XyZ--\r\n')
+        # Every read size puts the delimiters somewhere else across reads.
+        for size in (1, 2, 3, 7, 16, 64, len(body)):
+            f = StringIO.StringIO(body)
+            reader = filemanager.MultipartReader(f.read, 'XyZ', len(body), chunksize=size)
+            parts = [(name, filename, ''.join(chunks)) for name, filename, chunks in reader.parts()]
+            self.assertEqual(parts, [('currentpath', None, '/a/'), ('newfile', 'f.bin', 'x\r\n--XY' * 50)], size)
+
+    def test_multipart_truncated(self):
+        body = '--XyZ\r\nContent-Disposition: form-data; name="newfile"; filename="f"\r\n\r\nabc'
+        reader = filemanager.MultipartReader(StringIO.StringIO(body).read, 'XyZ', len(body), chunksize=4)
+        self.assertRaises(ValueError, lambda: [''.join(chunks) for _, _, chunks in reader.parts()])
+
+    def chunk(self, fm, data, offset, total, uploadid='upload0001'):
+        req = FakeRequest(data, {'Content-Length' : str(len(data))})
+        fm.addchunk(path=self.root, name='big.bin', uploadid=uploadid, offset=str(offset), total=str(total), req=req)
+        return json.loads(req.body())
+
+    def partials(self):
+        return [n for n in os.listdir(self.root) if n.endswith('.part')]
+
+    def test_addchunk_resume(self):
+        fm = filemanager.Filemanager(fileroot=self.root, searchindex=False, quota=1000)
+        result = self.chunk(fm, 'abcd', 0, 10)
+        self.assertEqual((result['Code'], result['Offset'], result['Complete']), (0, 4, False))
+        self.assertEqual(fm.ledger.usage()[2], 10)
+        req = FakeRequest()
+        fm.uploadstatus(path=self.root, uploadid='upload0001', req=req)
+        self.assertEqual(json.loads(req.body())['Offset'], 4)
+        result = self.chunk(fm, 'efghij', 4, 10)
+        self.assertEqual((result['Code'], result['Offset'], result['Complete']), (0, 10, True))
+        self.assertEqual(open(self.root + 'big.bin').read(), 'abcdefghij')
+        self.assertEqual(self.partials(), [])
+        self.assertEqual(tuple(fm.ledger.usage())[::2], (10, 0))
+
+    def test_addchunk_wrong_offset(self):
+        fm = filemanager.Filemanager(fileroot=self.root, searchindex=False, quota=1000)
+        result = self.chunk(fm, 'efgh', 4, 10)
+        self.assertEqual((result['Code'], result['Offset']), (-1, 0))
+        self.assertEqual(self.partials(), [])
+        self.assertEqual(fm.ledger.usage()[2], 0)
+        self.chunk(fm, 'abcd', 0, 10)
+        result = self.chunk(fm, 'ijkl', 8, 10)
+        self.assertEqual((result['Code'], result['Error'], result['Offset']), (-1, 'Expected offset 4.', 4))
+        self.assertEqual(os.path.getsize(self.root + self.partials()[0]), 4)
+
+    def test_addchunk_name_taken(self):
+        fm = filemanager.Filemanager(fileroot=self.root, searchindex=False, quota=1000)
+        self.chunk(fm, 'abcd', 0, 10)
+        self.write(self.root + 'big.bin', 'taken')
+        result = self.chunk(fm, 'efghij', 4, 10)
+        self.assertEqual((result['Code'], result['Complete']), (-1, False))
+        self.assertEqual(open(self.root + 'big.bin').read(), 'taken')
+        self.assertEqual(self.partials(), [])
+        self.assertEqual(fm.ledger.usage()[2], 0)
+
+
+class BlobStoreTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        self.fm = filemanager.Filemanager(fileroot=self.root, searchindex=False, dedup=True)
+        self.blob = self.fm.blobs.path(hashlib.sha256('same').hexdigest())
+
+    def call(self, mode, **kwargs):
+        req = FakeRequest()
+        getattr(self.fm, mode)(req=req, **kwargs)
+        return json.loads(req.body())
+
+    def test_links_and_release(self):
+        for name in ('a.txt', 'b.txt'):
+            self.assertEqual(upload(self.fm, 'same', self.root, name)['Code'], 0)
+        upload(self.fm, 'other', self.root, 'c.txt')
+        a, b = os.stat(self.root + 'a.txt'), os.stat(self.root + 'b.txt')
+        self.assertEqual((a.st_ino, a.st_nlink), (b.st_ino, 3))
+        self.assertEqual(os.stat(self.blob).st_ino, a.st_ino)
+        self.assertEqual(os.stat(self.root + 'c.txt').st_nlink, 2)
+        stats = self.call('dedupstats')
+        self.assertEqual((stats['Blobs'], stats['Stored'], stats['Referenced']), (2, 9, 13))
+        
+        self.assertEqual(self.call('delete', path=self.root + 'a.txt')['Code'], 0)
+        self.assertEqual(os.stat(self.root + 'b.txt').st_nlink, 2)
+        self.assertTrue(os.path.exists(self.blob))
+        self.assertEqual(self.call('delete', path=self.root + 'b.txt')['Code'], 0)
+        self.assertFalse(os.path.exists(self.blob))
+        stats = self.call('dedupstats')
+        self.assertEqual((stats['Blobs'], stats['Stored'], stats['Referenced']), (1, 5, 5))
+        
+        upload(self.fm, 'same', self.root, 'd.txt')
+        self.assertEqual(os.stat(self.root + 'd.txt').st_nlink, 2)
+        self.assertEqual(open(self.root + 'd.txt').read(), 'same')
+
+    def test_collect(self):
+        upload(self.fm, 'same', self.root, 'a.txt')
+        os.remove(self.root + 'a.txt')
+        self.fm.blobs.collect()
+        self.assertFalse(os.path.exists(self.blob))
+        self.assertEqual(self.call('dedupstats')['Blobs'], 0)
+
+
+class FolderSizesTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        self.fm = filemanager.Filemanager(fileroot=self.root, searchindex=False)
+        os.makedirs(self.root + 'docs/sub')
+        self.write(self.root + 'docs/a.txt', 'a' * 10)
+        self.write(self.root + 'docs/sub/b.txt', 'b' * 5)
+
+    def sizes(self):
+        req = FakeRequest()
+        self.fm.getfolder(path=self.root, req=req)
+        return dict((os.path.basename(p.rstrip('/')), (i['Properties']['Size'], i['Properties'].get('Files')))
+                    for p, i in json.loads(req.body()).items() if i['File Type'] == 'dir')
+
+    def test_listing(self):
+        self.assertEqual(self.sizes(), {'docs' : (15, 2)})
+
+    def test_add_delete_rename(self):
+        self.sizes()
+        self.assertEqual(upload(self.fm, 'c' * 100, self.root + 'docs/sub/')['Code'], 0)
+        self.assertEqual(self.sizes(), {'docs' : (115, 3)})
+        self.fm.delete(path=self.root + 'docs/a.txt', req=FakeRequest())
+        self.assertEqual(self.sizes(), {'docs' : (105, 2)})
+        self.fm.rename(old=self.root + 'docs/', new='papers', req=FakeRequest())
+        self.assertEqual(self.sizes(), {'papers' : (105, 2)})
+        self.fm.delete(path=self.root + 'papers/sub/new.txt', req=FakeRequest())
+        self.fm.delete(path=self.root + 'papers/sub/b.txt', req=FakeRequest())
+        self.fm.delete(path=self.root + 'papers/sub/', req=FakeRequest())
+        self.assertEqual(self.sizes(), {'papers' : (0, 0)})
+
+    def test_warm_listing_only_stats_the_subfolders(self):
+        self.sizes()
+        visits = []
+        visit = self.fm.foldersizes._visit
+        self.fm.foldersizes._visit = lambda path: visits.append(path) or visit(path)
+        self.assertEqual(self.sizes(), {'docs' : (15, 2)})
+        self.assertEqual(visits, [])
+
+    def test_change_below_a_subfolder_is_picked_up_once_invalidated(self):
+        self.sizes()
+        self.write(self.root + 'docs/sub/b.txt', 'b' * 50) # Doesn't touch the folders' mtimes.
+        self.assertEqual(self.sizes(), {'docs' : (15, 2)})
+        self.fm.foldersizes.invalidate(self.root + 'docs/sub')
+        self.assertEqual(self.sizes(), {'docs' : (60, 2)})
+
+
+class PoolRoutingTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        self.a, self.b = self.base + '/a/', self.base + '/b/'
+
+    def route(self, pool, path, user='alice'):
+        req = FakeRequest()
+        req.user = user
+        return pool.route(req, 'getinfo', {'path' : path})
+
+    def test_path_alone_routes_nowhere(self):
+        pool = filemanager.FilemanagerPool([self.a, self.b])
+        self.assertIsNone(self.route(pool, self.b + 'x'))
+        pool = filemanager.FilemanagerPool([self.a, self.b], default=self.a)
+        self.assertEqual(self.route(pool, self.b + 'x'), self.a)
+
+    def test_resolve_decides(self):
+        roots = {'alice' : self.a, 'bob' : self.b}
+        pool = filemanager.FilemanagerPool([self.a, self.b], resolve=lambda req, mode, kwargs: roots.get(req.user))
+        self.assertEqual(self.route(pool, self.b + 'x'), self.a)
+        self.assertEqual(self.route(pool, self.a + 'x', 'bob'), self.b)
+        self.assertIsNone(self.route(pool, self.a + 'x', 'mallory'))
+
+    def test_resolve_limits_path_routing(self):
+        pool = filemanager.FilemanagerPool([self.a, self.b], resolve=lambda req, mode, kwargs: [self.a])
+        self.assertEqual(self.route(pool, self.a + 'x'), self.a)
+        self.assertIsNone(self.route(pool, self.b + 'x'))
+
+    def test_routebypath(self):
+        pool = filemanager.FilemanagerPool([self.a, self.b], routebypath=True)
+        self.assertEqual(self.route(pool, self.b + 'x'), self.b)
+        self.assertIsNone(self.route(pool, self.base + '/c/x'))
+
+
+class ChangeWatcherTest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        try:
+            self.watcher = filemanager.ChangeWatcher(self.root)
+        except EnvironmentError:
+            self.skipTest('needs inotify')
+        self.addCleanup(self.watcher.close)
+
+    def wait(self, token):
+        return self.watcher.changes(token, timeout=5)
+
+    def test_failing_listener_keeps_the_thread(self):
+        seen = []
+        def failing(folder):
+            raise IOError('database is locked')
+        self.watcher.listeners[:] = [failing, seen.append]
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            token = self.watcher.token()
+            self.write(self.root + 'a.txt')
+            token, folders = self.wait(token)
+            self.assertEqual(folders, set([self.root.rstrip('/')]))
+            os.mkdir(self.root + 'sub')
+            token, folders = self.wait(token)
+            self.assertTrue(folders)
+            self.assertTrue(self.watcher.thread.is_alive())
+            self.assertIn('database is locked', sys.stderr.getvalue())
+        finally:
+            self.watcher.close()
+            sys.stderr = stderr
+        self.assertIn(self.root.rstrip('/'), seen)
+
+
+class MetricsTest(TempRootTestCase):
+
+    def test_batch_workers_count_for_the_request(self):
+        fm = filemanager.Filemanager(fileroot=self.root, searchindex=False, imagesizecache=False)
+        paths = [self.root + 'image%d.png' % i for i in xrange(4)]
+        for path in paths:
+            self.write(path)
+        read_image_size = filemanager.read_image_size
+        def slow(path):
+            time.sleep(0.02)
+            return 10, 10
+        filemanager.read_image_size = slow
+        try:
+            fm.requestmetrics.start()
+            fm.multigetinfo(paths=json.dumps(paths), req=FakeRequest())
+            counts = fm.requestmetrics.local.counts
+        finally:
+            filemanager.read_image_size = read_image_size
+        self.assertEqual(counts['entries'], 4)
+        self.assertGreaterEqual(counts['image_seconds'], 0.07)
+
+
+class ZipStreamTest(TempRootTestCase):
+
+    files = {'docs/a.txt' : 'hello ' * 1000, 'docs/photo.jpg' : 'not really a jpeg ' * 10, 'docs/blank.txt' : '',
+             'docs/caf\xc3\xa9.txt' : 'caf\xc3\xa9'}
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        os.makedirs(self.root + 'docs/empty')
+        for name, data in self.files.items():
+            self.write(self.root + name, data)
+        self.write(self.root + 'docs/.hidden', 'hidden')
+
+    def assertArchive(self, data):
+        zf = zipfile.ZipFile(StringIO.StringIO(data))
+        self.assertEqual(zf.testzip(), None)
+        names = sorted(self.files) + ['docs/', 'docs/empty/']
+        self.assertEqual(sorted(i.filename.encode('utf-8') for i in zf.infolist()), sorted(names))
+        for name, data in self.files.items():
+            self.assertEqual(zf.read(name.decode('utf-8')), data)
+        methods = dict((i.filename, i.compress_type) for i in zf.infolist())
+        self.assertEqual((methods['docs/a.txt'], methods['docs/photo.jpg']), (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED))
+        self.assertTrue(zf.getinfo('docs/a.txt').compress_size < 100)
+
+    def test_round_trip(self):
+        out = StringIO.StringIO()
+        archive = filemanager.ZipStream(out.write, chunksize=1024)
+        for arcname, path, st in filemanager.archive_members([self.root + 'docs']):
+            if os.path.isdir(path):
+                archive.add(arcname, st)
+            else:
+                archive.add(arcname, st, path, not path.endswith('.jpg'))
+        archive.close()
+        self.assertEqual(archive.offset, len(out.getvalue()))
+        self.assertArchive(out.getvalue())
+
+    def test_downloadarchive(self):
+        fm = filemanager.Filemanager(fileroot=self.root, searchindex=False)
+        req = FakeRequest()
+        fm.downloadarchive(path=self.root + 'docs', req=req)
+        self.assertEqual(req.content_type, 'application/zip')
+        self.assertArchive(req.body())
+
+
+class WSGITest(TempRootTestCase):
+
+    def setUp(self):
+        TempRootTestCase.setUp(self)
+        self.app = filemanager.WSGIApplication(filemanager.Filemanager(fileroot=self.root, searchindex=False))
+        self.write(self.root + 'a.txt', 'aaa')
+
+    def call(self, query='', body=''):
+        environ = {
+            'REQUEST_METHOD' : 'POST' if body else 'GET',
+            'QUERY_STRING' : query,
+            'CONTENT_TYPE' : 'application/x-www-form-urlencoded' if body else '',
+            'CONTENT_LENGTH' : str(len(body)),
+            'wsgi.input' : StringIO.StringIO(body),
+            'wsgi.errors' : sys.stderr,
+        }
+        started = []
+        def start_response(status, headers):
+            started.append((status, dict(headers)))
+            return lambda data: started.append(data)
+        body = ''.join(self.app(environ, start_response))
+        return started[0][0], started[0][1], ''.join(started[1:]) + body
+
+    def test_refused_path_is_403_with_error(self):
+        status, headers, body = self.call('mode=getinfo&path=/etc/passwd')
+        self.assertEqual(status, '403 Forbidden')
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(body)['Code'], -1)
+
+    def test_unknown_mode_is_400(self):
+        self.assertEqual(self.call('mode=__init__')[0], '400 Bad Request')
+
+    def test_posted_heavy_mode_is_limited(self):
+        acquired = []
+        class Limit:
+            def acquire(self):
+                acquired.append(True)
+            def release(self):
+                pass
+        self.app.limit = Limit()
+        status, headers, body = self.call(body='mode=getinfo&path=' + self.root + 'a.txt')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body)['Properties']['Size'], 3)
+        self.assertEqual(acquired, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""Tests of folder moves in the GAE connector, on the App Engine SDK's service stubs.
+
+They need the SDK and an application root providing py.constants, the same
+as the GAE benchmarks in benchmarks/suite.py, given in the GAE_SDK and
+GAE_APP environment variables; without them they're skipped.
+
+Run from the repository root with:
+    GAE_SDK=... GAE_APP=... python -m unittest discover tests
+"""
+import imp, os, sys, unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sdk, app = os.environ.get('GAE_SDK'), os.environ.get('GAE_APP')
+
+# Folders and files below the moved folder; the folders hold FILES_PER_FOLDER files each.
+FOLDERS = 1000
+FILES_PER_FOLDER = 9
+
+
+def load_gae():
+    """Returns the testbed module and the GAE connector, loaded on the SDK's stubs."""
+    sys.path[:0] = [sdk, app, os.path.join(here, '..', 'connectors', 'gae')]
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    return testbed, imp.load_source('gae_filemanager', os.path.join(here, '..', 'connectors', 'gae', 'filemanager.py'))
+
+
+@unittest.skipUnless(sdk and app, 'needs GAE_SDK and GAE_APP')
+class LargeMoveTest(unittest.TestCase):
+
+    def setUp(self):
+        testbed, self.gae = load_gae()
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        self.bed.init_datastore_v3_stub()
+        self.bed.init_memcache_stub()
+        self.bed.init_blobstore_stub()
+        self.bed.init_taskqueue_stub()
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def make_tree(self, path, legacy):
+        """Creates the folder at path with FOLDERS subfolders of FILES_PER_FOLDER files.
+
+        Legacy trees are keyed by id and have no parent_path, as saved before paths were keys.
+        """
+        gae = self.gae
+        def folder(path):
+            if not legacy:
+                return gae.Folder(key_name=path, path=path)
+            f = gae.Folder(path=path)
+            f.parent_path = None
+            return f
+        def file(folder, name):
+            if not legacy:
+                return gae.File(key_name=gae.join_path(folder.path, name), folder=folder, filename=name)
+            return gae.File(folder=folder, filename=name)
+
+        top = folder(path)
+        top.put()
+        gae.db.put(file(top, 'top.txt'))
+        for i in xrange(0, FOLDERS, 100):
+            folders = [ folder(gae.join_path(path, 'sub%04d' % n)) for n in xrange(i, i + 100) ]
+            gae.db.put(folders)
+            gae.db.put([ file(f, 'file%d.txt' % n) for f in folders for n in xrange(FILES_PER_FOLDER) ])
+        return top
+
+    def move(self, top, new_path):
+        gae = self.gae
+        top.move_to(new_path, budget=0)
+        while not gae.continue_move(new_path, budget=5):
+            pass
+
+    def assertMoved(self, old_path, new_path):
+        gae = self.gae
+        self.assertEqual(gae.FolderMove.all().count(limit=None), 0)
+        self.assertEqual(gae.Folder.all().filter('path >=', old_path).filter('path <', old_path + u'\ufffd').count(limit=None), 0)
+        self.assertIsNone(gae.Folder.get_by_path(old_path))
+        moved = gae.Folder.get_by_path(new_path)
+        self.assertIsNotNone(moved)
+        self.assertEqual(moved.key().name(), new_path)
+        self.assertEqual([ f.filename for f in gae.File.all().filter('folder =', moved.key()) ], ['top.txt'])
+        folders = list(gae.Folder.all().filter('path >', new_path + '/').filter('path <', new_path + u'/\ufffd'))
+        self.assertEqual(len(folders), FOLDERS)
+        self.assertTrue(all(f.key().name() == f.path for f in folders))
+        self.assertEqual(gae.File.all().count(limit=None), 1 + FOLDERS * FILES_PER_FOLDER)
+        self.assertTrue(all(f.key().name().startswith(new_path + '/') for f in gae.File.all()))
+
+    def test_move(self):
+        self.move(self.make_tree('/big', legacy=False), '/moved')
+        self.assertMoved('/big', '/moved')
+
+    def test_move_legacy_tree(self):
+        self.move(self.make_tree('/legacy', legacy=True), '/moved')
+        self.assertMoved('/legacy', '/moved')
+
+    def test_interrupted_move_keeps_its_record(self):
+        gae = self.gae
+        top = self.make_tree('/legacy', legacy=True)
+        top.move_to('/moved', budget=0)
+        self.assertFalse(gae.continue_move('/moved', budget=0))
+        self.assertIsNotNone(gae.FolderMove.get_by_key_name('/moved'))
+        while not gae.continue_move('/moved', budget=5):
+            pass
+        self.assertMoved('/legacy', '/moved')
+
+    def test_second_move_of_a_moving_folder(self):
+        gae = self.gae
+        top = self.make_tree('/big', legacy=False)
+        stale = gae.Folder.get(top.key())
+        top.move_to('/moved', budget=0)
+        self.assertRaises(gae.FileException, stale.move_to, '/elsewhere', 0)
+        self.assertIsNone(gae.Folder.get_by_path('/elsewhere'))
+        while not gae.continue_move('/moved', budget=5):
+            pass
+        self.assertMoved('/big', '/moved')
+
+
+if __name__ == '__main__':
+    unittest.main()
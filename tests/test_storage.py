@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Tests of the python connector's storage drivers, and of its modes over each of them.
+
+S3Storage runs against the in-memory client in fakes3.py.
+"""
+import errno, json, os, shutil, sys, tempfile, unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'connectors', 'python'))
+import filemanager
+from fakes3 import FakeS3Client
+from test_filemanager import FakeRequest
+
+
+class StorageTests:
+    """Tests every driver should pass; self.storage holds an empty folder at self.root."""
+
+    def write(self, folder, name, data):
+        with self.storage.create(folder, name) as f:
+            f.write(data)
+
+    def read(self, path):
+        return ''.join(self.storage.chunks(path))
+
+    def assertErrno(self, code, fn, *args):
+        try:
+            fn(*args)
+        except EnvironmentError, e:
+            self.assertEqual(e.errno, code)
+        else:
+            self.fail('%s%r raised nothing' % (fn.__name__, args))
+
+    def test_create_and_read(self):
+        self.write(self.root, 'a.txt', 'hello world')
+        st = self.storage.stat(self.root + 'a.txt')
+        self.assertEqual(st.st_size, 11)
+        self.assertFalse(self.storage.isdir(self.root + 'a.txt'))
+        self.assertEqual(self.read(self.root + 'a.txt'), 'hello world')
+        self.assertEqual(''.join(self.storage.chunks(self.root + 'a.txt', 6, 3)), 'wor')
+        self.assertEqual(''.join(self.storage.chunks(self.root + 'a.txt', 6)), 'world')
+        f = self.storage.open(self.root + 'a.txt')
+        f.seek(-5, 2)
+        self.assertEqual(f.read(), 'world')
+        f.close()
+
+    def test_create_never_replaces(self):
+        self.write(self.root, 'a.txt', 'first')
+        def replace():
+            self.write(self.root, 'a.txt', 'second')
+        self.assertErrno(errno.EEXIST, replace)
+        self.assertEqual(self.read(self.root + 'a.txt'), 'first')
+
+    def test_missing(self):
+        self.assertErrno(errno.ENOENT, self.storage.stat, self.root + 'nope')
+        self.assertFalse(self.storage.exists(self.root + 'nope'))
+        self.assertErrno(errno.ENOENT, lambda path: list(self.storage.list(path)), self.root + 'nope/')
+
+    def test_folders(self):
+        self.storage.mkdir(self.root + 'empty')
+        self.storage.mkdir(self.root + 'docs')
+        self.write(self.root + 'docs/', 'b.txt', 'bb')
+        self.write(self.root, 'a.txt', 'a')
+        self.assertTrue(self.storage.isdir(self.root + 'empty'))
+        self.assertTrue(self.storage.isdir(self.root + 'docs/'))
+        listing = dict(self.storage.list(self.root))
+        self.assertEqual(sorted(listing), ['a.txt', 'docs', 'empty'])
+        self.assertTrue(self.storage.isdir(self.root + 'docs'))
+        self.assertEqual(listing['a.txt'].st_size, 1)
+        self.assertEqual(sorted(self.storage.names(self.root + 'docs')), ['b.txt'])
+        self.assertEqual(list(self.storage.list(self.root + 'empty/')), [])
+        self.assertErrno(errno.EEXIST, self.storage.mkdir, self.root + 'docs')
+
+    def test_rename(self):
+        self.storage.mkdir(self.root + 'docs')
+        self.storage.mkdir(self.root + 'docs/sub')
+        self.write(self.root + 'docs/', 'a.txt', 'a')
+        self.write(self.root + 'docs/sub/', 'b.txt', 'b')
+        self.storage.rename(self.root + 'docs/a.txt', self.root + 'docs/c.txt')
+        self.assertEqual(sorted(self.storage.names(self.root + 'docs')), ['c.txt', 'sub'])
+        self.storage.rename(self.root + 'docs', self.root + 'papers')
+        self.assertFalse(self.storage.exists(self.root + 'docs'))
+        self.assertEqual(self.read(self.root + 'papers/sub/b.txt'), 'b')
+        self.assertEqual(self.read(self.root + 'papers/c.txt'), 'a')
+        self.storage.mkdir(self.root + 'docs')
+        self.assertErrno(errno.EEXIST, self.storage.rename, self.root + 'papers', self.root + 'docs')
+
+    def test_remove(self):
+        self.storage.mkdir(self.root + 'docs')
+        self.write(self.root + 'docs/', 'a.txt', 'a')
+        self.assertErrno(errno.ENOTEMPTY, self.storage.rmdir, self.root + 'docs')
+        self.storage.remove(self.root + 'docs/a.txt')
+        self.storage.rmdir(self.root + 'docs')
+        self.assertEqual(list(self.storage.names(self.root)), [])
+
+    def test_modes(self):
+        fm = filemanager.Filemanager(fileroot=self.root, storage=self.storage, searchindex=False)
+        def call(mode, req=None, **kwargs):
+            req = req or FakeRequest()
+            self.assertEqual(getattr(fm, mode)(req=req, **kwargs), None)
+            return req
+        self.assertEqual(json.loads(call('addfolder', path=self.root, name='docs').body())['Code'], 0)
+        self.write(self.root + 'docs/', 'a.txt', 'hello world')
+        folder = json.loads(call('getfolder', path=self.root + 'docs/').body())
+        self.assertEqual(folder.keys(), [self.root + 'docs/a.txt'])
+        info = json.loads(call('getinfo', path=self.root + 'docs/a.txt').body())
+        self.assertEqual(info['Properties']['Size'], 11)
+        self.assertEqual(call('download', path=self.root + 'docs/a.txt').body(), 'hello world')
+        req = call('download', FakeRequest(headers={'Range' : 'bytes=6-'}), path=self.root + 'docs/a.txt')
+        self.assertEqual((req.status, req.body()), (206, 'world'))
+        result = json.loads(call('rename', old=self.root + 'docs/a.txt', new='b.txt').body())
+        self.assertEqual(result['New Path'], self.root + 'docs/b.txt')
+        self.assertEqual(json.loads(call('delete', path=self.root + 'docs/b.txt').body())['Code'], 0)
+        self.assertEqual(json.loads(call('getfolder', path=self.root + 'docs/').body()), {})
+
+
+class LocalStorageTest(StorageTests, unittest.TestCase):
+
+    def setUp(self):
+        self.base = os.path.realpath(tempfile.mkdtemp())
+        self.root = self.base + '/'
+        self.storage = filemanager.LocalStorage()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+
+class MemoryStorageTest(StorageTests, unittest.TestCase):
+
+    def setUp(self):
+        self.root = '/files/'
+        self.storage = filemanager.MemoryStorage(self.root)
+
+
+class S3StorageTest(StorageTests, unittest.TestCase):
+
+    def setUp(self):
+        self.root = '/files/'
+        self.client = FakeS3Client()
+        self.storage = filemanager.S3Storage(self.root, 'bucket', prefix='tenant/', client=self.client)
+
+    def test_objects(self):
+        self.storage.mkdir(self.root + 'docs')
+        self.write(self.root + 'docs/', 'a.txt', 'a')
+        self.assertEqual(sorted(self.client.buckets['bucket']), ['tenant/docs/', 'tenant/docs/a.txt'])
+
+    def test_listing_pages(self):
+        for i in xrange(2500):
+            self.client.put_object(Bucket='bucket', Key='tenant/wide/file%04d' % i, Body='x')
+        self.client.put_object(Bucket='bucket', Key='tenant/wide/sub/file', Body='x')
+        names = sorted(self.storage.names(self.root + 'wide'))
+        self.assertEqual(names, ['file%04d' % i for i in xrange(2500)] + ['sub'])
+        self.assertEqual(self.client.calls['ListObjectsV2'], 3)
+
+    def test_reads_in_blocks(self):
+        self.write(self.root, 'big.bin', 'x' * 200000)
+        f = self.storage.open(self.root + 'big.bin')
+        gets = self.client.calls.get('GetObject', 0)
+        self.assertEqual(len(''.join(f.read(100) for _ in xrange(600))), 60000)
+        self.assertEqual(self.client.calls['GetObject'] - gets, 1)
+        f.seek(199990)
+        self.assertEqual(f.read(), 'x' * 10)
+        self.assertEqual(f.read(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()